@@ -0,0 +1,408 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+import threading
+
+from CTRL.profiling import profiler
+
+# CTRL as a library: build the model once, with explicit paths and sizes, and generate or score with it
+#
+# generation.py and source_atttribution.py are scripts that parse the command line, read vocab and codes
+# from the working directory and build and load the whole model as they start. nothing happens when this
+# module is imported, TensorFlow isn't even imported: a CTRLModel only holds its paths and sizes, and
+# opens the tokenizer and builds and loads the layers the first time they are used (or on load()).
+# any number of CTRLGenerator and CTRLScorer objects can share one CTRLModel, e.g.
+#
+#   model = CTRLModel(weights='ctrl.wts', codes='CTRL/codes', vocab='CTRL/vocab')
+#   generator = CTRLGenerator(model, temperature=0.2, max_length=128)
+#   generator.generate('Links bitcoin wallet')
+#   CTRLScorer(model).rank('my bitcoin wallet was stolen')
+#
+# the model runs eagerly; eager execution is enabled when it is loaded, if it isn't on yet.
+# loading is thread-safe, running the model isn't: use it from one thread at a time, as server.py does.
+
+
+class CTRLModel(object):
+    # the tokenizer and the loaded layers of one model; the defaults are the 48-layer CTRL model
+    #
+    # weights is a weight file made by weight_store.py, model_path the checkpoint *data* file (slower to load);
+    # one of them is needed for the layers, the tokenizer only needs codes and vocab
+
+    def __init__(self, weights=None, model_path=None, codes='codes', vocab='vocab', num_layers=48,
+                 d_model_size=1280, num_heads=16, dff=8192, max_position=512, precision='fp32', fused_qkv=True):
+        self.weights = weights
+        self.model_path = model_path
+        self.codes = codes
+        self.vocab = vocab
+        self.num_layers = num_layers
+        self.d_model_size = d_model_size
+        self.num_heads = num_heads
+        self.dff = dff
+        self.max_position = max_position
+        self.precision = precision
+        self.fused_qkv = fused_qkv
+        self.lock = threading.RLock()
+        self._tokenizer = None
+        self._layers = None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            with self.lock:
+                if self._tokenizer is None:
+                    from CTRL.tokenizer import Tokenizer
+                    self._tokenizer = Tokenizer(self.codes, self.vocab)
+        return self._tokenizer
+
+    @property
+    def vocab_size(self):
+        return len(self.tokenizer)
+
+    @property
+    def loaded(self):
+        return self._layers is not None
+
+    @property
+    def layers(self):
+        # (encoder, tied_embedding_softmax)
+        if self._layers is None:
+            with self.lock:
+                if self._layers is None:
+                    self._layers = self.build()
+        return self._layers
+
+    def load(self):
+        # loads everything now instead of on first use, e.g. before a server takes requests
+        self.layers
+        return self
+
+    def build(self):
+        if not self.weights and not self.model_path:
+            raise ValueError('one of weights or model_path is needed to load the model')
+        import tensorflow as tf
+        if not tf.executing_eagerly():
+            tf.enable_eager_execution()
+        import CTRL.transformer
+        from CTRL.weight_store import WeightStore, checkpoint_variable_names, load_checkpoint_weights, \
+            load_model_weights
+        # before anything is built, see checkpoint_variable_names
+        names = None if self.weights else checkpoint_variable_names(self.num_layers, self.num_heads)
+        tied_embedding_softmax = CTRL.transformer.TiedEmbeddingSoftmax(self.vocab_size, self.d_model_size)
+        encoder = CTRL.transformer.Encoder(num_layers=self.num_layers, d_model_size=self.d_model_size,
+                                           num_heads=self.num_heads, dff=self.dff, max_position=self.max_position)
+        # built once so that its weights exist to be loaded
+        tied_embedding_softmax(encoder(tied_embedding_softmax(tf.zeros((1, 1), tf.int32), embed=True),
+                                       training=False), embed=False)
+        if self.weights:
+            # the converted weight file is mapped and assigned one tensor at a time
+            load_model_weights(WeightStore(self.weights), tied_embedding_softmax, encoder)
+        else:
+            load_checkpoint_weights(self.model_path, tied_embedding_softmax, encoder, names)
+        # one query/key/value matmul per layer from here on, and the weight matrices at the inference precision
+        if self.fused_qkv:
+            encoder.fuse_qkv()
+        if self.precision != 'fp32':
+            encoder.set_precision(self.precision)
+            tied_embedding_softmax.set_precision(self.precision)
+        return encoder, tied_embedding_softmax
+
+
+def model_of(model):
+    # a CTRLModel, or the keyword arguments of one
+    return model if isinstance(model, CTRLModel) else CTRLModel(**model)
+
+
+class CTRLGenerator(object):
+    # text generation with a CTRLModel, with the options of generation.py
+    #
+    # max_length is the length of a generation, prompt included. past seq_length tokens, generate and stream
+    # slide the key/value cache (window positions, the first `sink` tokens always kept, see decoding.py);
+    # generate_batch and candidates stop at seq_length. cache=False recomputes the window for every token.
+    # shortlist / shortlist_file restrict the next token to a candidate index (see shortlist.py).
+    # draft is a smaller CTRLModel with the same vocabulary, which makes generate and stream decode speculatively,
+    # `speculate` draft tokens per pass of the model. candidates draws num_samples samples, or runs a beam search
+    # of beam_width. topn prints the top-n alternatives of every token; eager_steps runs the decoding steps
+    # eagerly, so that the profiler times every layer.
+
+    def __init__(self, model, max_length=256, temperature=0., nucleus=0., topk=0, penalty=1.2, seq_length=256,
+                 window=0, sink=1, cache=True, shortlist=0, shortlist_file=None, num_samples=4, beam_width=0,
+                 length_penalty=1., draft=None, speculate=4, seed=None, topn=0, eager_steps=False):
+        self.model = model_of(model)
+        self.draft = None if draft is None else model_of(draft)
+        if self.draft is not None and (not cache or shortlist or shortlist_file):
+            raise ValueError('speculative decoding needs the key/value cache and the whole vocabulary')
+        self.max_length = max_length
+        self.temperature = temperature
+        self.nucleus = nucleus
+        self.topk = topk
+        self.penalty = penalty
+        self.seq_length = seq_length
+        self.window = window
+        self.sink = sink
+        self.cache = cache
+        self.shortlist_size = shortlist
+        self.shortlist_file = shortlist_file
+        self.num_samples = num_samples
+        self.beam_width = beam_width
+        self.length_penalty = length_penalty
+        self.speculate = speculate
+        self.seed = seed
+        self.topn = topn
+        self.eager_steps = eager_steps
+        # set up by prepare()
+        self.ready = False
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    def prepare(self):
+        # the sampler, the compiled decoding steps and whatever the options need, once
+        if self.ready:
+            return self
+        with self.model.lock:
+            if not self.ready:
+                self.setup()
+                self.ready = True
+        return self
+
+    def setup(self):
+        from CTRL.decoding import compile_decode_step, compile_window_step
+        from CTRL.sampler import Sampler
+        from CTRL.shortlist import Shortlist, load_candidates, shortlist_ids
+        encoder, tied_embedding_softmax = self.model.layers
+        vocab_size = self.model.vocab_size
+        # temperature, repetition penalty, disallowed tokens and top-k/nucleus pruning of every step
+        self.sampler = Sampler(self.tokenizer.idx2word, temperature=self.temperature, nucleus=self.nucleus,
+                               topk=self.topk, penalty=self.penalty)
+
+        # the logits of every step only cover the shortlisted tokens, if there is a shortlist;
+        # greedy decoding never picks a disallowed token, so they are left out too
+        candidates = load_candidates(self.shortlist_file) if self.shortlist_file else (
+            np.arange(min(self.shortlist_size, vocab_size)) if self.shortlist_size > 0 else None)
+        self.shortlist = None if candidates is None else Shortlist(
+            tied_embedding_softmax, shortlist_ids(self.sampler, candidates, drop_disallowed=self.temperature == 0),
+            vocab_size)
+        self.projection = tied_embedding_softmax if self.shortlist is None else self.shortlist.projection
+
+        # the compiled step that runs new tokens against the key/value cache, shared by all generations,
+        # and the step that replaces the oldest cached position once the window is full
+        self.decode_step = compile_decode_step(encoder, tied_embedding_softmax, self.projection)
+        self.window_step = compile_window_step(encoder, tied_embedding_softmax, self.projection)
+        if self.eager_steps:
+            self.decode_step = self.decode_step.python_function
+            self.window_step = self.window_step.python_function
+
+        self.bucketed_model = None
+        if not self.cache:
+            self.bucketed_model = self.full_window_model()
+
+        self.speculative_decoder = None
+        if self.draft is not None:
+            from CTRL.speculative import SpeculativeDecoder
+            draft_encoder, draft_tied_embedding_softmax = self.draft.layers
+            self.speculative_decoder = SpeculativeDecoder(encoder, tied_embedding_softmax, draft_encoder,
+                                                          draft_tied_embedding_softmax, self.sampler, self.speculate,
+                                                          self.seed)
+
+    def full_window_model(self):
+        # the full-window passes, each traced once per length bucket; they stop at the hidden states
+        import tensorflow as tf
+        from CTRL.buckets import BucketedModel
+        encoder, tied_embedding_softmax = self.model.layers
+        tokens = tf.keras.layers.Input(shape=(None,), dtype='int32')
+        hidden_model = tf.keras.Model(inputs=tokens, outputs=encoder(tied_embedding_softmax(tokens, embed=True),
+                                                                     training=False))
+        return BucketedModel(hidden_model, self.seq_length)
+
+    @property
+    def speculative_stats(self):
+        # SpeculativeStats over every speculative generation so far, None without a draft model
+        return self.speculative_decoder.stats if self.draft is not None and self.ready else None
+
+    def project_last(self, hidden):
+        # the logits of the last position of [batch, width, d_model] hidden states, [batch, vocab]
+        import tensorflow as tf
+        logits = self.projection(tf.constant(hidden[:, -1]), embed=False).numpy()
+        return logits if self.shortlist is None else self.shortlist.expand(logits)
+
+    def stream(self, prompt, max_length=None):
+        # yields the text as it is generated: first the prompt, then what every new token adds to it,
+        # so that ''.join() of everything yielded is the whole completion
+        from CTRL.decoding import SlidingWindowPredictor
+        from CTRL.tokenizer import Detokenizer
+        self.prepare()
+        encoder, tied_embedding_softmax = self.model.layers
+        max_length = max_length or self.max_length
+        seq_length = min(max_length, self.seq_length)
+        with profiler.stage('tokenize'):
+            text = self.tokenizer.encode(prompt)
+
+        tokens_generated = np.zeros((1, max(max_length, len(text))), dtype=np.int64)
+        tokens_generated[0, :len(text)] = text
+        token_counts = self.sampler.new_counts([text])
+        # the text of every new token is worked out on its own, the prefix is never detokenized again
+        detokenizer = Detokenizer(self.tokenizer.idx2word)
+        yield detokenizer.decode(text)
+        if self.speculative_decoder is not None:
+            # every pass of the model adds one or more tokens
+            for new_tokens in self.speculative_decoder.stream(text, max_length):
+                profiler.count('tokens', len(new_tokens))
+                for idx in new_tokens:
+                    with profiler.stage('detokenize'):
+                        delta = detokenizer.add(idx)
+                    yield delta
+            return
+        # with the cache, the prompt is encoded once and every step only runs the newest token;
+        # past the window the oldest tokens (but the first) are evicted from the cache instead of recomputing the window.
+        # the window stays below the encoder's positions; if that leaves nothing past the sink, the window is recomputed
+        window = min(self.window or seq_length, encoder.max_position - 1)
+        cached_predictor = None
+        if self.cache and self.sink < window:
+            cached_predictor = SlidingWindowPredictor(encoder, tied_embedding_softmax, window, encoder.max_position,
+                                                      self.sink, self.decode_step, self.window_step)
+        elif self.bucketed_model is None:
+            with self.model.lock:
+                if self.bucketed_model is None:
+                    self.bucketed_model = self.full_window_model()
+        for token in range(len(text) - 1, max_length - 1):
+            with profiler.stage('forward'):
+                if cached_predictor is not None:
+                    # only the logits at `token` are needed, which is what the cached predictor returns
+                    logits = cached_predictor(tokens_generated, token + 1)
+                    if self.shortlist is not None:
+                        logits = self.shortlist.expand(logits)
+                elif token <= seq_length:
+                    # only the tokens up to `token` are run, padded to the smallest bucket that fits them
+                    logits = self.project_last(self.bucketed_model(tokens_generated[:, :min(token + 1, seq_length)]))
+                else:
+                    # the first token and the last seq_length - 1
+                    start = token - seq_length + 2
+                    logits = self.project_last(self.bucketed_model(np.hstack((tokens_generated[:, 0:1],
+                                                                               tokens_generated[:, start:token + 1]))))
+
+            # temperature, repetition penalty (over everything generated so far) and disallowed tokens
+            logits = self.sampler.process(logits[-1][np.newaxis], token_counts)
+            if self.topn > 0:
+                print('TOPN :: top-n alternatives:',
+                      [self.tokenizer.idx2word[_] for _ in self.sampler.alternatives(logits, self.topn)[0]])
+
+            # greedy, or sample from the top-k / nucleus candidates
+            idx = self.sampler.select(logits)[0]
+            self.sampler.add(token_counts, [idx])
+            if self.topn > 0:
+                print('TOPN :: chosen word:', self.tokenizer.idx2word[idx])
+
+            tokens_generated[0, token + 1] = idx
+            profiler.count('tokens')
+            with profiler.stage('detokenize'):
+                delta = detokenizer.add(idx)
+            yield delta
+
+    def generate(self, prompt, max_length=None):
+        # the completion of one prompt, prompt included
+        with profiler.stage('generate'):
+            return ''.join(self.stream(prompt, max_length))
+
+    def generate_batch(self, prompts, max_length=None):
+        # the completions of a list of prompts, decoded together: one forward pass per step for the whole batch,
+        # and each row stops on its own once it has max_length tokens (at most seq_length)
+        from CTRL.decoding import BatchGenerator
+        self.prepare()
+        encoder, tied_embedding_softmax = self.model.layers
+        with profiler.stage('tokenize'):
+            texts = self.tokenizer.encode_batch(prompts)
+
+        select_fn = self.sampler.for_batch(texts)
+        if self.shortlist is not None:
+            select_fn = lambda logits, rows, select_fn=select_fn: select_fn(self.shortlist.expand(logits), rows)
+        with profiler.stage('generate'):
+            generated = BatchGenerator(encoder, tied_embedding_softmax, self.decode_step).generate(
+                texts, min(max_length or self.max_length, self.seq_length), select_fn)
+        profiler.count('tokens', sum(len(tokens) - len(text) for tokens, text in zip(generated, texts)))
+
+        with profiler.stage('detokenize'):
+            return self.tokenizer.decode_batch(generated)
+
+    def candidates(self, prompt, max_length=None, num_samples=None, beam_width=None):
+        # several completions of one prompt, num_samples samples or the beams of a beam_width beam search,
+        # as (text, score) pairs; the prompt is run once and all candidates are decoded together
+        from CTRL.decoding import CandidateGenerator
+        self.prepare()
+        encoder, tied_embedding_softmax = self.model.layers
+        num_samples = num_samples or self.num_samples
+        beam_width = self.beam_width if beam_width is None else beam_width
+        text = self.tokenizer.encode(prompt)
+        # candidates are scored over the whole vocabulary, so a shortlisted decode_step isn't used
+        generator = CandidateGenerator(encoder, tied_embedding_softmax,
+                                       self.decode_step if self.shortlist is None else None)
+        max_length = min(max_length or self.max_length, self.seq_length)
+        if beam_width > 0:
+            candidates = generator.beam_search(text, beam_width, max_length, self.sampler,
+                                               length_penalty=self.length_penalty)
+        else:
+            candidates = generator.sample(text, num_samples, max_length, self.sampler,
+                                          length_penalty=self.length_penalty)
+        texts = self.tokenizer.decode_batch([tokens for tokens, _ in candidates])
+        return [(content, score) for content, (_, score) in zip(texts, candidates)]
+
+
+def load_domains(path):
+    # the (domain, prior) pairs of a control_codes.txt, one `count domain` line per domain
+    with open(path) as f:
+        domains = [line.split() for line in f.readlines() if line.strip()]
+    return [(t[1], float(t[0])) for t in domains]
+
+
+class CTRLScorer(object):
+    # source attribution with a CTRLModel, as in source_atttribution.py: which domains (control codes) a prompt
+    # most likely comes from. domains is a list of (domain, prior) pairs, all of control_codes.py by default;
+    # see load_domains for the file of source_atttribution.py
+
+    def __init__(self, model, domains=None, seq_length=256, batch_size=8, score_domain_tokens=False):
+        self.model = model_of(model)
+        if domains is None:
+            from CTRL.control_codes import CONTROL_CODES
+            domains = [(domain, float(count)) for domain, count in sorted(CONTROL_CODES.items())]
+        self.domains = domains
+        self.seq_length = seq_length
+        self.batch_size = batch_size
+        self.score_domain_tokens = score_domain_tokens
+        # set up by prepare()
+        self.ready = False
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    def prepare(self):
+        if self.ready:
+            return self
+        with self.model.lock:
+            if not self.ready:
+                self.setup()
+                self.ready = True
+        return self
+
+    def setup(self):
+        import tensorflow as tf
+        from CTRL.attribution import DomainScorer, NextTokenLogProbs
+        from CTRL.buckets import BucketedModel, make_buckets
+        encoder, tied_embedding_softmax = self.model.layers
+        # the next-token log-probabilities of an input of any width, scored in length buckets
+        tokens = tf.keras.layers.Input(shape=(None,), dtype='int32')
+        logits = tied_embedding_softmax(encoder(tied_embedding_softmax(tokens, embed=True), training=False),
+                                        embed=False)
+        self.score_fn = BucketedModel(tf.keras.Model(inputs=tokens, outputs=NextTokenLogProbs()([logits, tokens])),
+                                      self.seq_length)
+        # the domain tags are tokenized once, the prompts are scored after each of them
+        self.domain_scorer = DomainScorer(self.domains, self.tokenizer.encode_batch([d for d, _ in self.domains]),
+                                          self.seq_length, make_buckets(self.seq_length))
+
+    def rank(self, prompt):
+        # (domain, perplexity, p(domain | prompt)) of every domain, the most likely first
+        self.prepare()
+        with profiler.stage('tokenize'):
+            text = self.tokenizer.encode(prompt)
+        return self.domain_scorer.rank(self.score_fn, text, self.batch_size, self.score_domain_tokens)
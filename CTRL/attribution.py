@@ -0,0 +1,106 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+
+# scoring for source attribution: how likely is a prompt under each domain (control code)
+#
+# every candidate is `domain + ' ' + prompt`. instead of one forward pass per domain
+# and a python loop over positions to get its perplexity, the candidates are packed into
+# batches and the model itself returns the log-probability of every next token,
+# so only [batch, seq_length - 1] numbers come back instead of the logits over the whole vocabulary
+
+
+class NextTokenLogProbs(tf.keras.layers.Layer):
+    # log p(tokens[:, i + 1] | tokens[:, :i + 1]) for every position, from the logits of the model
+    # (a log-softmax and gather, fused into the cross entropy op)
+
+    def call(self, inputs):
+        logits, tokens = inputs
+        targets = tf.cast(tokens[:, 1:], tf.int32)
+        return -tf.nn.sparse_softmax_cross_entropy_with_logits(labels=targets, logits=logits[:, :-1])
+
+
+def pack(texts, seq_length):
+    # right-pads token id lists into one [len(texts), seq_length] array
+    # (attention is causal, so the padding after a text doesn't change its scores)
+    tokens = np.zeros((len(texts), seq_length), dtype=np.int32)
+    for row, text in enumerate(texts):
+        tokens[row, :len(text)] = text
+    return tokens
+
+
+def sequence_log_probs(score_fn, tokens, lengths, starts, batch_size):
+    # total log-probability of tokens[row, starts[row]:lengths[row]] for every row,
+    # in as few forward passes as batch_size allows
+    # score_fn maps a [batch, width] token array to its [batch, width - 1] next-token log-probabilities
+    # returns the totals and the number of tokens counted per row
+    predicted = np.arange(1, tokens.shape[1])[np.newaxis, :]
+    counted = (predicted >= starts[:, np.newaxis]) & (predicted < lengths[:, np.newaxis])
+    totals = np.zeros(len(tokens))
+    for start in range(0, len(tokens), batch_size):
+        log_probs = np.asarray(score_fn(tokens[start:start + batch_size]), dtype=np.float64)
+        totals[start:start + batch_size] = (log_probs * counted[start:start + batch_size]).sum(axis=-1)
+    return totals, lengths - starts
+
+
+def rank(domains, totals, counts):
+    # (domain, perplexity, posterior) triples, most likely domain first;
+    # the posterior is p(domain | prompt) from the priors and the likelihood of what was scored
+    ppls = np.exp(-totals / np.maximum(counts, 1))
+
+    priors = np.array([prior for _, prior in domains], dtype=np.float64)
+    log_posterior = np.log(priors / priors.sum()) + totals
+    posterior = np.exp(log_posterior - log_posterior.max())
+    posterior /= posterior.sum()
+
+    ranked = [(domain, round(ppls[i], 6), posterior[i]) for i, (domain, _) in enumerate(domains)]
+    ranked.sort(key=lambda x: -x[2])
+    return ranked
+
+
+def rank_domains(score_fn, domains, texts, seq_length, batch_size=8):
+    # domains is a list of (domain, prior) pairs and texts the numericalized `domain + ' ' + prompt` of each;
+    # every text is scored from its second token on, over the whole seq_length window
+    lengths = np.array([len(text) for text in texts])
+    totals, counts = sequence_log_probs(score_fn, pack(texts, seq_length), lengths, np.ones_like(lengths),
+                                        batch_size)
+    return rank(domains, totals, counts)
+
+
+class DomainScorer(object):
+    # attribution for a stream of prompts against a fixed set of domains
+    #
+    # only the domain tag differs between the candidates, so the tags are tokenized once and written
+    # into a padded token buffer that is reused for every prompt; each prompt is tokenized once
+    # and copied in after every tag. only the prompt tokens are scored, log p(prompt | domain),
+    # and the forward passes stop at the longest candidate instead of running the whole window,
+    # which for short email subjects is most of the work. score_fn has to accept any width;
+    # with `buckets` the width is rounded up to the smallest bucket that fits, so it only ever sees those.
+
+    def __init__(self, domains, domain_texts, seq_length, buckets=None):
+        # domain_texts are the numericalized domain tags
+        self.domains = domains
+        self.seq_length = seq_length
+        self.buckets = buckets
+        self.starts = np.array([len(text) for text in domain_texts])
+        self.tokens = pack(domain_texts, seq_length)
+        # how far the buffer was filled by the last prompt
+        self.filled = int(self.starts.max())
+
+    def rank(self, score_fn, prompt_text, batch_size=8, score_domain_tokens=False):
+        # prompt_text is the numericalized prompt without any tag;
+        # with score_domain_tokens the tag pieces after the first one are scored too, like rank_domains does
+        lengths = np.minimum(self.starts + len(prompt_text), self.seq_length)
+        width = int(lengths.max())
+        if self.buckets:
+            # the buffer past the filled part is all padding already
+            width = next(bucket for bucket in self.buckets if width <= bucket)
+        for row, start in enumerate(self.starts):
+            self.tokens[row, start:lengths[row]] = prompt_text[:lengths[row] - start]
+            self.tokens[row, lengths[row]:self.filled] = 0
+        self.filled = width
+        starts = np.ones_like(self.starts) if score_domain_tokens else self.starts
+        totals, counts = sequence_log_probs(score_fn, self.tokens[:, :width], lengths, starts, batch_size)
+        return rank(self.domains, totals, counts)
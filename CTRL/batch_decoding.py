@@ -0,0 +1,67 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+
+# the decoding loop of a batch of prompts, shared by BatchGenerator (decoding.py) and NumpyModel (numpy_model.py)
+#
+# the prompts are left-padded to the same length so that every row appends its next token
+# in the same column; the padding is masked out of the attention and the positions of each row
+# start at its first real token, so a row decodes exactly as it would on its own.
+# rows that are done (length reached or a stop token sampled) are dropped from the batch,
+# together with their part of the cache, so the remaining rows don't pay for them.
+#
+# the model only comes in through three functions, so that this module doesn't import TensorFlow:
+#   step(tokens, past, padding_mask, position_ids) -> ([batch, vocab] numpy logits of the last position, past)
+#   empty_cache(batch_size) -> past
+#   gather_cache(past, rows) -> the past of those rows
+
+
+def decode_batch(step, empty_cache, gather_cache, prompts, max_lengths, select_fn, stop_tokens=()):
+    # prompts: list of token id lists
+    # max_lengths: total length (prompt included) per row, or one int for all rows
+    # select_fn(logits, rows): picks the next token of every active row from its [rows, vocab] logits;
+    #   rows are the indices into `prompts` of the active rows (see Sampler.for_batch)
+    # returns the token id lists, prompt included, in the order of `prompts`
+    if len(prompts) == 0:
+        return []
+    if isinstance(max_lengths, int):
+        max_lengths = [max_lengths] * len(prompts)
+    generated = [list(prompt) for prompt in prompts]
+    stop_tokens = set(stop_tokens)
+
+    width = max(len(prompt) for prompt in prompts)
+    tokens = np.zeros((len(prompts), width), dtype=np.int32)
+    padding_mask = np.ones((len(prompts), width), dtype=np.float32)
+    position_ids = np.zeros((len(prompts), width), dtype=np.int32)
+    for row, prompt in enumerate(prompts):
+        pad = width - len(prompt)
+        tokens[row, pad:] = prompt
+        padding_mask[row, pad:] = 0.
+        position_ids[row, pad:] = np.arange(len(prompt))
+
+    # rows of the batch still decoding, as indices into `prompts`
+    active = [row for row in range(len(prompts)) if len(generated[row]) < max_lengths[row]]
+    keep = np.array(active, dtype=np.int32)
+    past = empty_cache(len(prompts))
+    while len(active) > 0:
+        if len(keep) < tokens.shape[0]:
+            # drop the rows that finished last step
+            past = gather_cache(past, keep)
+            tokens, padding_mask, position_ids = tokens[keep], padding_mask[keep], position_ids[keep]
+        logits, past = step(tokens, past, padding_mask, position_ids)
+        next_tokens = select_fn(logits, active)
+
+        still_active = []
+        for i, row in enumerate(active):
+            generated[row].append(int(next_tokens[i]))
+            if len(generated[row]) < max_lengths[row] and next_tokens[i] not in stop_tokens:
+                still_active.append(i)
+        keep = np.array(still_active, dtype=np.int32)
+        active = [active[i] for i in still_active]
+
+        # the next step feeds only the token each row just got
+        tokens = np.asarray(next_tokens, dtype=np.int32)[:, np.newaxis]
+        position_ids = position_ids[:, -1:] + 1
+        padding_mask = np.hstack((padding_mask, np.zeros((len(padding_mask), 1), dtype=np.float32)))
+    return generated
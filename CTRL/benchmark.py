@@ -0,0 +1,131 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+tf.enable_eager_execution()
+import CTRL.benchmark_decoding as benchmark_decoding
+import CTRL.benchmark_model as benchmark_model
+import CTRL.benchmark_sampling as benchmark_sampling
+import CTRL.benchmark_serving as benchmark_serving
+import CTRL.benchmark_vocab as benchmark_vocab
+from CTRL.benchmark_common import failed_checks
+import argparse
+import sys
+
+# timing harnesses for the inference code, run on tiny random-weight models
+# so they don't need the real checkpoint, vocab or BPE codes
+# e.g. python -m CTRL.benchmark kv_cache
+#
+# the benchmarks are in benchmark_<feature>.py, by what they exercise; this is their command line.
+# a benchmark whose optimized path doesn't give the same result as the one it replaces exits with 1
+
+# every benchmark, by the name it is run with
+BENCHMARKS = {
+    'kv_cache': benchmark_decoding.bench_kv_cache,
+    'batch': benchmark_decoding.bench_batch,
+    'sampler': benchmark_sampling.bench_sampler,
+    'attribution': benchmark_serving.bench_attribution,
+    'weight_store': benchmark_model.bench_weight_store,
+    'buckets': benchmark_decoding.bench_buckets,
+    'detokenize': benchmark_sampling.bench_detokenize,
+    'long': benchmark_decoding.bench_long,
+    'attention': benchmark_model.bench_attention,
+    'positions': benchmark_model.bench_positions,
+    'precision': benchmark_model.bench_precision,
+    'projection': benchmark_model.bench_projection,
+    'serve': benchmark_serving.bench_serve,
+    'tokenize': benchmark_vocab.bench_tokenize,
+    'vocab': benchmark_vocab.bench_vocab,
+    'speculative': benchmark_decoding.bench_speculative,
+    'candidates': benchmark_decoding.bench_candidates,
+    'profile': benchmark_serving.bench_profile,
+}
+
+parser = argparse.ArgumentParser(description='benchmarks for the CTRL inference code on tiny random-weight models')
+parser.add_argument('benchmark', type=str, choices=list(BENCHMARKS),
+                    help='which benchmark to run')
+parser.add_argument('--seed', type=int, default=1337,
+                    help='random seed for TensorFlow and numpy')
+parser.add_argument('--num_layers', type=int, default=2,
+                    help='number of encoder layers of the tiny model')
+parser.add_argument('--d_model_size', type=int, default=64,
+                    help='model dimension of the tiny model')
+parser.add_argument('--num_heads', type=int, default=4,
+                    help='number of attention heads of the tiny model')
+parser.add_argument('--dff', type=int, default=256,
+                    help='feed forward dimension of the tiny model')
+parser.add_argument('--vocab_size', type=int, default=1000,
+                    help='vocabulary size of the tiny model')
+parser.add_argument('--seq_length', type=int, default=256,
+                    help='window the full-window model is built with')
+parser.add_argument('--prompt_length', type=int, default=8,
+                    help='number of random prompt tokens')
+parser.add_argument('--generate_num', type=int, default=128,
+                    help='total number of tokens (prompt included) to decode')
+parser.add_argument('--sampler_vocab_size', type=int, default=246534,
+                    help='vocabulary size for the sampler benchmark, the real one by default')
+parser.add_argument('--sampler_steps', type=int, default=50,
+                    help='number of steps timed per sampler setting')
+parser.add_argument('--penalty', type=float, default=1.2,
+                    help='repetition penalty for the sampler benchmark')
+parser.add_argument('--attribution_batch_size', type=int, default=8,
+                    help='number of domains scored per forward pass in the attribution benchmark')
+parser.add_argument('--short_prompts', type=int, default=64,
+                    help='number of short prompts for the length bucket benchmark')
+parser.add_argument('--long_tokens', type=int, default=4096,
+                    help='tokens generated by the long generation benchmark')
+parser.add_argument('--window', type=int, default=128,
+                    help='key/value cache window of the long generation benchmark')
+parser.add_argument('--max_position', type=int, default=512,
+                    help='positions the model is run with in the long generation benchmark')
+parser.add_argument('--layer_d_model_size', type=int, default=1280,
+                    help='model size of the attention layer benchmark')
+parser.add_argument('--layer_num_heads', type=int, default=16,
+                    help='attention heads of the attention layer benchmark')
+parser.add_argument('--projection_vocab_size', type=int, default=100000,
+                    help='vocabulary size of the projection benchmark; the random initialization of the real '
+                         '246534 x 1280 embedding alone needs ~5GB')
+parser.add_argument('--shortlist_size', type=int, default=32768,
+                    help='candidate tokens kept by the shortlist in the projection benchmark')
+parser.add_argument('--clients', type=int, default=8,
+                    help='concurrent clients of the serving benchmark')
+parser.add_argument('--requests', type=int, default=4,
+                    help='generate requests sent by every client of the serving benchmark')
+parser.add_argument('--max_delay_ms', type=float, default=10.,
+                    help='batching latency budget of the serving benchmark')
+parser.add_argument('--codes', type=str, default='CTRL/codes',
+                    help='BPE codes for the tokenizer benchmark with --fastbpe')
+parser.add_argument('--vocab', type=str, default='CTRL/vocab',
+                    help='vocabulary for the vocab benchmark, and the tokenizer benchmark with --fastbpe')
+parser.add_argument('--fastbpe', action='store_true',
+                    help='run the tokenizer benchmark on fastBPE with --codes and --vocab '
+                         'instead of a synthetic vocabulary')
+parser.add_argument('--tokenizer_vocab_size', type=int, default=32000,
+                    help='size of the synthetic vocabulary of the tokenizer benchmark')
+parser.add_argument('--prompts', type=int, default=2000,
+                    help='prompts of the tokenizer benchmark')
+parser.add_argument('--batch_sizes', type=str, default='1,2,4,8,16',
+                    help='comma separated batch sizes for the batch benchmark')
+parser.add_argument('--draft_num_layers', type=int, default=1,
+                    help='encoder layers of the draft model of the speculative decoding benchmark')
+parser.add_argument('--draft_d_model_size', type=int, default=32,
+                    help='model dimension of the independent draft model of the speculative decoding benchmark')
+parser.add_argument('--speculate', type=int, default=4,
+                    help='draft tokens per main model pass in the speculative decoding benchmark')
+parser.add_argument('--num_samples', type=int, default=8,
+                    help='samples per prompt in the candidates benchmark')
+parser.add_argument('--beam_width', type=int, default=4,
+                    help='beam width in the candidates benchmark')
+parser.add_argument('--samples', type=int, default=2000,
+                    help='sequences drawn to compare the output distributions in the speculative decoding benchmark')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    tf.random.set_random_seed(args.seed)
+    np.random.seed(args.seed)
+    BENCHMARKS[args.benchmark](args)
+    if failed_checks:
+        print('failed parity checks: {}'.format('; '.join(failed_checks)))
+        sys.exit(1)
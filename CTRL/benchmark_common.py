@@ -0,0 +1,100 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+tf.enable_eager_execution()
+import CTRL.transformer
+from CTRL.decoding import CachedPredictor
+import os
+import time
+
+# what the benchmarks of benchmark.py share: tiny random-weight models, the greedy loops they are checked against,
+# timing and memory readings, and the record of the parity checks
+#
+# every benchmark checks that what it times gives the same result as what it replaces. check() records each of
+# those comparisons, and benchmark.py exits with 1 if any of them failed, so a benchmark that has gone wrong
+# fails the run instead of printing a False in its table
+
+# names of the parity checks that failed in this run
+failed_checks = []
+
+
+def check(name, ok):
+    # records a parity check and returns whether it passed, for printing
+    ok = bool(ok)
+    if not ok:
+        failed_checks.append(name)
+    return ok
+
+
+def build_tiny_model(num_layers, d_model_size, num_heads, dff, vocab_size, seq_length):
+    # same wiring as generation.py, at a size that builds in a second
+    tied_embedding_softmax = CTRL.transformer.TiedEmbeddingSoftmax(vocab_size, d_model_size)
+    encoder = CTRL.transformer.Encoder(num_layers=num_layers, d_model_size=d_model_size, num_heads=num_heads,
+                                       dff=dff, max_position=max(seq_length, 512))
+    tokens = tf.keras.layers.Input(shape=(seq_length,), dtype='int32')
+    logits = tied_embedding_softmax(encoder(tied_embedding_softmax(tokens, embed=True), training=False), embed=False)
+    model = tf.keras.Model(inputs=tokens, outputs=logits)
+    return model, encoder, tied_embedding_softmax
+
+
+def greedy_full_window(model, text, generate_num, seq_length):
+    # the decoding loop of generation.py without the cache: the whole window is recomputed every step
+    tokens_generated = np.tile(text + [0] * (max(generate_num, seq_length) - len(text)), (1, 1))
+    for token in range(len(text) - 1, generate_num - 1):
+        prompt_logits = model.predict_on_batch(tokens_generated[:, :seq_length])
+        prompt_logits = np.asarray(prompt_logits)[0]
+        tokens_generated[0][token + 1] = np.argmax(prompt_logits[token])
+    return tokens_generated[0][:generate_num].tolist()
+
+
+def greedy_cached(encoder, tied_embedding_softmax, text, generate_num):
+    tokens_generated = np.tile(text + [0] * (generate_num - len(text)), (1, 1))
+    cached_predictor = CachedPredictor(encoder, tied_embedding_softmax)
+    for token in range(len(text) - 1, generate_num - 1):
+        prompt_logits = cached_predictor(tokens_generated, token + 1)
+        tokens_generated[0][token + 1] = np.argmax(prompt_logits[0])
+    return tokens_generated[0][:generate_num].tolist()
+
+
+def timed(fn, *fn_args):
+    start = time.time()
+    result = fn(*fn_args)
+    return result, time.time() - start
+
+
+def synthetic_vocab(vocab_size):
+    # a stand-in for the BPE vocabulary with the tokens the sampler treats specially
+    vocab = ['tok%d' % i for i in range(vocab_size - 3)] + ['Sco@@', '<unk>', '\n']
+    for i in range(7, vocab_size - 3, 997):
+        vocab[i] = 'http%d' % i
+    return np.array(vocab)
+
+
+def memory_status():
+    # (current, peak) resident set size and the anonymous (private) part of it, in MB, from /proc
+    status = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            status[key] = value.split()
+    return dict((key, int(status[key][0]) / 1024.) for key in ['VmRSS', 'VmHWM', 'RssAnon'] if key in status)
+
+
+def reset_peak_rss():
+    # lets VmHWM measure the next step only (linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def drop_page_cache(path):
+    # so that every load reads from disk, as on a cold start
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
@@ -0,0 +1,304 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+from CTRL.benchmark_common import build_tiny_model, check, greedy_cached, greedy_full_window, synthetic_vocab, \
+    timed
+from CTRL.buckets import BucketedModel, bucket_for
+from CTRL.decoding import BatchGenerator, CachedPredictor, CandidateGenerator, SlidingWindowPredictor, \
+    compile_decode_step, log_probs
+from CTRL.sampler import Sampler
+from CTRL.speculative import SpeculativeDecoder, draw
+import CTRL.transformer
+import time
+
+# benchmarks of the decoding loops: the key/value cache, batches, length buckets, the sliding window,
+# speculative decoding and candidate generation (see benchmark.py)
+
+
+def bench_kv_cache(args):
+    seq_length = min(args.seq_length, args.generate_num)
+    model, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                              args.dff, args.vocab_size, seq_length)
+    text = np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+
+    # warm up both paths once so that tracing isn't part of the timing
+    greedy_full_window(model, text, args.prompt_length + 2, seq_length)
+    greedy_cached(encoder, tied_embedding_softmax, text, args.prompt_length + 2)
+
+    full, full_time = timed(greedy_full_window, model, text, args.generate_num, seq_length)
+    cached, cached_time = timed(greedy_cached, encoder, tied_embedding_softmax, text, args.generate_num)
+
+    steps = args.generate_num - args.prompt_length
+    print('decoded {} tokens from a {} token prompt, window {}'.format(steps, args.prompt_length, seq_length))
+    print('full window: {:.2f} ms/token'.format(1000. * full_time / steps))
+    print('kv cache:    {:.2f} ms/token'.format(1000. * cached_time / steps))
+    print('speedup:     {:.1f}x'.format(full_time / cached_time))
+    print('same greedy output: {}'.format(check('kv_cache: same greedy output', full == cached)))
+
+
+def greedy_select(logits, rows):
+    return np.argmax(logits, axis=-1)
+
+
+def bench_batch(args):
+    _, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                          args.dff, args.vocab_size, args.seq_length)
+    batch_generator = BatchGenerator(encoder, tied_embedding_softmax,
+                                     compile_decode_step(encoder, tied_embedding_softmax))
+    batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(',')]
+    # prompts of different lengths, and rows that stop at different lengths
+    prompts = [np.random.randint(0, args.vocab_size, size=np.random.randint(2, 2 * args.prompt_length)).tolist()
+               for _ in range(max(batch_sizes))]
+    max_lengths = [args.generate_num - np.random.randint(0, args.generate_num // 4) for _ in prompts]
+
+    # every row of a batch has to decode exactly as it does on its own
+    alone = [batch_generator.generate([prompt], max_length, greedy_select)[0]
+             for prompt, max_length in zip(prompts, max_lengths)]
+
+    print('batch size | tokens/sec | same output as unbatched')
+    for batch_size in batch_sizes:
+        generated, batch_time = timed(batch_generator.generate, prompts[:batch_size], max_lengths[:batch_size],
+                                      greedy_select)
+        new_tokens = sum(len(tokens) - len(prompt) for tokens, prompt in zip(generated, prompts))
+        print('{:10d} | {:10.1f} | {}'.format(batch_size, new_tokens / batch_time, check(
+            'batch: batch of {} same as unbatched'.format(batch_size), generated == alone[:batch_size])))
+
+
+def bench_buckets(args):
+    model, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                              args.dff, args.vocab_size, args.seq_length)
+    # the same layers behind an input of any width
+    tokens = tf.keras.layers.Input(shape=(None,), dtype='int32')
+    logits = tied_embedding_softmax(encoder(tied_embedding_softmax(tokens, embed=True), training=False), embed=False)
+    bucketed_model = BucketedModel(tf.keras.Model(inputs=tokens, outputs=logits), args.seq_length)
+
+    # short prompts, like email subjects and keywords
+    lengths = np.random.randint(4, 25, size=args.short_prompts)
+    prompts = [np.random.randint(0, args.vocab_size, size=(1, length)) for length in lengths]
+
+    def fixed():
+        outputs = []
+        for prompt in prompts:
+            padded = np.zeros((1, args.seq_length), dtype=np.int32)
+            padded[:, :prompt.shape[1]] = prompt
+            outputs.append(model.predict_on_batch(padded)[0, prompt.shape[1] - 1])
+        return outputs
+
+    def bucketed():
+        return [bucketed_model(prompt)[0, -1] for prompt in prompts]
+
+    fixed()
+    bucketed_model.warmup()
+    reference, fixed_time = timed(fixed)
+    outputs, bucketed_time = timed(bucketed)
+    same = check('buckets: same logits', all(np.allclose(a, b, atol=1e-4) for a, b in zip(reference, outputs)))
+
+    used = sorted(set(bucket_for(length, bucketed_model.buckets) for length in lengths))
+    print('{} prompts of 4-24 tokens, window {}, buckets {} (used {})'.format(
+        len(prompts), args.seq_length, list(bucketed_model.buckets), used))
+    print('mode                   | prompts/sec | speedup | same logits')
+    print('{:22s} | {:11.1f} | {:6.1f}x | -'.format('padded to the window', len(prompts) / fixed_time, 1.))
+    print('{:22s} | {:11.1f} | {:6.1f}x | {}'.format('length buckets', len(prompts) / bucketed_time,
+                                                     fixed_time / bucketed_time, same))
+
+
+def greedy_sliding_recompute(bucketed_model, text, generate_num, window):
+    # generation.py past the window without the cache: the first token and the last window - 1 tokens
+    # are run through the whole model again for every new token
+    tokens_generated = np.tile(text + [0] * (generate_num - len(text)), (1, 1))
+    for token in range(len(text) - 1, generate_num - 1):
+        start = max(token - window + 2, 1)
+        window_tokens = np.hstack((tokens_generated[:, 0:1], tokens_generated[:, start:token + 1]))
+        tokens_generated[0][token + 1] = np.argmax(bucketed_model(window_tokens)[0, -1])
+    return tokens_generated[0][:generate_num].tolist()
+
+
+def bench_long(args):
+    model, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                              args.dff, args.vocab_size, args.max_position)
+    tokens = tf.keras.layers.Input(shape=(None,), dtype='int32')
+    logits = tied_embedding_softmax(encoder(tied_embedding_softmax(tokens, embed=True), training=False), embed=False)
+    bucketed_model = BucketedModel(tf.keras.Model(inputs=tokens, outputs=logits), args.window)
+    text = np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+    predictor = SlidingWindowPredictor(encoder, tied_embedding_softmax, args.window, args.max_position)
+
+    # up to the window it is the plain cache
+    same = greedy_cached(encoder, tied_embedding_softmax, text, args.window)
+    tokens_generated = np.tile(text + [0] * (args.long_tokens - len(text)), (1, 1))
+    segment = 512
+    segment_times = []
+    start = time.time()
+    for token in range(len(text) - 1, args.long_tokens - 1):
+        prompt_logits = predictor(tokens_generated, token + 1)
+        tokens_generated[0][token + 1] = np.argmax(prompt_logits[0])
+        if (token + 2) % segment == 0:
+            segment_times.append(time.time() - start)
+            start = time.time()
+    same = check('long: same as the plain cache within the window', tokens_generated[0][:args.window].tolist() == same)
+
+    # the recompute, on a stretch past the window only
+    recompute_tokens = 2 * args.window
+    greedy_sliding_recompute(bucketed_model, text, args.window + 2, args.window)
+    _, recompute_time = timed(greedy_sliding_recompute, bucketed_model, text, recompute_tokens, args.window)
+    recompute_per_token = recompute_time / (recompute_tokens - len(text))
+
+    print('generated {} tokens, window {} (first token kept), re-encoded every {} tokens'.format(
+        args.long_tokens, args.window, args.max_position - args.window))
+    print('same as the plain cache within the window: {}'.format(same))
+    print('tokens      | ms/token')
+    for i, segment_time in enumerate(segment_times):
+        print('{:5d}-{:5d} | {:8.2f}'.format(i * segment, (i + 1) * segment, 1000. * segment_time / segment))
+    print('window recompute for every token: {:.2f} ms/token'.format(1000. * recompute_per_token))
+
+
+def truncated_draft(encoder, num_layers, num_heads, dff):
+    # a draft made of the first layers of `encoder` and its final layernorm, for the same embedding
+    draft = CTRL.transformer.Encoder(num_layers=num_layers, d_model_size=encoder.d_model_size, num_heads=num_heads,
+                                     dff=dff, max_position=encoder.max_position)
+    draft(tf.zeros((1, 1, encoder.d_model_size)), training=False)
+    layers = [getattr(encoder, 'layer%i' % i) for i in range(num_layers)] + [encoder.layernorm]
+    draft_layers = [getattr(draft, 'layer%i' % i) for i in range(num_layers)] + [draft.layernorm]
+    for layer, draft_layer in zip(layers, draft_layers):
+        for variable, draft_variable in zip(layer.weights, draft_layer.weights):
+            draft_variable.assign(variable)
+    return draft
+
+
+def sample_cached(encoder, tied_embedding_softmax, sampler, prompt, generate_num, rng, decode_step=None):
+    # the decoding loop without a draft, with the same sampler and the same way of drawing a token
+    cached_predictor = CachedPredictor(encoder, tied_embedding_softmax, decode_step)
+    generated = list(prompt)
+    counts = sampler.new_counts([generated])
+    while len(generated) < generate_num:
+        logits = cached_predictor(np.array([generated]), len(generated))
+        token = draw(sampler.probabilities(sampler.process(logits, counts))[0], rng)
+        sampler.add(counts, [token])
+        generated.append(token)
+    return generated
+
+
+def total_variation(samples, probs):
+    # distance between the empirical distribution of samples (ids into probs) and probs
+    counts = np.bincount(samples, minlength=len(probs)) / float(len(samples))
+    return 0.5 * np.abs(counts - probs).sum()
+
+
+def bench_speculative(args):
+    _, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                          args.dff, args.vocab_size, args.seq_length)
+    _, draft_encoder, draft_tied = build_tiny_model(args.draft_num_layers, args.draft_d_model_size, args.num_heads,
+                                                    args.dff // 4, args.vocab_size, args.seq_length)
+    drafts = [('independent random draft', draft_encoder, draft_tied),
+              ('first {} layer(s) of the main model'.format(args.draft_num_layers),
+               truncated_draft(encoder, args.draft_num_layers, args.num_heads, args.dff), tied_embedding_softmax)]
+    prompt = np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+    decode_step = compile_decode_step(encoder, tied_embedding_softmax)
+
+    print('main model {} layers x {}, vocabulary {}, {} tokens after a {} token prompt, k = {}'.format(
+        args.num_layers, args.d_model_size, args.vocab_size, args.generate_num - args.prompt_length,
+        args.prompt_length, args.speculate))
+    print('decoding                                  | temperature | ms/token | accepted | tokens/pass | same as greedy')
+    for temperature in [0., 1.]:
+        sampler = Sampler(synthetic_vocab(args.vocab_size), temperature=temperature, topk=0, penalty=args.penalty)
+        sample_cached(encoder, tied_embedding_softmax, sampler, prompt, args.prompt_length + 2,
+                      np.random.RandomState(0), decode_step)
+        reference, elapsed = timed(sample_cached, encoder, tied_embedding_softmax, sampler, prompt,
+                                   args.generate_num, np.random.RandomState(args.seed), decode_step)
+        print('{:41s} | {:11.1f} | {:8.2f} | {:>8s} | {:11.2f} | {}'.format(
+            'main model only', temperature, 1000. * elapsed / (args.generate_num - args.prompt_length), '-', 1.,
+            '-' if temperature else True))
+        for name, draft, draft_tied_embedding_softmax in drafts:
+            decoder = SpeculativeDecoder(encoder, tied_embedding_softmax, draft, draft_tied_embedding_softmax,
+                                         sampler, args.speculate, args.seed)
+            decoder.generate(prompt, args.prompt_length + 2)
+            decoder.stats = type(decoder.stats)()
+            generated, elapsed = timed(decoder.generate, prompt, args.generate_num)
+            print('{:41s} | {:11.1f} | {:8.2f} | {:8.1%} | {:11.2f} | {}'.format(
+                name, temperature, 1000. * elapsed / (args.generate_num - args.prompt_length),
+                decoder.stats.acceptance_rate, decoder.stats.tokens_per_pass,
+                '-' if temperature else check('speculative: {} same as greedy'.format(name), generated == reference)))
+
+    # the distribution of the first two tokens after the prompt: sampled with the independent draft
+    # against the exact one of the main model, next to the same number of draws from the exact one
+    sampler = Sampler(synthetic_vocab(args.vocab_size), temperature=1., penalty=args.penalty)
+    counts = sampler.new_counts([prompt])
+    logits = CachedPredictor(encoder, tied_embedding_softmax)(np.array([prompt]), len(prompt))
+    first = sampler.probabilities(sampler.process(logits, counts))[0]
+    # p(second | first) for every first token, in one batch
+    rows = np.hstack((np.tile(prompt, (args.vocab_size, 1)), np.arange(args.vocab_size)[:, np.newaxis]))
+    logits = CachedPredictor(encoder, tied_embedding_softmax)(rows, len(prompt) + 1)
+    second = np.stack([sampler.probabilities(sampler.process(logits[i:i + 1], counts.prefixes(0, [i]), [1]))[0]
+                       for i in range(args.vocab_size)])
+    joint = first[:, np.newaxis] * second
+    decoder = SpeculativeDecoder(encoder, tied_embedding_softmax, draft_encoder, draft_tied, sampler, 1, args.seed)
+    speculative = np.array([decoder.generate(prompt, len(prompt) + 2)[-2:] for _ in range(args.samples)])
+    rng = np.random.RandomState(args.seed)
+    exact = np.array([divmod(draw(joint.ravel(), rng), args.vocab_size) for _ in range(args.samples)])
+    print('{} samples of the first two tokens with the independent draft, k = 1 ({:.1%} of the drafts accepted)'.format(
+        args.samples, decoder.stats.acceptance_rate))
+    print('total variation from the exact distribution | speculative | exact samples')
+    for i, (name, probs) in enumerate([('first token', joint.sum(axis=1)), ('second token', joint.sum(axis=0))]):
+        print('{:43s} | {:11.3f} | {:13.3f}'.format(name, total_variation(speculative[:, i], probs),
+                                                   total_variation(exact[:, i], probs)))
+
+
+def sequence_score(encoder, tied_embedding_softmax, sampler, prompt, tokens):
+    # the summed log-probability of the tokens after `prompt`, as CandidateGenerator scores them
+    logits = CachedPredictor(encoder, tied_embedding_softmax)
+    counts = sampler.new_counts([prompt])
+    total = 0.
+    for length in range(len(prompt), len(tokens)):
+        total += log_probs(sampler, sampler.process(logits(np.array([tokens]), length), counts))[0, tokens[length]]
+        sampler.add(counts, [tokens[length]])
+    return total
+
+
+def bench_candidates(args):
+    _, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                          args.dff, args.vocab_size, args.seq_length)
+    vocab = synthetic_vocab(args.vocab_size)
+    prompt = np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+    decode_step = compile_decode_step(encoder, tied_embedding_softmax)
+    generator = CandidateGenerator(encoder, tied_embedding_softmax, decode_step)
+    sampler = Sampler(vocab, temperature=1., penalty=args.penalty)
+    greedy = Sampler(vocab, penalty=args.penalty)
+    new_tokens = args.generate_num - args.prompt_length
+    # traced for every shape once before timing
+    generator.sample(prompt, args.num_samples, args.prompt_length + 2, sampler)
+    generator.beam_search(prompt, args.beam_width, args.prompt_length + 2, greedy)
+    sample_cached(encoder, tied_embedding_softmax, sampler, prompt, args.prompt_length + 2, np.random.RandomState(0),
+                  decode_step)
+
+    rng = np.random.RandomState(args.seed)
+    _, one_time = timed(sample_cached, encoder, tied_embedding_softmax, sampler, prompt, args.generate_num, rng,
+                        decode_step)
+    _, separate_time = timed(lambda: [sample_cached(encoder, tied_embedding_softmax, sampler, prompt,
+                                                    args.generate_num, rng, decode_step)
+                                      for _ in range(args.num_samples)])
+    samples, samples_time = timed(generator.sample, prompt, args.num_samples, args.generate_num, sampler)
+    beams, beam_time = timed(generator.beam_search, prompt, args.beam_width, args.generate_num, greedy)
+    greedy_tokens = sample_cached(encoder, tied_embedding_softmax, greedy, prompt, args.generate_num, rng, decode_step)
+    width_one = generator.beam_search(prompt, 1, args.generate_num, greedy)[0]
+
+    print('{} prompt tokens, {} new tokens per candidate'.format(args.prompt_length, new_tokens))
+    print('decoding                         | ms     | x one generation')
+    for name, elapsed in [('one sample', one_time),
+                          ('{} samples, separate runs'.format(args.num_samples), separate_time),
+                          ('{} samples, shared prompt'.format(args.num_samples), samples_time),
+                          ('beam search, width {}'.format(args.beam_width), beam_time)]:
+        print('{:32s} | {:6.1f} | {:6.2f}'.format(name, 1000. * elapsed, elapsed / one_time))
+    # the scores that come with the candidates are the ones of the sequence scored on its own
+    rescored = [sequence_score(encoder, tied_embedding_softmax, scorer, prompt, tokens) / new_tokens
+                for scorer, (tokens, _) in [(sampler, samples[0]), (greedy, beams[0])]]
+    print('sample scores: {}'.format(' '.join('{:.3f}'.format(score) for _, score in samples)))
+    print('beam scores:   {}'.format(' '.join('{:.3f}'.format(score) for _, score in beams)))
+    print('greedy score:  {:.3f}'.format(sequence_score(encoder, tied_embedding_softmax, greedy, prompt,
+                                                        greedy_tokens) / new_tokens))
+    print('scores match a separate scoring pass: {}'.format(check(
+        'candidates: scores match a separate scoring pass',
+        np.allclose(rescored, [samples[0][1], beams[0][1]], atol=1e-4))))
+    print('distinct samples: {}, width 1 beam is greedy: {}'.format(
+        len(set(tuple(tokens) for tokens, _ in samples)),
+        check('candidates: width 1 beam is greedy', width_one[0] == greedy_tokens)))
@@ -0,0 +1,237 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+from CTRL.benchmark_common import build_tiny_model, check, drop_page_cache, greedy_cached, memory_status, \
+    reset_peak_rss, synthetic_vocab, timed
+from CTRL.sampler import Sampler
+from CTRL.shortlist import Shortlist, shortlist_ids
+from CTRL.weight_store import WeightStore, load_model_weights, model_weights, save_model_weights
+import CTRL.transformer
+import os
+import tempfile
+import time
+
+# benchmarks of the model itself: the attention layer, the positional encoding, the precisions,
+# the output projection and loading the weights (see benchmark.py)
+
+
+def bench_attention(args):
+    d_model_size, num_heads, length = args.layer_d_model_size, args.layer_num_heads, args.seq_length
+    attention = CTRL.transformer.MultiHeadAttention(d_model_size, num_heads)
+    fused = CTRL.transformer.MultiHeadAttention(d_model_size, num_heads)
+    x = tf.random.normal((1, length, d_model_size))
+    mask = tf.constant(np.triu(np.ones((length, length), dtype=np.float32), 1))
+    attention(x, x, x, mask)
+    fused(x, x, x, mask)
+    for a, b in zip(attention.trainable_weights, fused.trainable_weights):
+        b.assign(a)
+    fused.fuse_qkv()
+    bias = mask * -1e9
+
+    # the prompt: all positions at once; a decoding step: one position against `length` cached ones
+    past = (tf.random.normal((1, num_heads, length, d_model_size // num_heads)),
+            tf.random.normal((1, num_heads, length, d_model_size // num_heads)))
+    step = x[:, -1:]
+    step_mask = tf.zeros((1, length + 1))
+
+    cases = []
+    for name, layer, layer_mask, layer_step_mask in [('separate q/k/v', attention, mask, step_mask),
+                                                     ('fused, pre-scaled', fused, bias, step_mask)]:
+        prompt_fn = tf.function(lambda: layer(x, x, x, layer_mask))
+        step_fn = tf.function(lambda: layer(step, step, step, layer_step_mask, layer_past=past, use_cache=True))
+        prompt_out, step_out = prompt_fn(), step_fn()
+        runs = 20
+        _, prompt_time = timed(lambda: [prompt_fn().numpy() for _ in range(runs)])
+        _, step_time = timed(lambda: [step_fn()[0].numpy() for _ in range(5 * runs)])
+        cases.append((name, prompt_time / runs, step_time / (5 * runs), prompt_out, step_out[0]))
+
+    print('one attention layer, d_model {}, {} heads, {} positions'.format(d_model_size, num_heads, length))
+    print('layer             | prompt ms | step ms | same output')
+    for name, prompt_time, step_time, prompt_out, step_out in cases:
+        same = check('attention: {} same output'.format(name), np.allclose(prompt_out, cases[0][3], atol=1e-4) and
+                     np.allclose(step_out, cases[0][4], atol=1e-4))
+        print('{:17s} | {:9.2f} | {:7.3f} | {}'.format(name, 1000. * prompt_time, 1000. * step_time, same))
+
+    # and the whole model, fused after its weights are set
+    _, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                          args.dff, args.vocab_size, args.seq_length)
+    text = np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+    reference = greedy_cached(encoder, tied_embedding_softmax, text, args.generate_num)
+    encoder.fuse_qkv()
+    print('tiny model, same greedy output after fusing: {}'.format(check(
+        'attention: same greedy output after fusing',
+        greedy_cached(encoder, tied_embedding_softmax, text, args.generate_num) == reference)))
+
+
+def reference_positional_encoding(position, d_model_size):
+    # the table Encoder built before, for input_vocab_size positions
+    angle_rads = CTRL.transformer.angle_defn(np.arange(position)[:, np.newaxis], np.arange(d_model_size)[np.newaxis, :],
+                                             d_model_size)
+    sines = np.sin(angle_rads[:, 0::2])
+    cosines = np.cos(angle_rads[:, 1::2])
+    return tf.cast(np.concatenate([sines, cosines], axis=-1)[np.newaxis, ...], dtype=tf.float32)
+
+
+def bench_positions(args):
+    d_model_size = args.layer_d_model_size
+    runs = []
+    # the new tables first: RSS only shows growth
+    for name, fn in [('table, first encoder', lambda: CTRL.transformer.positional_encoding(512, d_model_size)),
+                     ('table, later encoders', lambda: CTRL.transformer.positional_encoding(512, d_model_size)),
+                     ('50000 positions (before)', lambda: reference_positional_encoding(50000, d_model_size))]:
+        before = memory_status()
+        reset_peak_rss()
+        table, elapsed = timed(fn)
+        after = memory_status()
+        runs.append((name, table, elapsed, after.get('VmHWM', 0.) - before.get('VmRSS', 0.),
+                     after.get('VmRSS', 0.) - before.get('VmRSS', 0.)))
+
+    same = check('positions: same values for the first 512 positions',
+                 np.array_equal(runs[0][1].numpy()[0], runs[2][1].numpy()[0, :512]))
+    print('positional encoding, d_model {}'.format(d_model_size))
+    print('build                    | ms      | peak RSS growth MB | kept MB | table MB')
+    for name, table, elapsed, peak, kept in runs:
+        print('{:24s} | {:7.1f} | {:18.1f} | {:7.1f} | {:8.1f}'.format(name, 1000. * elapsed, peak, kept,
+                                                                      int(np.prod(table.shape)) * 4 / 2. ** 20))
+    print('same values for the first 512 positions: {}'.format(same))
+
+
+def weight_bytes(*layers):
+    return sum(int(np.prod(variable.shape)) * variable.dtype.size for layer in layers for variable in layer.weights)
+
+
+def bench_precision(args):
+    # the same random weights at every precision, loaded from one weight file like generation.py does
+    _, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                          args.dff, args.vocab_size, args.seq_length)
+    path = tempfile.mktemp(suffix='.ctrlwts')
+    save_model_weights(path, tied_embedding_softmax, encoder)
+    # teacher-forced: every position of these sequences is scored at once
+    tokens = tf.constant(np.random.randint(0, args.vocab_size, size=(4, args.seq_length)), dtype=tf.int32)
+    text = np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+
+    runs = []
+    try:
+        for precision in CTRL.transformer.PRECISIONS:
+            _, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                                  args.dff, args.vocab_size, args.seq_length)
+            store = WeightStore(path)
+            load_model_weights(store, tied_embedding_softmax, encoder)
+            store.close()
+            encoder.fuse_qkv()
+            encoder.set_precision(precision)
+            tied_embedding_softmax.set_precision(precision)
+            forward = tf.function(lambda tokens: tied_embedding_softmax(
+                encoder(tied_embedding_softmax(tokens, embed=True), training=False), embed=False))
+            logits = forward(tokens).numpy()
+            greedy_cached(encoder, tied_embedding_softmax, text, len(text) + 2)
+            generated, elapsed = timed(greedy_cached, encoder, tied_embedding_softmax, text, args.generate_num)
+            runs.append((precision, weight_bytes(encoder, tied_embedding_softmax), logits, generated,
+                         elapsed / (args.generate_num - len(text))))
+    finally:
+        os.remove(path)
+
+    reference = runs[0][2]
+    print('{} layers, d_model {}, dff {}, vocabulary {}; logits of {} positions'.format(
+        args.num_layers, args.d_model_size, args.dff, args.vocab_size, reference.shape[0] * reference.shape[1]))
+    print('precision | weights MB | max logit error | same argmax | same greedy text | ms/token')
+    for precision, nbytes, logits, generated, per_token in runs:
+        error = np.abs(logits - reference).max()
+        same_argmax = np.mean(np.argmax(logits, -1) == np.argmax(reference, -1))
+        print('{:9s} | {:10.1f} | {:15.5f} | {:10.2f}% | {:16s} | {:8.2f}'.format(
+            precision, nbytes / 2. ** 20, error, 100. * same_argmax, str(generated == runs[0][3]), 1000. * per_token))
+
+
+def bench_projection(args):
+    # the output projection of one decoding step at the real model width
+    vocab_size, d_model_size, length = args.projection_vocab_size, args.layer_d_model_size, args.seq_length
+    tied_embedding_softmax = CTRL.transformer.TiedEmbeddingSoftmax(vocab_size, d_model_size)
+    hidden = tf.random.normal((1, length, d_model_size))
+    sampler = Sampler(synthetic_vocab(vocab_size))
+    shortlist = Shortlist(tied_embedding_softmax, shortlist_ids(sampler, np.arange(args.shortlist_size),
+                                                                drop_disallowed=True), vocab_size)
+
+    full = tf.function(lambda hidden: tied_embedding_softmax(hidden, embed=False))
+    last = tf.function(lambda hidden: tied_embedding_softmax(hidden[:, -1], embed=False))
+    short = tf.function(lambda hidden: shortlist.projection(hidden[:, -1], embed=False))
+    runs = []
+    for name, fn, rows, columns in [('every position (before)', full, length, vocab_size),
+                                    ('last position', last, 1, vocab_size),
+                                    ('last position, shortlist', short, 1, len(shortlist))]:
+        logits = fn(hidden).numpy()
+        repeats = 3 if rows > 1 else 20
+        _, elapsed = timed(lambda: [fn(hidden).numpy() for _ in range(repeats)])
+        runs.append((name, logits, 2. * rows * columns * d_model_size, logits.nbytes, elapsed / repeats))
+
+    reference = runs[0][1][0, -1]
+    same_last = check('projection: same logits at the last position', np.allclose(runs[1][1][0], reference, atol=1e-4))
+    same_short = check('projection: same logits on the shortlist',
+                       np.allclose(runs[2][1][0], reference[shortlist.ids], atol=1e-4))
+    expanded = shortlist.expand(runs[2][1])[0]
+    print('vocabulary {}, d_model {}, {} positions; shortlist of {} tokens'.format(vocab_size, d_model_size, length,
+                                                                                 len(shortlist)))
+    print('projection               | GFLOP  | logits MB | ms     | same logits')
+    for (name, logits, flops, nbytes, elapsed), same in zip(runs, ['-', str(same_last), str(same_short)]):
+        print('{:24s} | {:6.3f} | {:9.2f} | {:6.2f} | {}'.format(name, flops / 1e9, nbytes / 2. ** 20,
+                                                                1000. * elapsed, same))
+    print('greedy pick from the expanded shortlist matches the full vocabulary when the best token is a '
+          'candidate: {}'.format(check('projection: greedy pick from the expanded shortlist',
+                                       np.argmax(expanded) == np.argmax(reference) or
+                                       np.argmax(reference) not in set(shortlist.ids))))
+
+
+def load_from_checkpoint(prefix, variables):
+    # the loading path of generation.py: read every tensor, cast it and assign it
+    reader = tf.train.load_checkpoint(prefix)
+    for i, variable in enumerate(variables):
+        variable.assign(tf.cast(reader.get_tensor('v{}/.ATTRIBUTES/VARIABLE_VALUE'.format(i)), variable.dtype))
+
+
+def bench_weight_store(args):
+    _, source_encoder, source_tied = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                      args.dff, args.vocab_size, args.seq_length)
+    source = model_weights(source_tied, source_encoder)
+    directory = tempfile.mkdtemp()
+    store_path = os.path.join(directory, 'ctrl.weights')
+    save_model_weights(store_path, source_tied, source_encoder)
+    prefix = tf.train.Checkpoint(**dict(('v{}'.format(i), variable) for i, variable in enumerate(source))).write(
+        os.path.join(directory, 'ctrl'))
+    size = sum(int(np.prod(variable.shape)) * variable.dtype.size for variable in source) / 2. ** 20
+
+    prompt = np.random.randint(0, args.vocab_size, size=(1, args.prompt_length))
+    expected = greedy_cached(source_encoder, source_tied, prompt[0].tolist(), 1)
+
+    results = []
+    # the mapped store first: peak RSS only grows, so a lower peak after a higher one could not be seen
+    for mode in ['weight store', 'checkpoint']:
+        model, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size,
+                                                                  args.num_heads, args.dff, args.vocab_size,
+                                                                  args.seq_length)
+        variables = model_weights(tied_embedding_softmax, encoder)
+        drop_page_cache(store_path)
+        for name in os.listdir(directory):
+            drop_page_cache(os.path.join(directory, name))
+        before = memory_status()
+        reset_peak_rss()
+        start = time.time()
+        if mode == 'weight store':
+            store = WeightStore(store_path)
+            load_model_weights(store, tied_embedding_softmax, encoder)
+        else:
+            load_from_checkpoint(prefix, variables)
+        elapsed = time.time() - start
+        after = memory_status()
+        same = check('weight_store: {} loads the same weights'.format(mode),
+                     all(np.array_equal(a.numpy(), b.numpy()) for a, b in zip(source, variables)) and
+                     greedy_cached(encoder, tied_embedding_softmax, prompt[0].tolist(), 1) == expected)
+        results.append((mode, elapsed, after.get('VmHWM', 0.) - before.get('VmRSS', 0.),
+                        after.get('RssAnon', 0.) - before.get('RssAnon', 0.), same))
+        if mode == 'weight store':
+            store.close()
+
+    print('{} tensors, {:.1f} MB of weights'.format(len(source), size))
+    print('mode         | load ms | peak RSS growth MB | private RSS growth MB | same weights')
+    for mode, elapsed, peak, private, same in results:
+        print('{:12s} | {:7.1f} | {:18.1f} | {:21.1f} | {}'.format(mode, 1000. * elapsed, peak, private, same))
@@ -0,0 +1,122 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+from CTRL.benchmark_common import check, synthetic_vocab, timed
+from CTRL.sampler import Sampler
+from CTRL.tokenizer import Detokenizer
+import re
+import time
+
+# benchmarks of what happens to the logits of a step: the sampler, and turning the tokens back into text
+# (see benchmark.py)
+
+
+def reference_select(prompt_logits, generated, idx2word, word2idx, temperature, nucleusprob, topk, penalty):
+    # the per-token post-logits code generation() had before CTRL.sampler, kept as the baseline
+    prompt_logits = prompt_logits / (temperature if temperature > 0 else 1.)
+    if penalty > 0:
+        penalized_so_far = set()
+        for generated_token in generated:
+            if idx2word[generated_token] == '\n':
+                continue
+            if generated_token in penalized_so_far:
+                continue
+            penalized_so_far.add(generated_token)
+            prompt_logits[generated_token] /= penalty
+    prompt_logits[word2idx['<unk>']] = -1e8
+    prompt_logits[word2idx['Sco@@']] = -1e8
+    prompt_probs = np.exp(prompt_logits)
+    prompt_probs = prompt_probs / sum(prompt_probs)
+    pruned_list = np.argsort(prompt_probs)[::-1]
+    if nucleusprob > 0.:
+        nucleus = max(np.where(np.cumsum(np.sort(prompt_probs)[::-1]) > nucleusprob)[0][0], 1)
+    elif topk > 0:
+        nucleus = topk
+    else:
+        nucleus = len(pruned_list)
+    pruned_list = pruned_list[:nucleus]
+    tokens_to_disallow = []
+    for _ in range(len(pruned_list)):
+        if 'http' in idx2word[pruned_list[_]]:
+            tokens_to_disallow.append(_)
+    pruned_list = np.delete(pruned_list, tokens_to_disallow)
+    if temperature == 0:
+        return pruned_list[0]
+    chosen_idx = tf.random.categorical(np.expand_dims(prompt_logits[pruned_list], 0), num_samples=1).numpy()[0, 0]
+    return pruned_list[chosen_idx]
+
+
+def bench_sampler(args):
+    idx2word = synthetic_vocab(args.sampler_vocab_size)
+    word2idx = {u: i for i, u in enumerate(idx2word)}
+    # peaked logits like a real model's, so that the nucleus stays small
+    logits = [np.random.normal(size=len(idx2word)).astype(np.float32) * 2 for _ in range(args.sampler_steps)]
+    for step_logits in logits:
+        step_logits[np.random.randint(0, len(idx2word), size=200)] += np.random.uniform(5, 15, size=200)
+    logits[0][7] = logits[0].max() + .01  # a disallowed token on top
+    generated = np.random.randint(0, len(idx2word), size=args.generate_num).tolist()
+
+    # the sampler's own work (process + candidates) is timed apart from the whole step: for a fixed seed
+    # the draw is the same tf.random.categorical call as the reference's, and costs about as much as it does there
+    print('setting                      | reference ms/step | sampler us/step | without draw us | same tokens')
+    for temperature, nucleus, topk in [(0., 0., 0), (0.7, 0., 40), (0.7, 0.9, 0), (0.7, 0., 0)]:
+        sampler = Sampler(idx2word, temperature=temperature, nucleus=nucleus, topk=topk, penalty=args.penalty)
+        counts = sampler.new_counts([generated])
+
+        # both work on their own copy of the logits, made before the timing
+        reference_logits = [step_logits.copy() for step_logits in logits]
+        tf.random.set_random_seed(args.seed)
+        start = time.time()
+        reference = [reference_select(step_logits, generated, idx2word, word2idx, temperature, nucleus, topk,
+                                      args.penalty) for step_logits in reference_logits]
+        reference_time = (time.time() - start) / len(logits)
+
+        sampler_logits = [step_logits[np.newaxis].copy() for step_logits in logits]
+        tf.random.set_random_seed(args.seed)
+        start = time.time()
+        vectorized = [sampler(step_logits, counts)[0] for step_logits in sampler_logits]
+        sampler_time = (time.time() - start) / len(logits)
+
+        sampler_logits = [step_logits[np.newaxis].copy() for step_logits in logits]
+        start = time.time()
+        for step_logits in sampler_logits:
+            processed = sampler.process(step_logits, counts)
+            if temperature > 0:
+                sampler.candidates(processed)
+        prepare_time = (time.time() - start) / len(logits)
+
+        setting = 'temp={} nucleus={} topk={}'.format(temperature, nucleus, topk)
+        print('{:28s} | {:17.2f} | {:15.1f} | {:15.1f} | {}'.format(
+            setting, 1000. * reference_time, 1e6 * sampler_time, 1e6 * prepare_time,
+            check('sampler: {} same tokens'.format(setting), reference == vectorized)))
+
+
+def bench_detokenize(args):
+    # a vocabulary with continuation pieces, as in the BPE vocabulary
+    idx2word = synthetic_vocab(args.sampler_vocab_size)
+    idx2word[::3] = [word + '@@' for word in idx2word[::3]]
+    print('text so far after every token')
+    print('tokens | rebuilt ms | streamed ms | speedup | same text')
+    for length in [256, 1024, 4096]:
+        tokens = np.random.randint(0, len(idx2word), size=length)
+
+        def rebuilt():
+            # what generation() did every step
+            for token in range(1, length + 1):
+                text = ' '.join([idx2word[c] for c in tokens[:token]])
+                text = re.sub('(@@ )', '', string=text)
+                text = re.sub('(@@ ?$)', '', string=text)
+            return text
+
+        def streamed():
+            detokenizer = Detokenizer(idx2word)
+            return ''.join([detokenizer.add(token) for token in tokens])
+
+        reference, rebuilt_time = timed(rebuilt)
+        text, streamed_time = timed(streamed)
+        same = check('detokenize: {} tokens same text'.format(length), text == reference)
+        print('{:6d} | {:10.1f} | {:11.2f} | {:6.0f}x | {}'.format(length, 1000. * rebuilt_time,
+                                                                  1000. * streamed_time,
+                                                                  rebuilt_time / streamed_time, same))
@@ -0,0 +1,196 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+from CTRL.attribution import DomainScorer, NextTokenLogProbs, rank_domains
+from CTRL.benchmark_common import build_tiny_model, check, synthetic_vocab, timed
+from CTRL.control_codes import CONTROL_CODES
+from CTRL.decoding import CachedPredictor, compile_decode_step
+from CTRL.profiling import profiler
+from CTRL.sampler import Sampler
+from CTRL.server import Client, InferenceServer, tiny_service
+from CTRL.tokenizer import Detokenizer
+import json
+import os
+import tempfile
+import threading
+import time
+
+# benchmarks of serving: source attribution, the HTTP server and the profiler (see benchmark.py)
+
+
+def reference_attribution(model, texts, seq_length):
+    # the loop source_atttribution.py had before CTRL.attribution, kept as the baseline:
+    # one forward pass on a tiled batch of 2 per domain, then a python loop over the positions
+    ppls = []
+    for text in texts:
+        padding_text = text + [0] * (seq_length - len(text))
+        tokens_generated = np.tile(padding_text, (2, 1))
+        token_scores = np.asarray(model.predict_on_batch(tokens_generated))[0][:-1]
+        xent = 0
+        for sequence_idx, token_idx in enumerate(text[1:]):
+            Z = np.exp(token_scores[sequence_idx]).sum()
+            token_prob = np.exp(token_scores[sequence_idx, token_idx]) / Z
+            xent -= np.log(token_prob) / len(text[1:])
+        ppls.append(round(np.exp(xent), 6))
+    return ppls
+
+
+def bench_attribution(args):
+    model, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                              args.dff, args.vocab_size, args.seq_length)
+    tokens = model.inputs[0]
+    score_model = tf.keras.Model(inputs=tokens, outputs=NextTokenLogProbs()([model.outputs[0], tokens]))
+    # the same layers behind an input of any width, for the trimmed scoring
+    tokens = tf.keras.layers.Input(shape=(None,), dtype='int32')
+    logits = tied_embedding_softmax(encoder(tied_embedding_softmax(tokens, embed=True), training=False), embed=False)
+    trimmed_model = tf.keras.Model(inputs=tokens, outputs=NextTokenLogProbs()([logits, tokens]))
+
+    # one made-up tag of one or two tokens per control code, in front of the same prompt
+    domains = [(domain, 1.) for domain in sorted(CONTROL_CODES)]
+    domain_texts = [[i % args.vocab_size] + [(i + 1) % args.vocab_size] * (i % 2) for i in range(len(domains))]
+    prompt = np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+    texts = [domain_text + prompt for domain_text in domain_texts]
+    domain_scorer = DomainScorer(domains, domain_texts, args.seq_length)
+
+    reference_attribution(model, texts[:2], args.seq_length)
+    rank_domains(score_model.predict_on_batch, domains, texts, args.seq_length, args.attribution_batch_size)
+    domain_scorer.rank(trimmed_model.predict_on_batch, prompt, args.attribution_batch_size, True)
+
+    reference, reference_time = timed(reference_attribution, model, texts, args.seq_length)
+    ranked, ranked_time = timed(rank_domains, score_model.predict_on_batch, domains, texts, args.seq_length,
+                                args.attribution_batch_size)
+    trimmed, trimmed_time = timed(domain_scorer.rank, trimmed_model.predict_on_batch, prompt,
+                                  args.attribution_batch_size, True)
+    _, suffix_time = timed(domain_scorer.rank, trimmed_model.predict_on_batch, prompt, args.attribution_batch_size)
+
+    def same(mode, ranked):
+        ppls = dict((domain, ppl) for domain, ppl, _ in ranked)
+        return check('attribution: {} same perplexities'.format(mode),
+                     np.allclose([ppls[domain] for domain, _ in domains], reference, rtol=1e-3))
+
+    print('{} domains, {} token prompt, window {}'.format(len(domains), args.prompt_length, args.seq_length))
+    print('mode                     | ms/prompt | speedup | same perplexities')
+    for mode, mode_time, mode_ranked in [('per-domain loop', reference_time, None),
+                                         ('batched, full window', ranked_time, ranked),
+                                         ('batched, trimmed', trimmed_time, trimmed),
+                                         ('trimmed, prompt only', suffix_time, None)]:
+        print('{:24s} | {:9.1f} | {:6.1f}x | {}'.format(mode, 1000. * mode_time, reference_time / mode_time,
+                                                      '-' if mode_ranked is None else same(mode, mode_ranked)))
+
+
+def bench_serve(args):
+    # concurrent local clients against the server over a unix socket, one request at a time each
+    service = tiny_service(args.num_layers, args.d_model_size, args.num_heads, args.dff, args.vocab_size,
+                           args.seq_length, args.generate_num, args.seed)
+    prompts = [[np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+                for _ in range(args.requests)] for _ in range(args.clients)]
+    socket_path = tempfile.mktemp(suffix='.sock')
+    runs = []
+    for name, max_batch_size in [('one request at a time', 1), ('dynamic batching', args.clients)]:
+        server = InferenceServer(service, max_batch_size, args.max_delay_ms / 1000.)
+        address = server.start_in_thread(unix_socket=socket_path)
+        Client(address).generate(tokens=prompts[0][0])
+        results = [[] for _ in range(args.clients)]
+
+        def client(i):
+            connection = Client(address)
+            for prompt in prompts[i]:
+                results[i].append(connection.generate(tokens=prompt))
+            connection.close()
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        stats = Client(address).stats()['generate']
+        server.stop()
+        os.remove(socket_path)
+        runs.append((name, elapsed, results, stats))
+
+    same = check('serve: same generations with and without batching',
+                 all(a['tokens'] == b['tokens'] for i in range(args.clients)
+                     for a, b in zip(runs[0][2][i], runs[1][2][i])))
+    print('{} clients x {} requests of {} tokens, batching budget {} ms'.format(
+        args.clients, args.requests, args.generate_num, args.max_delay_ms))
+    print('server                | requests/s | mean batch | p50 ms  | p95 ms  | p99 ms')
+    for name, elapsed, results, stats in runs:
+        print('{:21s} | {:10.2f} | {:10.2f} | {:7.1f} | {:7.1f} | {:7.1f}'.format(
+            name, args.clients * args.requests / elapsed, stats['mean_batch_size'], stats['p50_ms'],
+            stats['p95_ms'], stats['p99_ms']))
+    print('same generations: {}'.format(same))
+
+
+def profiled_generation(encoder, tied_embedding_softmax, sampler, detokenizer, prompt, generate_num, decode_step):
+    # the decoding loop of generate_stream, with its stages
+    cached_predictor = CachedPredictor(encoder, tied_embedding_softmax, decode_step)
+    generated = list(prompt)
+    counts = sampler.new_counts([generated])
+    detokenizer.reset()
+    with profiler.stage('generate'):
+        while len(generated) < generate_num:
+            with profiler.stage('forward'):
+                logits = cached_predictor(np.array([generated]), len(generated))
+            token = int(sampler.select(sampler.process(logits, counts))[0])
+            sampler.add(counts, [token])
+            generated.append(token)
+            profiler.count('tokens')
+            with profiler.stage('detokenize'):
+                detokenizer.add(token)
+    return generated
+
+
+def bench_profile(args):
+    _, encoder, tied_embedding_softmax = build_tiny_model(args.num_layers, args.d_model_size, args.num_heads,
+                                                          args.dff, args.vocab_size, args.seq_length)
+    vocab = synthetic_vocab(args.vocab_size)
+    sampler = Sampler(vocab, temperature=1., topk=40, penalty=args.penalty)
+    detokenizer = Detokenizer(vocab)
+    prompt = np.random.randint(0, args.vocab_size, size=args.prompt_length).tolist()
+    decode_step = compile_decode_step(encoder, tied_embedding_softmax)
+    new_tokens = args.generate_num - args.prompt_length
+
+    runs = []
+    for name, enabled, step in [('profiler off', False, decode_step), ('profiler on', True, decode_step),
+                                ('profiler on, eager layers', True, decode_step.python_function)]:
+        profiler.disable()
+        profiled_generation(encoder, tied_embedding_softmax, sampler, detokenizer, prompt, args.generate_num, step)
+        if enabled:
+            profiler.enable()
+        _, elapsed = timed(profiled_generation, encoder, tied_embedding_softmax, sampler, detokenizer, prompt,
+                           args.generate_num, step)
+        runs.append((name, elapsed, profiler.report() if enabled else None))
+    trace_path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+    events = profiler.write_chrome_trace(trace_path)
+    with open(trace_path) as f:
+        loaded = len(json.load(f)['traceEvents'])
+    profiler.disable()
+
+    # what an instrumented stage costs while the profiler is off
+    calls = 1000000
+
+    def empty_loop():
+        for _ in range(calls):
+            pass
+
+    def stage_loop():
+        for _ in range(calls):
+            with profiler.stage('forward'):
+                pass
+
+    _, empty_time = timed(empty_loop)
+    _, stage_time = timed(stage_loop)
+
+    print('{} layers x {}, {} new tokens'.format(args.num_layers, args.d_model_size, new_tokens))
+    print('run                        | ms/token')
+    for name, elapsed, _ in runs:
+        print('{:26s} | {:8.3f}'.format(name, 1000. * elapsed / new_tokens))
+    print('a stage with the profiler off: {:.0f} ns per call'.format(1e9 * (stage_time - empty_time) / calls))
+    print('stages with the profiler on, eager layers:')
+    print(runs[-1][2])
+    print('chrome trace: {} events written, {} read back from {}'.format(events, loaded, trace_path))
+    check('profile: every trace event read back', loaded == events)
@@ -0,0 +1,421 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+tf.enable_eager_execution()
+import CTRL.transformer
+from CTRL.attribution import DomainScorer, NextTokenLogProbs
+from CTRL.control_codes import CONTROL_CODES
+from CTRL.decoding import BatchGenerator, compile_decode_step
+from CTRL.numpy_model import write_serving_weights
+from CTRL.sampler import Sampler
+from CTRL.tokenizer import CONTINUATION, Tokenizer
+from CTRL.worker_pool import WorkerPool
+from depeng.extract_keywords_from_email import KeywordExtractor, get_stop_words
+from depeng.read_email import get_email_body_from_directory
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+
+# a reproducible benchmark suite: random-weight models at a few scaled-down sizes, a synthetic BPE vocabulary
+# and generated e-mails, so nothing needs the real checkpoint, vocab or corpus.
+# it measures forward latency by sequence length, decoding tokens/s by batch size, attribution latency
+# by number of control codes, tokenization, and e-mail parsing / keyword throughput, and writes every
+# result as json; with --compare the results are checked against an earlier run.
+#
+#   python -m CTRL.benchmark_suite --out baseline.json
+#   python -m CTRL.benchmark_suite --out current.json --compare baseline.json
+#
+# every result has the measured `value` of its `metric` (the median over --repeats runs for latencies)
+# and whether higher is better; the other fields (benchmark, size, seq_length, ...) identify it.
+#
+# --benchmarks pool (not run by default, it starts worker processes) decodes on a WorkerPool of every one of
+# --pool_workers, for the aggregate tokens/s and the memory of all the workers together; it stops the run
+# if the workers decode differently from the model they were written from.
+
+SUITE_VERSION = 1
+
+# the model sizes; the vocabulary is synthetic, with vocab_size pieces
+SIZES = {
+    'tiny': {'num_layers': 2, 'd_model_size': 64, 'num_heads': 4, 'dff': 256, 'vocab_size': 2000},
+    'small': {'num_layers': 4, 'd_model_size': 128, 'num_heads': 4, 'dff': 512, 'vocab_size': 8000},
+    'medium': {'num_layers': 8, 'd_model_size': 256, 'num_heads': 8, 'dff': 1024, 'vocab_size': 32000},
+}
+
+parser = argparse.ArgumentParser(description='reproducible benchmarks of CTRL and depeng on synthetic models and data')
+parser.add_argument('--out', type=str, default='benchmark_results.json',
+                    help='json file the results are written to')
+parser.add_argument('--compare', type=str, default=None,
+                    help='results of an earlier run; exits with 1 if anything got slower by more than --tolerance')
+parser.add_argument('--tolerance', type=float, default=0.2,
+                    help='relative slowdown that counts as a regression')
+parser.add_argument('--sizes', type=str, default='tiny,small',
+                    help='comma separated model sizes, of {}'.format(', '.join(sorted(SIZES))))
+parser.add_argument('--benchmarks', type=str, default='forward,decode,attribution,tokenize,email',
+                    help='comma separated benchmarks to run')
+parser.add_argument('--seq_lengths', type=str, default='16,64,128,256',
+                    help='sequence lengths of the forward benchmark')
+parser.add_argument('--batch_sizes', type=str, default='1,4,16',
+                    help='batch sizes of the decode benchmark')
+parser.add_argument('--domain_counts', type=str, default='4,16,{}'.format(len(CONTROL_CODES)),
+                    help='numbers of control codes of the attribution benchmark')
+parser.add_argument('--pool_workers', type=str, default='1,2,4',
+                    help='worker processes of the pool benchmark')
+parser.add_argument('--prompt_length', type=int, default=16,
+                    help='prompt tokens of the decode benchmark')
+parser.add_argument('--new_tokens', type=int, default=32,
+                    help='tokens decoded per row in the decode benchmark')
+parser.add_argument('--emails', type=int, default=500,
+                    help='generated e-mails of the e-mail benchmark')
+parser.add_argument('--repeats', type=int, default=5,
+                    help='timed runs of every measurement, after one untimed run')
+parser.add_argument('--seed', type=int, default=1337,
+                    help='random seed for the weights and the synthetic data')
+parser.add_argument('--stop_file', type=str, default='depeng/resources/stopwords.txt',
+                    help='stop words for keyword extraction')
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def synthetic_words(count, rng):
+    # made-up lowercase words of 3 to 10 letters
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(list(LETTERS), size=rng.randint(3, 11))))
+    return sorted(words)
+
+
+def zipf_choice(words, size, rng):
+    # words drawn with a long tail, like the words of real text
+    return [words[min(int(i), len(words)) - 1] for i in rng.zipf(1.3, size=size)]
+
+
+class SyntheticBPE(object):
+    # a stand-in for fastBPE over a synthetic vocabulary: whole words that are pieces stay whole,
+    # everything else is split greedily into the longest pieces of the vocabulary, `@@` on all but the last
+
+    def __init__(self, pieces):
+        self.words = set(piece for piece in pieces if not piece.endswith(CONTINUATION))
+        self.prefixes = set(piece[:-len(CONTINUATION)] for piece in pieces if piece.endswith(CONTINUATION))
+        self.longest = max(len(piece) for piece in self.prefixes | self.words)
+
+    def split(self, word):
+        if word in self.words:
+            return [word]
+        pieces = []
+        while word:
+            for length in range(min(self.longest, len(word)), 0, -1):
+                piece = word[:length]
+                if length == len(word) and piece in self.words:
+                    return pieces + [piece]
+                if length < len(word) and piece in self.prefixes:
+                    pieces.append(piece + CONTINUATION)
+                    word = word[length:]
+                    break
+            else:
+                # not even the letter is a piece: fastBPE passes it through and it becomes <unk>
+                return pieces + [word]
+        return pieces
+
+    def apply(self, texts):
+        return [' '.join(piece for word in text.split() for piece in self.split(word)) for text in texts]
+
+
+def synthetic_vocab(vocab_size, rng):
+    # the pieces of a vocab file: the control codes, every letter with and without `@@`,
+    # a few pieces the sampler treats specially, and random 2 to 4 letter pieces up to vocab_size - 2
+    # (the tokenizer adds <unk> and the newline)
+    pieces = sorted(CONTROL_CODES) + list(LETTERS) + [letter + CONTINUATION for letter in LETTERS] + \
+        ['Sco@@', 'http', 'http@@']
+    seen = set(pieces)
+    while len(pieces) < vocab_size - 2:
+        piece = ''.join(rng.choice(list(LETTERS), size=rng.randint(2, 5)))
+        if rng.rand() < 0.6:
+            piece += CONTINUATION
+        if piece not in seen:
+            seen.add(piece)
+            pieces.append(piece)
+    return pieces
+
+
+def write_vocab(path, pieces):
+    # in the format of fastBPE vocab files, a piece and a count per line
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join('{} {}'.format(piece, len(pieces) - i) for i, piece in enumerate(pieces)))
+
+
+def write_emails(directory, count, words, rng):
+    # e-mails like the spam corpus: multipart with a text/plain part, or a single text/html part
+    for i in range(count):
+        message = EmailMessage()
+        message['From'] = 'sender{}@example.com'.format(i)
+        message['To'] = 'someone@example.com'
+        message['Subject'] = ' '.join(zipf_choice(words, 6, rng))
+        text = ' '.join(zipf_choice(words, rng.randint(50, 300), rng))
+        if i % 2 == 0:
+            message.set_content(text + '\nhttp://example.com/{}\n'.format(i))
+            message.add_alternative('<html><body><p>{}</p></body></html>'.format(text), subtype='html')
+        else:
+            message.set_content('<html><body><p>{}</p><a href="http://example.com">link</a></body></html>'.format(
+                text), subtype='html')
+        with open(os.path.join(directory, "b'{}'.eml".format(i)), 'wb') as f:
+            f.write(bytes(message))
+
+
+def measure(fn, repeats):
+    # the seconds of every timed run of fn, after an untimed one (tracing, caches)
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def latency(times, **fields):
+    return dict(fields, metric='median_ms', value=1000. * float(np.median(times)), higher_is_better=False,
+                min_ms=1000. * min(times), runs=len(times))
+
+
+def throughput(times, items, metric, **fields):
+    # items per second of the median run
+    return dict(fields, metric=metric, value=items / float(np.median(times)), higher_is_better=True,
+                median_ms=1000. * float(np.median(times)), runs=len(times))
+
+
+class SyntheticModel(object):
+    # a random-weight CTRL model of one of SIZES and its synthetic vocabulary and tokenizer
+
+    def __init__(self, size, directory, seed):
+        self.size = size
+        config = SIZES[size]
+        rng = np.random.RandomState(seed)
+        tf.random.set_random_seed(seed)
+        self.pieces = synthetic_vocab(config['vocab_size'], rng)
+        self.vocab_path = os.path.join(directory, 'vocab.{}'.format(size))
+        write_vocab(self.vocab_path, self.pieces)
+        self.tokenizer = Tokenizer(vocab_path=self.vocab_path, bpe=SyntheticBPE(self.pieces))
+        self.words = synthetic_words(2000, rng)
+        self.seed = seed
+
+        self.tied_embedding_softmax = CTRL.transformer.TiedEmbeddingSoftmax(len(self.tokenizer),
+                                                                            config['d_model_size'])
+        self.encoder = CTRL.transformer.Encoder(num_layers=config['num_layers'], d_model_size=config['d_model_size'],
+                                                num_heads=config['num_heads'], dff=config['dff'], max_position=512)
+        tokens = tf.keras.layers.Input(shape=(None,), dtype='int32')
+        logits = self.tied_embedding_softmax(self.encoder(self.tied_embedding_softmax(tokens, embed=True),
+                                                          training=False), embed=False)
+        # the full-window pass of generation.py, and the next-token log-probabilities of attribution
+        self.forward = tf.function(tf.keras.Model(inputs=tokens, outputs=logits),
+                                   input_signature=[tf.TensorSpec((None, None), tf.int32)])
+        self.score_model = tf.keras.Model(inputs=tokens, outputs=NextTokenLogProbs()([logits, tokens]))
+        self.encoder.fuse_qkv()
+        self.decode_step = compile_decode_step(self.encoder, self.tied_embedding_softmax)
+
+    def rng(self):
+        # every benchmark draws its data from a fresh generator, so it gets the same data whatever else runs
+        return np.random.RandomState(self.seed)
+
+    def text(self, words, rng):
+        return ' '.join(zipf_choice(self.words, words, rng))
+
+
+def bench_forward(model, args):
+    results = []
+    rng = model.rng()
+    for seq_length in [int(n) for n in args.seq_lengths.split(',')]:
+        tokens = tf.constant(rng.randint(0, len(model.tokenizer), size=(1, seq_length)), dtype=tf.int32)
+        times = measure(lambda: model.forward(tokens).numpy(), args.repeats)
+        results.append(latency(times, benchmark='forward', size=model.size, seq_length=seq_length))
+    return results
+
+
+def bench_decode(model, args):
+    results = []
+    generator = BatchGenerator(model.encoder, model.tied_embedding_softmax, model.decode_step)
+    sampler = Sampler(model.tokenizer.idx2word)
+    rng = model.rng()
+    for batch_size in [int(n) for n in args.batch_sizes.split(',')]:
+        prompts = [rng.randint(0, len(model.tokenizer), size=args.prompt_length).tolist()
+                   for _ in range(batch_size)]
+        max_length = args.prompt_length + args.new_tokens
+        times = measure(lambda: generator.generate(prompts, max_length, sampler.for_batch(prompts)), args.repeats)
+        results.append(throughput(times, batch_size * args.new_tokens, 'tokens_per_s', benchmark='decode',
+                                  size=model.size, batch_size=batch_size, prompt_length=args.prompt_length,
+                                  new_tokens=args.new_tokens))
+    return results
+
+
+def bench_pool(model, args, directory):
+    # decoding of batches of 4 prompts, 2 batches per worker, on pools of a serving weight file of the model
+    results = []
+    path = os.path.join(directory, 'serving.{}'.format(model.size))
+    write_serving_weights(path, model.encoder, model.tied_embedding_softmax)
+    rng = model.rng()
+    max_length = args.prompt_length + args.new_tokens
+    generator = BatchGenerator(model.encoder, model.tied_embedding_softmax, model.decode_step)
+    sampler = Sampler(model.tokenizer.idx2word)
+    for workers in [int(n) for n in args.pool_workers.split(',')]:
+        prompts = [rng.randint(0, len(model.tokenizer), size=args.prompt_length).tolist() for _ in range(8 * workers)]
+        expected = generator.generate(prompts, max_length, sampler.for_batch(prompts))
+        pool = WorkerPool(path, workers, num_heads=SIZES[model.size]['num_heads'], vocab=model.vocab_path,
+                          max_batch_size=4).start()
+        try:
+            # greedy on both sides: the workers have to decode what the model does, or their speed means nothing
+            if [tokens for tokens, _ in pool.generate(prompts, max_length)] != expected:
+                raise RuntimeError('the {} model decodes differently on a pool of {}'.format(model.size, workers))
+            times = measure(lambda: pool.generate(prompts, max_length), args.repeats)
+            memory = pool.summary()['total']
+        finally:
+            pool.close()
+        results.append(throughput(times, len(prompts) * args.new_tokens, 'tokens_per_s', benchmark='pool',
+                                  size=model.size, workers=workers, prompt_length=args.prompt_length,
+                                  new_tokens=args.new_tokens, pss_mb=memory['pss_mb']))
+    return results
+
+
+def bench_attribution(model, args):
+    results = []
+    codes = sorted(CONTROL_CODES)
+    prompt = model.tokenizer.encode(model.text(12, model.rng()))
+    for count in [int(n) for n in args.domain_counts.split(',')]:
+        domains = [(code, 1.) for code in codes[:count]]
+        scorer = DomainScorer(domains, model.tokenizer.encode_batch([code for code, _ in domains]), 256)
+        times = measure(lambda: scorer.rank(model.score_model.predict_on_batch, prompt), args.repeats)
+        results.append(latency(times, benchmark='attribution', size=model.size, control_codes=count,
+                               prompt_tokens=len(prompt)))
+    return results
+
+
+def bench_tokenize(model, args):
+    rng = model.rng()
+    texts = [' '.join([rng.choice(sorted(CONTROL_CODES)), model.text(11, rng)]) for _ in range(1000)]
+
+    def cold():
+        model.tokenizer.cache.clear()
+        model.tokenizer.encode_batch(texts)
+
+    ids = model.tokenizer.encode_batch(texts)
+    return [throughput(measure(cold, args.repeats), len(texts), 'texts_per_s', benchmark='tokenize',
+                       size=model.size, cache='cold', texts=len(texts)),
+            throughput(measure(lambda: model.tokenizer.encode_batch(texts), args.repeats), len(texts),
+                       'texts_per_s', benchmark='tokenize', size=model.size, cache='warm', texts=len(texts)),
+            throughput(measure(lambda: model.tokenizer.decode_batch(ids), args.repeats), len(texts),
+                       'texts_per_s', benchmark='detokenize', size=model.size, texts=len(texts))]
+
+
+def bench_email(args, directory):
+    rng = np.random.RandomState(args.seed)
+    corpus = os.path.join(directory, 'emails')
+    os.mkdir(corpus)
+    write_emails(corpus, args.emails, synthetic_words(5000, rng), rng)
+    bodies = get_email_body_from_directory(corpus, cache=False, processes=1)
+    stop_words = get_stop_words(args.stop_file)
+    docs = [str(body) for _, body in sorted(bodies.items())]
+
+    def fit():
+        extractor = KeywordExtractor(stop_words)
+        extractor.add_documents(bodies)
+        extractor.model()
+
+    extractor = KeywordExtractor(stop_words)
+    extractor.add_documents(bodies)
+    return [throughput(measure(lambda: get_email_body_from_directory(corpus, cache=False, processes=1), args.repeats),
+                       args.emails, 'emails_per_s', benchmark='email_parse', emails=args.emails),
+            throughput(measure(fit, args.repeats), args.emails, 'emails_per_s', benchmark='keyword_fit',
+                       emails=args.emails),
+            throughput(measure(lambda: extractor.keywords(docs), args.repeats), args.emails, 'emails_per_s',
+                       benchmark='keywords', emails=args.emails)]
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'tensorflow': tf.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'git_commit': commit}
+
+
+def result_key(result):
+    # what identifies a result across runs: every field but the measurements
+    return tuple(sorted((key, value) for key, value in result.items()
+                        if key not in ('value', 'median_ms', 'min_ms', 'runs', 'pss_mb')))
+
+
+def compare(results, baseline, tolerance):
+    # (result, baseline value, relative change) of the results that got worse by more than tolerance
+    # (a 1.25x longer latency or a 20% lower throughput are both a change of -0.2 and more)
+    earlier = dict((result_key(result), result['value']) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        value = earlier.get(result_key(result))
+        if not value:
+            continue
+        change = result['value'] / value - 1 if result['higher_is_better'] else value / result['value'] - 1
+        if change < -tolerance:
+            regressions.append((result, value, change))
+    return regressions
+
+
+def describe(result):
+    fields = ', '.join('{}={}'.format(key, value) for key, value in sorted(result.items())
+                       if key not in ('benchmark', 'metric', 'value', 'higher_is_better', 'median_ms', 'min_ms',
+                                      'runs', 'pss_mb'))
+    return '{:12s} {:45s} {:>12.2f} {}'.format(result['benchmark'], fields, result['value'], result['metric'])
+
+
+def run(args):
+    benchmarks = args.benchmarks.split(',')
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for size in args.sizes.split(','):
+            model = SyntheticModel(size, directory, args.seed)
+            for name, bench in [('forward', bench_forward), ('decode', bench_decode),
+                                ('attribution', bench_attribution), ('tokenize', bench_tokenize)]:
+                if name in benchmarks:
+                    for result in bench(model, args):
+                        print(describe(result))
+                        results.append(result)
+            if 'pool' in benchmarks:
+                for result in bench_pool(model, args, directory):
+                    print(describe(result) + ', {:.1f} MB'.format(result['pss_mb']))
+                    results.append(result)
+            tf.keras.backend.clear_session()
+        if 'email' in benchmarks:
+            for result in bench_email(args, directory):
+                print(describe(result))
+                results.append(result)
+    finally:
+        shutil.rmtree(directory)
+    settings = dict((key, value) for key, value in vars(args).items() if key not in ('out', 'compare', 'tolerance'))
+    return {'suite_version': SUITE_VERSION, 'environment': environment(), 'settings': settings, 'results': results}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    report = run(args)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('wrote {} results to {}'.format(len(report['results']), args.out))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report['results'], baseline, args.tolerance)
+        for result, value, change in regressions:
+            print('regression: {} (was {:.2f}, {:+.0%})'.format(describe(result), value, change))
+        print('{} regressions against {}'.format(len(regressions), args.compare))
+        sys.exit(1 if regressions else 0)
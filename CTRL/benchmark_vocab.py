@@ -0,0 +1,122 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+import CTRL.benchmark_suite as benchmark_suite
+from CTRL.benchmark_common import check, drop_page_cache, memory_status, reset_peak_rss, timed
+from CTRL.control_codes import CONTROL_CODES
+from CTRL.sampler import Sampler
+from CTRL.tokenizer import Detokenizer, Tokenizer, UNK
+from CTRL.vocab_index import VocabIndex, load_vocab_text, write_vocab_index
+import os
+import tempfile
+
+# benchmarks of the vocabulary: tokenizing prompts and the memory-mapped vocabulary index (see benchmark.py)
+
+
+def encode_one_by_one(bpe, word2idx, prompts):
+    # what generation.py and source_atttribution.py did per prompt (with <unk> instead of the KeyError)
+    return [[word2idx.get(piece, word2idx[UNK]) for piece in bpe.apply([prompt])[0].split()] for prompt in prompts]
+
+
+def bench_tokenize(args):
+    if args.fastbpe:
+        import fastBPE
+        bpe = fastBPE.fastBPE(args.codes, args.vocab)
+        vocab_path = args.vocab
+    else:
+        # the synthetic vocabulary and BPE of benchmark_suite.py, so it runs without fastBPE or the real vocab
+        pieces = benchmark_suite.synthetic_vocab(args.tokenizer_vocab_size, np.random.RandomState(args.seed))
+        bpe = benchmark_suite.SyntheticBPE(pieces)
+        vocab_path = os.path.join(tempfile.mkdtemp(), 'vocab')
+        benchmark_suite.write_vocab(vocab_path, pieces)
+    tokenizer = Tokenizer(vocab_path=vocab_path, bpe=bpe)
+    # prompts like the pipeline's: a control code and ten keywords, the keywords drawn
+    # with a long tail from whole words of the vocabulary, and a few made-up words
+    words = [word for word in tokenizer.idx2word[:20000] if word.isalpha()]
+    codes = sorted(CONTROL_CODES)
+    rng = np.random.RandomState(args.seed)
+    prompts = []
+    for _ in range(args.prompts):
+        keywords = [words[min(int(rng.zipf(1.3)), len(words)) - 1] for _ in range(10)]
+        keywords.append('zq%dxv' % rng.randint(100000))
+        prompts.append(' '.join([codes[rng.randint(len(codes))]] + keywords))
+
+    reference, reference_time = timed(encode_one_by_one, bpe, tokenizer.word2idx, prompts)
+    cold, cold_time = timed(tokenizer.encode_batch, prompts)
+    warm, warm_time = timed(tokenizer.encode_batch, prompts)
+    single, single_time = timed(lambda: [tokenizer.encode(prompt) for prompt in prompts])
+
+    generated = rng.randint(0, len(tokenizer), size=(args.prompts, args.generate_num))
+    detokenizer = Detokenizer(tokenizer.idx2word)
+    texts, detokenize_time = timed(lambda: [detokenizer.decode(row) for row in generated])
+    batch_texts, decode_time = timed(tokenizer.decode_batch, generated)
+
+    print('{} prompts of {} words, {} distinct words'.format(len(prompts), 12,
+                                                            len(set(' '.join(prompts).split()))))
+    print('encode                          | ms     | same ids')
+    for name, elapsed, ids in [('apply + word2idx per prompt', reference_time, reference),
+                               ('batch, cold cache', cold_time, cold),
+                               ('batch, warm cache', warm_time, warm),
+                               ('one prompt at a time, warm', single_time, single)]:
+        print('{:31s} | {:6.1f} | {}'.format(name, 1000. * elapsed,
+                                             check('tokenize: {} same ids'.format(name), ids == reference)))
+    print('decode {} x {} ids: Detokenizer {:.1f} ms, decode_batch {:.1f} ms, same text: {}'.format(
+        args.prompts, args.generate_num, 1000. * detokenize_time, 1000. * decode_time,
+        check('tokenize: decode_batch same text', texts == batch_texts)))
+
+
+def load_vocab_lists(vocab_path):
+    # the start-up of generation.py: the vocab file parsed into a list, a dict and an array
+    vocab = load_vocab_text(vocab_path)
+    word2idx = {u: i for i, u in enumerate(vocab)}
+    idx2word = np.array(vocab)
+    return vocab, word2idx, idx2word, Sampler(idx2word)
+
+
+def open_vocab_index(path):
+    index = VocabIndex(path)
+    return index, Sampler(index)
+
+
+def bench_vocab(args):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'vocab.idx')
+    _, build_time = timed(lambda: write_vocab_index(path, load_vocab_text(args.vocab)))
+
+    runs = []
+    # the index first: RSS only shows growth
+    for name, fn, arg in [('index', open_vocab_index, path), ('text', load_vocab_lists, args.vocab)]:
+        drop_page_cache(args.vocab)
+        drop_page_cache(path)
+        before = memory_status()
+        reset_peak_rss()
+        loaded, elapsed = timed(fn, arg)
+        after = memory_status()
+        runs.append((name, loaded, elapsed, after.get('VmHWM', 0.) - before.get('VmRSS', 0.),
+                     after.get('RssAnon', 0.) - before.get('RssAnon', 0.)))
+
+    (index, index_sampler), (vocab, word2idx, _, text_sampler) = runs[0][1], runs[1][1]
+    # every id to its piece and every piece back to its id, the same both ways
+    same_pieces = index.to_list() == vocab
+    same_ids = all(index.get(word) == i for word, i in word2idx.items())
+    same_masks = np.array_equal(index_sampler.banned, text_sampler.banned) and \
+        np.array_equal(index_sampler.disallowed, text_sampler.disallowed) and \
+        np.array_equal(index_sampler.penalizable, text_sampler.penalizable)
+    lookups = [vocab[i] for i in np.random.randint(0, len(vocab), size=100000)]
+    _, dict_time = timed(lambda: [word2idx[word] for word in lookups])
+    _, get_time = timed(lambda: [index.get(word) for word in lookups])
+    index_ids, index_time = timed(index.ids, lookups, -1)
+    same_ids = same_ids and index_ids.tolist() == [word2idx[word] for word in lookups]
+
+    print('{} pieces, index of {:.1f} MB built in {:.0f} ms'.format(len(vocab), os.path.getsize(path) / 2. ** 20,
+                                                                  1000. * build_time))
+    print('vocab | start-up ms | peak RSS growth MB | private RSS growth MB')
+    for name, _, elapsed, peak, private in runs:
+        print('{:5s} | {:11.1f} | {:18.1f} | {:21.1f}'.format(name, 1000. * elapsed, peak, private))
+    print('100k piece -> id lookups: dict {:.1f} ms, index ids {:.1f} ms, index get one at a time {:.1f} ms'.format(
+        1000. * dict_time, 1000. * index_time, 1000. * get_time))
+    print('same pieces: {}, same ids: {}, same sampler masks: {}'.format(
+        check('vocab: same pieces', same_pieces), check('vocab: same ids', same_ids),
+        check('vocab: same sampler masks', same_masks)))
+    index.close()
@@ -0,0 +1,54 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+
+# length buckets for full-window forward passes
+#
+# with a fixed seq_length input, a 12 token prompt is zero-padded to and run over all 256 positions
+# in every layer. here a batch is padded only up to the smallest bucket that fits it.
+# every bucket is traced once with its static length (and its causal mask, see Encoder.causal_mask),
+# so a handful of graphs serve every length and nothing is retraced per prompt.
+# attention is causal, so the padding after the tokens doesn't change any of their outputs.
+
+BUCKETS = (16, 32, 64, 128, 256)
+
+
+def make_buckets(seq_length, buckets=BUCKETS):
+    # the buckets shorter than the window, and the window itself
+    return tuple(sorted(set([bucket for bucket in buckets if bucket < seq_length] + [seq_length])))
+
+
+def bucket_for(length, buckets):
+    # the smallest bucket that fits `length` tokens
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    raise ValueError('{} tokens do not fit in the largest bucket ({})'.format(length, buckets[-1]))
+
+
+class BucketedModel(object):
+    # runs fn (e.g. a keras model with an Input(shape=(None,))) on token arrays padded to their bucket
+    #
+    # fn maps [batch, bucket] tokens to per-position outputs (logits, or the bucket - 1
+    # next-token log-probabilities of NextTokenLogProbs); what is returned is trimmed back to the
+    # positions of the unpadded tokens
+
+    def __init__(self, fn, seq_length, buckets=BUCKETS):
+        self.buckets = make_buckets(seq_length, buckets)
+        self.fn = tf.function(fn)
+
+    def warmup(self, batch_size=1):
+        # traces every bucket up front, so that no request pays for it
+        for bucket in self.buckets:
+            self.fn(tf.zeros((batch_size, bucket), dtype=tf.int32))
+
+    def __call__(self, tokens):
+        # tokens is a [batch, width] array of real tokens (rows may be right-padded with 0 themselves)
+        width = tokens.shape[1]
+        bucket = bucket_for(width, self.buckets)
+        padded = np.zeros((tokens.shape[0], bucket), dtype=np.int32)
+        padded[:, :width] = tokens
+        outputs = self.fn(tf.constant(padded))
+        return outputs[:, :int(outputs.shape[1]) - (bucket - width)].numpy()
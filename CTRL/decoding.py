@@ -0,0 +1,337 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+from CTRL.batch_decoding import decode_batch
+
+
+# incremental (key/value cached) decoding on top of CTRL.transformer
+#
+# the full-window path calls the keras model on all seq_length positions for every new token,
+# so every layer recomputes attention over the whole prefix again and again.
+# here the prompt is run through the stack once and the per-layer keys and values are kept;
+# every following step only feeds the newest token and attends to the cached prefix.
+
+def predict_with_cache(encoder, tied_embedding_softmax, tokens, past=None):
+    # tokens is a [batch, new_positions] int array holding the positions after the cached ones
+    # returns the logits for those positions and the cache that now also covers them
+    embedded = tied_embedding_softmax(tf.cast(tokens, tf.int32), embed=True)
+    transformed, presents = encoder(embedded, training=False, past=past, use_cache=True)
+    logits = tied_embedding_softmax(transformed, embed=False)
+    return logits, presents
+
+
+def empty_cache(encoder, batch_size):
+    # a cache that covers no positions yet, so the prompt and the later steps share one signature
+    attention = encoder.layer0.multi_head_attention
+    shape = (batch_size, attention.num_heads, 0, attention.depth)
+    return [(tf.zeros(shape), tf.zeros(shape)) for _ in range(encoder.num_layers)]
+
+
+def cache_length(past):
+    # number of positions the cache covers
+    return 0 if past is None else int(past[0][0].shape[-2])
+
+
+def gather_cache(past, rows):
+    # the cache of the given rows of the batch, in that order; a row can be taken more than once
+    return [(tf.gather(key, rows), tf.gather(value, rows)) for key, value in past]
+
+
+def truncate_cache(past, length):
+    # the cache of the first `length` positions only, e.g. after draft tokens were rejected
+    return [(key[:, :, :length], value[:, :, :length]) for key, value in past]
+
+
+def compile_decode_step(encoder, tied_embedding_softmax, projection=None, all_positions=False):
+    # a graph function that runs new positions against the cache
+    # and returns the logits of the last position only, which is all decoding needs
+    # (or of every new position with all_positions, for checking several draft tokens at once)
+    # padding_mask covers the cached and the new positions; position_ids only the new ones
+    # projection (e.g. Shortlist.projection) replaces the softmax over the whole vocabulary
+    projection = projection or tied_embedding_softmax
+    attention = encoder.layer0.multi_head_attention
+    cache_spec = tf.TensorSpec((None, attention.num_heads, None, attention.depth), tf.float32)
+
+    @tf.function(input_signature=[tf.TensorSpec((None, None), tf.int32),
+                                  [(cache_spec, cache_spec)] * encoder.num_layers,
+                                  tf.TensorSpec((None, None), tf.float32),
+                                  tf.TensorSpec((None, None), tf.int32)])
+    def decode_step(tokens, past, padding_mask, position_ids):
+        embedded = tied_embedding_softmax(tokens, embed=True)
+        transformed, presents = encoder(embedded, training=False, past=past, use_cache=True,
+                                        padding_mask=padding_mask, position_ids=position_ids)
+        return projection(transformed if all_positions else transformed[:, -1], embed=False), presents
+
+    return decode_step
+
+
+class CachedPredictor(object):
+    # keeps the cache for one growing sequence of tokens
+    # call it with the full token row each step; it only runs the tokens it hasn't seen yet
+
+    def __init__(self, encoder, tied_embedding_softmax, decode_step=None):
+        self.encoder = encoder
+        self.decode_step = decode_step or compile_decode_step(encoder, tied_embedding_softmax)
+        self.past = None
+
+    def reset(self):
+        self.past = None
+
+    def __call__(self, tokens, length):
+        # tokens is a [batch, >= length] array; returns the logits at position length - 1
+        start = cache_length(self.past)
+        if self.past is None or start >= length:
+            # nothing cached yet or the sequence was rewound, start over
+            self.past = empty_cache(self.encoder, tokens.shape[0])
+            start = 0
+        batch_size = tokens.shape[0]
+        padding_mask = np.zeros((batch_size, length), dtype=np.float32)
+        position_ids = np.tile(np.arange(start, length, dtype=np.int32), (batch_size, 1))
+        logits, self.past = self.decode_step(tf.constant(tokens[:, start:length], dtype=tf.int32), self.past,
+                                             padding_mask, position_ids)
+        return logits.numpy()
+
+
+class BatchGenerator(object):
+    # decodes many prompts of different lengths together, one forward pass per step for all of them,
+    # with the loop of batch_decoding.py (left padding, finished rows dropped from the batch and the cache)
+
+    def __init__(self, encoder, tied_embedding_softmax, decode_step=None):
+        self.encoder = encoder
+        self.decode_step = decode_step or compile_decode_step(encoder, tied_embedding_softmax)
+
+    def step(self, tokens, past, padding_mask, position_ids):
+        logits, past = self.decode_step(tf.constant(tokens), past, padding_mask, position_ids)
+        return logits.numpy(), past
+
+    def generate(self, prompts, max_lengths, select_fn, stop_tokens=()):
+        # see decode_batch for the arguments; returns the token id lists, prompt included, in the order of `prompts`
+        return decode_batch(self.step, lambda batch_size: empty_cache(self.encoder, batch_size), gather_cache,
+                            prompts, max_lengths, select_fn, stop_tokens)
+
+
+def log_probs(sampler, logits):
+    # log-softmax of processed [batch, vocab] logits over the tokens the sampler allows, in float64;
+    # candidates are scored with it whatever they were picked by
+    logits = logits.astype(np.float64)
+    logits[:, sampler.disallowed] = -np.inf
+    top = logits.max(axis=-1, keepdims=True)
+    # a row with every token ruled out stays -inf throughout instead of turning into nans
+    top[~np.isfinite(top)] = 0.
+    logits -= top
+    total = np.exp(logits).sum(axis=-1, keepdims=True)
+    total[total == 0] = 1.
+    return logits - np.log(total)
+
+
+class CandidateGenerator(object):
+    # several continuations of one prompt at once: n samples, or the best of a beam search
+    #
+    # the prompt is run once and its cache is copied to every row, then all rows decode together,
+    # one forward pass per step as in BatchGenerator. beams are pruned and reordered by gathering
+    # the rows of the cache. every candidate comes with its score, the sum of the log-probabilities
+    # of its new tokens (after the penalty and temperature of the sampler) divided by
+    # (number of new tokens) ** length_penalty, so longer candidates aren't ranked down for being longer
+
+    def __init__(self, encoder, tied_embedding_softmax, decode_step=None):
+        self.encoder = encoder
+        self.decode_step = decode_step or compile_decode_step(encoder, tied_embedding_softmax)
+
+    def encode_prompt(self, prompt):
+        # the logits after the prompt, [1, vocab], and its cache
+        logits, past = self.decode_step(tf.constant([prompt], dtype=tf.int32), empty_cache(self.encoder, 1),
+                                        np.zeros((1, len(prompt)), dtype=np.float32),
+                                        np.arange(len(prompt), dtype=np.int32)[np.newaxis])
+        return logits.numpy(), past
+
+    def step(self, tokens, past, length):
+        # the next token of every row, at position length - 1, run against the cache
+        logits, past = self.decode_step(tf.constant(np.asarray(tokens, dtype=np.int32)[:, np.newaxis]), past,
+                                        np.zeros((len(tokens), length), dtype=np.float32),
+                                        np.full((len(tokens), 1), length - 1, dtype=np.int32))
+        return logits.numpy(), past
+
+    @staticmethod
+    def score(total, new_tokens, length_penalty):
+        return total / max(new_tokens, 1) ** length_penalty
+
+    def sample(self, prompt, n, max_length, sampler, stop_tokens=(), length_penalty=1.):
+        # n samples of the sampler (temperature > 0) after `prompt`, as (tokens, score) pairs in the order drawn;
+        # tokens include the prompt, and a sample ends at max_length tokens or at one of stop_tokens
+        if sampler.temperature == 0:
+            raise ValueError('greedy decoding gives the same sample every time, sample with a temperature > 0')
+        stop_tokens = set(stop_tokens)
+        logits, past = self.encode_prompt(prompt)
+        generated = [list(prompt) for _ in range(n)]
+        totals = np.zeros(n)
+        counts = sampler.new_counts(generated)
+        active = list(range(n)) if len(prompt) < max_length else []
+        logits = np.repeat(logits, len(active), axis=0)
+        past = gather_cache(past, np.zeros(len(active), dtype=np.int32))
+        while active:
+            processed = sampler.process(logits, counts, active)
+            scores = log_probs(sampler, processed)
+            tokens = sampler.select(processed)
+            keep = []
+            for i, row in enumerate(active):
+                generated[row].append(int(tokens[i]))
+                totals[row] += scores[i, tokens[i]]
+                if len(generated[row]) < max_length and tokens[i] not in stop_tokens:
+                    keep.append(i)
+            sampler.add(counts, tokens, active)
+            if not keep:
+                break
+            if len(keep) < len(active):
+                past = gather_cache(past, keep)
+            active = [active[i] for i in keep]
+            logits, past = self.step(tokens[keep], past, len(generated[active[0]]))
+        return [(tokens, self.score(total, len(tokens) - len(prompt), length_penalty))
+                for tokens, total in zip(generated, totals)]
+
+    def beam_search(self, prompt, beam_width, max_length, sampler, stop_tokens=(), length_penalty=1.):
+        # the beam_width best continuations of `prompt` found by a beam search, as (tokens, score) pairs,
+        # best first; the sampler only contributes its penalty, temperature and banned / disallowed tokens
+        stop_tokens = set(stop_tokens)
+        if len(prompt) >= max_length:
+            return [(list(prompt), 0.)]
+        logits, past = self.encode_prompt(prompt)
+        beams = [list(prompt)]
+        totals = np.zeros(1)
+        counts = sampler.new_counts(beams)
+        finished = []
+        while beams:
+            scores = log_probs(sampler, sampler.process(logits, counts)) + totals[:, np.newaxis]
+            # twice the width, so that enough of them go on if some of them end here
+            flat = scores.ravel()
+            finite = int(np.isfinite(flat).sum())
+            if finite == 0:
+                # every token is ruled out (banned, disallowed or not on the shortlist): the beams end here
+                finished += [(beam, self.score(total, len(beam) - len(prompt), length_penalty))
+                             for beam, total in zip(beams, totals)]
+                break
+            best = min(2 * beam_width, finite)
+            best = np.argpartition(flat, len(flat) - best)[len(flat) - best:]
+            best = best[np.argsort(flat[best], kind='stable')[::-1]]
+            parents, tokens, new_beams = [], [], []
+            for candidate in best:
+                parent, token = divmod(int(candidate), scores.shape[1])
+                tokens_so_far = beams[parent] + [token]
+                if token in stop_tokens or len(tokens_so_far) >= max_length:
+                    finished.append((tokens_so_far, self.score(flat[candidate], len(tokens_so_far) - len(prompt),
+                                                               length_penalty)))
+                else:
+                    parents.append(parent)
+                    tokens.append(token)
+                    new_beams.append(tokens_so_far)
+                if len(new_beams) == beam_width:
+                    break
+            if len(finished) >= beam_width or not new_beams:
+                break
+            totals = scores[parents, tokens]
+            counts = counts.select(parents)
+            sampler.add(counts, tokens)
+            beams = new_beams
+            logits, past = self.step(tokens, gather_cache(past, np.array(parents, dtype=np.int32)), len(beams[0]))
+        return sorted(finished, key=lambda candidate: -candidate[1])[:beam_width]
+
+
+def compile_window_step(encoder, tied_embedding_softmax, projection=None):
+    # like compile_decode_step, for a cache that is full: the key/value of the new position
+    # is written over cache slot `slot` instead of being appended, so the cache keeps its size.
+    # a single new position attends to every cached one and attention doesn't depend on their order,
+    # so the slots can be reused in any order (each cached key/value carries its own position)
+    projection = projection or tied_embedding_softmax
+    attention = encoder.layer0.multi_head_attention
+    cache_spec = tf.TensorSpec((None, attention.num_heads, None, attention.depth), tf.float32)
+
+    @tf.function(input_signature=[tf.TensorSpec((None, 1), tf.int32),
+                                  [(cache_spec, cache_spec)] * encoder.num_layers,
+                                  tf.TensorSpec((None, 1), tf.int32),
+                                  tf.TensorSpec((), tf.int32)])
+    def window_step(tokens, past, position_ids, slot):
+        embedded = tied_embedding_softmax(tokens, embed=True)
+        transformed, presents = encoder(embedded, training=False, past=past, use_cache=True,
+                                        position_ids=position_ids)
+        # the new key/value is at index `window` of the presents, put it in place of `slot`
+        window = tf.shape(past[0][0])[-2]
+        keep = tf.concat([tf.range(slot), [window], tf.range(slot + 1, window)], axis=0)
+        presents = [(tf.gather(key, keep, axis=2), tf.gather(value, keep, axis=2)) for key, value in presents]
+        return projection(transformed[:, -1], embed=False), presents
+
+    return window_step
+
+
+class SlidingWindowPredictor(object):
+    # CachedPredictor for sequences of any length, at a constant cost per token
+    #
+    # the cache holds at most `window` positions: the first `sink` tokens of the sequence, which are
+    # always kept (the control code, which everything attends to), and a ring buffer of the most
+    # recent ones, where every new token replaces the oldest. nothing is recomputed when a token is evicted.
+    # the keys and values are computed with the absolute position of their token, so positions
+    # keep growing as the window slides; once they reach max_position (the length the model was
+    # trained on) the window is encoded again from position 0, i.e. the sink at 0 and the recent tokens
+    # after it, as the full-window recompute did for every token. that happens once every
+    # max_position - window tokens. up to `window` tokens, it is exactly CachedPredictor.
+
+    def __init__(self, encoder, tied_embedding_softmax, window, max_position=512, sink=1, decode_step=None,
+                 window_step=None):
+        if not 0 <= sink < window < max_position:
+            raise ValueError('need 0 <= sink < window < max_position, got {}, {}, {}'.format(sink, window,
+                                                                                          max_position))
+        if max_position > encoder.max_position:
+            raise ValueError('the encoder only has {} positions, not {}'.format(encoder.max_position, max_position))
+        self.encoder = encoder
+        self.window = window
+        self.max_position = max_position
+        self.sink = sink
+        self.decode_step = decode_step or compile_decode_step(encoder, tied_embedding_softmax)
+        self.window_step = window_step or compile_window_step(encoder, tied_embedding_softmax)
+        self.reset()
+
+    def reset(self):
+        self.past = None
+        # tokens of the sequence run so far, the position of the next one and the cache slot it replaces
+        self.seen = 0
+        self.position = 0
+        self.slot = self.sink
+
+    def encode(self, tokens):
+        # (re)builds the cache from the sink and the most recent of `tokens`, returns the logits of the last one
+        if tokens.shape[1] > self.window:
+            tokens = np.hstack((tokens[:, :self.sink], tokens[:, tokens.shape[1] - (self.window - self.sink):]))
+        batch_size, length = tokens.shape
+        logits, self.past = self.decode_step(tf.constant(tokens, dtype=tf.int32),
+                                             empty_cache(self.encoder, batch_size),
+                                             np.zeros((batch_size, length), dtype=np.float32),
+                                             np.tile(np.arange(length, dtype=np.int32), (batch_size, 1)))
+        self.position = length
+        # the oldest of the recent tokens is right after the sink
+        self.slot = self.sink
+        return logits
+
+    def __call__(self, tokens, length):
+        # tokens is a [batch, >= length] array; returns the logits at position length - 1
+        if self.past is None or self.seen >= length:
+            # nothing cached yet or the sequence was rewound, start over
+            self.seen = length
+            return self.encode(tokens[:, :length]).numpy()
+        batch_size = tokens.shape[0]
+        for i in range(self.seen, length):
+            token = tf.constant(tokens[:, i:i + 1], dtype=tf.int32)
+            position_ids = np.full((batch_size, 1), self.position, dtype=np.int32)
+            cached = cache_length(self.past)
+            if self.position >= self.max_position:
+                logits = self.encode(tokens[:, :i + 1])
+            elif cached < self.window:
+                logits, self.past = self.decode_step(token, self.past,
+                                                     np.zeros((batch_size, cached + 1), dtype=np.float32),
+                                                     position_ids)
+                self.position += 1
+            else:
+                logits, self.past = self.window_step(token, self.past, position_ids, self.slot)
+                self.position += 1
+                self.slot = self.sink + (self.slot + 1 - self.sink) % (self.window - self.sink)
+        self.seen = length
+        return logits.numpy()
@@ -0,0 +1,189 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+import argparse
+
+from CTRL.batch_decoding import decode_batch
+from CTRL.profiling import profiler
+from CTRL.weight_store import WeightStore, write_weight_store
+
+# the forward pass of CTRL in numpy, straight from a memory-mapped serving weight file
+#
+# a TensorFlow process copies every weight into its own variables, so N processes hold N copies of the model.
+# the serving file holds the weights as a loaded model uses them at fp32 (the query/key/value kernels side by
+# side with the query part scaled, see MultiHeadAttention.fuse_qkv) and the positional encoding table;
+# NumpyModel computes with read-only views of the mapping, so nothing is copied and every process that
+# maps the file shares its pages (see worker_pool.py). it is Encoder and TiedEmbeddingSoftmax of
+# transformer.py with the key/value cache of decoding.py, for inference only, and doesn't import TensorFlow.
+#
+# tensors of the file: w and b (the tied embedding / softmax), pos_encoding, layer<i>/<dense>/kernel and bias
+# for qkv, dense (the attention output), ffn1 and ffn2, layer<i>/<norm>/gamma and beta for layernorm1 and
+# layernorm2, and layernorm/gamma and beta after the last layer.
+#
+# make one from a weight file with
+#   python -m CTRL.numpy_model --weights ctrl.wts --out ctrl.serving
+
+EPSILON = 1e-6
+
+DENSE_LAYERS = ['qkv', 'dense', 'ffn1', 'ffn2']
+NORM_LAYERS = ['layernorm1', 'layernorm2']
+
+
+def serving_tensors(encoder, tied_embedding_softmax):
+    # (name, variable or tensor) of everything the serving file holds, in file order, from a loaded model
+    if not encoder.fused or encoder.precision != 'fp32' or tied_embedding_softmax.precision != 'fp32':
+        raise ValueError('the serving weights come from a model with fused query/key/value projections at fp32')
+    tensors = [('w', tied_embedding_softmax.w), ('b', tied_embedding_softmax.b),
+               ('pos_encoding', encoder.pos_encoding[0])]
+    for i in range(encoder.num_layers):
+        layer = getattr(encoder, 'layer%i' % i)
+        dense_layers = [layer.multi_head_attention.Wqkv, layer.multi_head_attention.dense] + layer.ffn.layers
+        for name, dense in zip(DENSE_LAYERS, dense_layers):
+            tensors += [('layer%i/%s/kernel' % (i, name), dense.kernel), ('layer%i/%s/bias' % (i, name), dense.bias)]
+        for name, norm in zip(NORM_LAYERS, [layer.layernorm1, layer.layernorm2]):
+            tensors += [('layer%i/%s/gamma' % (i, name), norm.gamma), ('layer%i/%s/beta' % (i, name), norm.beta)]
+    tensors += [('layernorm/gamma', encoder.layernorm.gamma), ('layernorm/beta', encoder.layernorm.beta)]
+    return tensors
+
+
+def write_serving_weights(path, encoder, tied_embedding_softmax):
+    # one tensor in memory at a time, as with the weight file
+    tensors = serving_tensors(encoder, tied_embedding_softmax)
+    by_name = dict(tensors)
+    write_weight_store(path, [(name, tuple(tensor.shape), np.float32) for name, tensor in tensors],
+                       lambda name: np.asarray(by_name[name]))
+
+
+def layer_norm(x, gamma, beta):
+    mean = x.mean(axis=-1, keepdims=True)
+    centered = x - mean
+    variance = np.square(centered).mean(axis=-1, keepdims=True)
+    return centered / np.sqrt(variance + EPSILON) * gamma + beta
+
+
+def linear(x, kernel, bias):
+    # [..., d_in] x [d_in, d_out] as one matmul over all positions
+    return np.dot(x.reshape(-1, x.shape[-1]), kernel).reshape(x.shape[:-1] + (kernel.shape[-1],)) + bias
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    np.exp(logits, out=logits)
+    logits /= logits.sum(axis=-1, keepdims=True)
+    return logits
+
+
+class NumpyModel(object):
+
+    def __init__(self, path, num_heads=16):
+        self.store = WeightStore(path)
+        self.w = self.store['w']
+        self.b = self.store['b']
+        self.pos_encoding = self.store['pos_encoding']
+        self.max_position, self.d_model_size = self.pos_encoding.shape
+        if self.d_model_size % num_heads:
+            raise ValueError('{} heads don\'t divide a model dimension of {}'.format(num_heads, self.d_model_size))
+        self.num_heads = num_heads
+        self.depth = self.d_model_size // num_heads
+        self.num_layers = sum(1 for name in self.store.names() if name.endswith('/qkv/kernel'))
+        self.layers = [dict((name, self.store['layer%i/%s' % (i, name)])
+                            for name in [dense + '/' + part for dense in DENSE_LAYERS for part in ['kernel', 'bias']] +
+                            [norm + '/' + part for norm in NORM_LAYERS for part in ['gamma', 'beta']])
+                       for i in range(self.num_layers)]
+        self.layernorm = (self.store['layernorm/gamma'], self.store['layernorm/beta'])
+        # profiler stage of every layer, as in Encoder
+        self.stage_names = ['encoder.layer%i' % i for i in range(self.num_layers)]
+
+    @property
+    def vocab_size(self):
+        return len(self.b)
+
+    def empty_cache(self, batch_size):
+        shape = (batch_size, self.num_heads, 0, self.depth)
+        return [(np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)) for _ in range(self.num_layers)]
+
+    @staticmethod
+    def gather_cache(past, rows):
+        return [(key[rows], value[rows]) for key, value in past]
+
+    def layer(self, weights, x, bias, layer_past):
+        batch_size, seq_len = x.shape[:2]
+        normed = layer_norm(x, weights['layernorm1/gamma'], weights['layernorm1/beta'])
+        # [batch, seq, 3, heads, depth] -> [3, batch, heads, seq, depth]
+        qkv = linear(normed, weights['qkv/kernel'], weights['qkv/bias'])
+        q, k, v = qkv.reshape(batch_size, seq_len, 3, self.num_heads, self.depth).transpose(2, 0, 3, 1, 4)
+        k = np.concatenate([layer_past[0], k], axis=2)
+        v = np.concatenate([layer_past[1], v], axis=2)
+        attention = np.matmul(softmax(np.matmul(q, k.transpose(0, 1, 3, 2)) + bias), v)
+        attention = attention.transpose(0, 2, 1, 3).reshape(batch_size, seq_len, self.d_model_size)
+        out1 = x + linear(attention, weights['dense/kernel'], weights['dense/bias'])
+
+        normed = layer_norm(out1, weights['layernorm2/gamma'], weights['layernorm2/beta'])
+        hidden = np.maximum(linear(normed, weights['ffn1/kernel'], weights['ffn1/bias']), 0.)
+        return out1 + linear(hidden, weights['ffn2/kernel'], weights['ffn2/bias']), (k, v)
+
+    def decode_step(self, tokens, past, padding_mask, position_ids):
+        # as the step of compile_decode_step: runs the [batch, seq] new tokens after the cached positions and
+        # returns the logits of the last one, [batch, vocab], and the cache with the new positions;
+        # padding_mask is 1 at the padding of every row (over the cached and the new positions)
+        tokens = np.asarray(tokens)
+        seq_len = tokens.shape[1]
+        past_len = past[0][0].shape[2]
+        x = self.w[tokens] * np.float32(np.sqrt(self.d_model_size)) + self.pos_encoding[position_ids]
+        # each new position sees every cached position and the new positions up to itself
+        mask = np.triu(np.ones((seq_len, past_len + seq_len), dtype=np.float32), past_len + 1)
+        bias = np.maximum(mask, np.asarray(padding_mask, dtype=np.float32)[:, np.newaxis, np.newaxis, :]) * -1e9
+        presents = []
+        for i, weights in enumerate(self.layers):
+            with profiler.stage(self.stage_names[i]):
+                x, present = self.layer(weights, x, bias, past[i])
+            presents.append(present)
+        hidden = layer_norm(x[:, -1], *self.layernorm)
+        # [batch, d] times the transpose of the mapped [vocab, d] embedding, which BLAS reads as it is
+        return np.dot(hidden, self.w.T) + self.b, presents
+
+    def generate(self, prompts, max_lengths, select_fn, stop_tokens=()):
+        # BatchGenerator.generate, with the same loop (see batch_decoding.py)
+        if isinstance(max_lengths, int):
+            max_lengths = [max_lengths] * len(prompts)
+        if max_lengths and max(max_lengths) > self.max_position:
+            raise ValueError('the model has {} positions, not {}'.format(self.max_position, max(max_lengths)))
+        return decode_batch(self.decode_step, self.empty_cache, self.gather_cache, prompts, max_lengths, select_fn,
+                            stop_tokens)
+
+    def close(self):
+        self.layers = self.w = self.b = self.pos_encoding = self.layernorm = None
+        self.store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write the serving weight file of a CTRL model, for worker_pool.py')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='weight file of the model (see weight_store.py)')
+    parser.add_argument('--model_path', type=str, default=None,
+                        help='or the checkpoint *data* file')
+    parser.add_argument('--out', type=str, required=True,
+                        help='serving weight file to write')
+    parser.add_argument('--codes', type=str, default='codes',
+                        help='BPE codes file of the model')
+    parser.add_argument('--vocab', type=str, default='vocab',
+                        help='vocab file of the model, for its size')
+    parser.add_argument('--num_layers', type=int, default=48,
+                        help='encoder layers of the model')
+    parser.add_argument('--d_model_size', type=int, default=1280,
+                        help='model dimension')
+    parser.add_argument('--num_heads', type=int, default=16,
+                        help='attention heads')
+    parser.add_argument('--dff', type=int, default=8192,
+                        help='feed forward dimension')
+    args = parser.parse_args()
+    if not args.weights and not args.model_path:
+        parser.error('one of --weights or --model_path is required')
+    from CTRL.api import CTRLModel
+    model = CTRLModel(weights=args.weights, model_path=args.model_path, codes=args.codes, vocab=args.vocab,
+                      num_layers=args.num_layers, d_model_size=args.d_model_size, num_heads=args.num_heads,
+                      dff=args.dff)
+    encoder, tied_embedding_softmax = model.layers
+    write_serving_weights(args.out, encoder, tied_embedding_softmax)
+    print('wrote {}'.format(args.out))
@@ -0,0 +1,159 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+# named timers and counters around the stages of the inference loop
+#
+# `profiler` is the one instance the code is instrumented with; it is off unless enabled, and then
+# `with profiler.stage(name):` costs a method call returning a shared no-op context.
+# when on, every stage records its wall time (for the per-stage p50/p95/p99 of summary()) and,
+# for write_chrome_trace(), an event per call that chrome://tracing or Perfetto can open;
+# stages can be nested, e.g. the encoder layers inside the forward pass.
+# code running inside a tf.function only runs while it is traced, so nothing is recorded then:
+# the per-layer times need the encoder to run eagerly.
+#
+# the stage names used in this repository: tokenize, forward, encoder.layer<i>, sample.process,
+# sample.candidates, sample.draw, detokenize and generate in CTRL, email.parse, tfidf.fit and
+# tfidf.keywords in depeng; the tokens counter counts generated tokens.
+
+# events kept for the trace, so that a long run can't use up the memory; the summary keeps counting
+MAX_EVENTS = 1000000
+
+
+class NoStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+def tracing():
+    # inside a tf.function being traced, where the wall time of the python code means nothing
+    tf = sys.modules.get('tensorflow')
+    return tf is not None and not tf.executing_eagerly()
+
+
+def percentile(sorted_values, q):
+    return float(np.percentile(sorted_values, q)) if len(sorted_values) else 0.
+
+
+class Stage(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # seconds of every call, by stage
+            self.durations = {}
+            self.counters = {}
+            # (name, start, end, thread id) of every call, for the trace
+            self.events = []
+            self.started = time.perf_counter()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def stage(self, name):
+        if not self.enabled or tracing():
+            return NO_STAGE
+        return Stage(self, name)
+
+    def record(self, name, start, end):
+        with self.lock:
+            self.durations.setdefault(name, []).append(end - start)
+            if len(self.events) < MAX_EVENTS:
+                self.events.append((name, start, end, threading.current_thread().ident))
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def profiled(self, name):
+        # a decorator that runs the whole function as a stage
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        # calls, total and mean / p50 / p95 / p99 milliseconds of every stage, the counters,
+        # and the generated tokens per second of the generate stage (or of the time since enable)
+        with self.lock:
+            durations = dict((name, sorted(values)) for name, values in self.durations.items())
+            counters = dict(self.counters)
+            elapsed = time.perf_counter() - self.started
+        stages = {}
+        for name, values in durations.items():
+            stages[name] = {'calls': len(values), 'total_ms': 1000. * sum(values),
+                            'mean_ms': 1000. * sum(values) / len(values), 'p50_ms': 1000. * percentile(values, 50),
+                            'p95_ms': 1000. * percentile(values, 95), 'p99_ms': 1000. * percentile(values, 99)}
+        seconds = sum(durations['generate']) if 'generate' in durations else elapsed
+        return {'stages': stages, 'counters': counters,
+                'tokens_per_s': counters.get('tokens', 0) / seconds if seconds else 0.}
+
+    def report(self):
+        # the summary as a table, the most expensive stages first
+        summary = self.summary()
+        lines = ['stage                |   calls |   total ms |  mean ms |   p50 ms |   p95 ms |   p99 ms']
+        for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['total_ms']):
+            lines.append('{:20s} | {:7d} | {:10.1f} | {:8.3f} | {:8.3f} | {:8.3f} | {:8.3f}'.format(
+                name, stage['calls'], stage['total_ms'], stage['mean_ms'], stage['p50_ms'], stage['p95_ms'],
+                stage['p99_ms']))
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('{}: {}'.format(name, value))
+        lines.append('tokens/s: {:.2f}'.format(summary['tokens_per_s']))
+        return '\n'.join(lines)
+
+    def write_chrome_trace(self, path):
+        # the recorded calls in the chrome trace event format, as complete events in microseconds
+        with self.lock:
+            events, started = list(self.events), self.started
+        pid = os.getpid()
+        trace = [{'name': name, 'ph': 'X', 'ts': 1e6 * (start - started), 'dur': 1e6 * (end - start),
+                  'pid': pid, 'tid': tid} for name, start, end, tid in events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return len(trace)
+
+
+profiler = Profiler()
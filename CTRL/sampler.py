@@ -0,0 +1,251 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+from CTRL.profiling import profiler
+
+
+# the post-logits work of a decoding step (temperature, repetition penalty, disallowed tokens,
+# top-k / nucleus pruning and the final pick), vectorized over the vocabulary
+#
+# it makes the same choices as the per-token loops it replaces:
+# the penalty divides the logits of every token seen so far except newlines,
+# <unk> and Sco@@ are pushed to -1e8, the nucleus size is the number of sorted tokens
+# before the cumulative probability passes the cutoff (at least 1),
+# and anything containing `http` is dropped from the pruned candidates afterwards.
+# the candidates keep the descending order of the old argsort, so for a fixed seed
+# tf.random.categorical draws the same token for greedy, top-k, nucleus and full-vocabulary decoding
+# (the latter still sorts the whole vocabulary every step: the draw depends on the order of all of it).
+# with an rng (a numpy RandomState) the draw is made with it instead, from the same distribution
+# but not the same token as TensorFlow's for a seed, so that processes without TensorFlow can sample
+# (see worker_pool.py); TensorFlow is only imported to draw.
+
+# how many of the most likely tokens are sorted first when looking for the nucleus cutoff;
+# rows whose nucleus is bigger try NUCLEUS_GROWTH times as many, up to the whole vocabulary
+NUCLEUS_CANDIDATES = 64
+NUCLEUS_GROWTH = 8
+
+# every SAMPLE_STRIDE-th logit is used to guess a threshold for the top-k search
+SAMPLE_STRIDE = 16
+
+# tokens that are never generated, and what makes a token disallowed as a candidate
+BANNED = ['<unk>', 'Sco@@']
+DISALLOWED = 'http'
+
+
+def top_ids(values, k):
+    # ids of the k largest entries of a 1-d array, largest first
+    if k >= len(values):
+        return np.argsort(values)[::-1]
+    # a threshold from a strided sample of the values picks out a few hundred contenders in one pass,
+    # so argpartition and the sort only run on those instead of the whole vocabulary.
+    # if at least k values pass the threshold, the k largest are all among them
+    sample = values[::SAMPLE_STRIDE]
+    rank = len(sample) - min(len(sample), 2 * (k // SAMPLE_STRIDE + 1) + 8)
+    threshold = np.partition(sample, rank)[rank]
+    ids = np.flatnonzero(values >= threshold)
+    if len(ids) < k:
+        ids = np.arange(len(values))
+    if len(ids) > k:
+        ids = ids[np.argpartition(values[ids], len(ids) - k)[len(ids) - k:]]
+    return ids[np.argsort(values[ids])[::-1]]
+
+
+def draw_rows(values, rng):
+    # one index per row of [batch, n] logits, drawn from their softmax like tf.random.categorical
+    probs = np.exp(values.astype(np.float64) - values.max(axis=-1, keepdims=True))
+    cumulative = np.cumsum(probs, axis=-1)
+    draws = rng.random_sample(len(values)) * cumulative[:, -1]
+    return np.minimum((cumulative <= draws[:, np.newaxis]).sum(axis=-1), values.shape[-1] - 1)
+
+
+class Sampler(object):
+
+    def __init__(self, idx2word, temperature=0., nucleus=0., topk=0, penalty=1.2, rng=None):
+        self.vocab_size = len(idx2word)
+        self.temperature = temperature
+        self.nucleus = nucleus
+        self.topk = topk
+        self.penalty = penalty
+        self.rng = rng
+
+        # these masks are built once for the vocabulary instead of being checked token by token every step
+        if hasattr(idx2word, 'find'):
+            # a VocabIndex: the same masks from its hash table and blob, without a copy of the vocabulary
+            self.banned = np.array(sorted(i for i in (idx2word.get(word) for word in BANNED) if i is not None),
+                                   dtype=np.int64)
+            self.disallowed = idx2word.find(DISALLOWED)
+            self.penalizable = np.ones(self.vocab_size, dtype=bool)
+            if idx2word.get('\n') is not None:
+                self.penalizable[idx2word.get('\n')] = False
+        else:
+            idx2word = np.asarray(idx2word)
+            # tokens that are never generated
+            self.banned = np.flatnonzero(np.isin(idx2word, BANNED))
+            # tokens that are dropped from the pruned candidates
+            self.disallowed = np.char.find(idx2word, DISALLOWED) >= 0
+            # newlines are not penalized for repetition
+            self.penalizable = idx2word != '\n'
+
+        # scratch space for the nucleus softmax, reused across steps
+        self._probs = np.empty(self.vocab_size, dtype=np.float32)
+
+    def new_counts(self, prompts):
+        # running token counts of every row, for the repetition penalty
+        return TokenCounts(prompts, self.vocab_size, self.penalizable)
+
+    def add(self, counts, tokens, rows=None):
+        counts.add(np.arange(len(tokens)) if rows is None else rows, tokens)
+
+    @profiler.profiled('sample.process')
+    def process(self, logits, counts, rows=None):
+        # applies temperature, penalty and banned tokens to the [batch, vocab] logits, in place
+        # (they are fresh from the model every step) and returns them
+        # rows picks the rows of `counts` that belong to the rows of `logits`
+        if logits.dtype != np.float32 or not logits.flags.writeable:
+            logits = logits.astype(np.float32)
+        if self.temperature > 0:
+            logits /= self.temperature
+        if self.penalty > 0:
+            for i, row in enumerate(range(len(logits)) if rows is None else rows):
+                logits[i, counts.seen[row]] /= self.penalty
+        logits[:, self.banned] = -1e8
+        return logits
+
+    def nucleus_top(self, row):
+        # the nucleus of one row of logits, most likely first; only the total of the softmax needs the whole
+        # vocabulary, the cutoff is looked for in a prefix of the most likely tokens that grows until it has it
+        probs = self._probs
+        np.subtract(row, row.max(), out=probs)
+        np.exp(probs, out=probs)
+        total = probs.sum()
+        k = NUCLEUS_CANDIDATES
+        while True:
+            ids = top_ids(row, min(k, self.vocab_size))
+            passed = np.flatnonzero(np.cumsum(probs[ids] / total) > self.nucleus)
+            if len(passed) or k >= self.vocab_size:
+                return ids[:max(passed[0] if len(passed) else self.vocab_size, 1)]
+            k *= NUCLEUS_GROWTH
+
+    def candidates(self, logits):
+        # the pruned candidates of every row without the disallowed tokens, and their logits;
+        # rows with fewer candidates are padded with -inf logits
+        if self.nucleus <= 0. and self.topk <= 0:
+            # neither nucleus nor topk: every allowed token is a candidate, most likely first like the old list;
+            # every row loses the same disallowed tokens, so the rows stay the same length
+            ids = np.argsort(logits, axis=-1)[:, ::-1]
+            ids = ids[~self.disallowed[ids]].reshape(len(logits), -1)
+            return ids, logits[np.arange(len(logits))[:, np.newaxis], ids]
+        rows = []
+        for row in logits:
+            ids = self.nucleus_top(row) if self.nucleus > 0. else top_ids(row, self.topk)
+            ids = ids[~self.disallowed[ids]]
+            if len(ids) == 0:
+                # every candidate was disallowed, take the most likely allowed token
+                ids = self.alternatives(row[np.newaxis], 1)[0]
+            rows.append(ids)
+        width = max(max(len(ids) for ids in rows), 1)
+        ids = np.zeros((len(logits), width), dtype=np.int64)
+        values = np.full((len(logits), width), -np.inf, dtype=np.float32)
+        for i, row_ids in enumerate(rows):
+            ids[i, :len(row_ids)] = row_ids
+            values[i, :len(row_ids)] = logits[i, row_ids]
+        return ids, values
+
+    def alternatives(self, logits, n):
+        # the n most likely allowed tokens of every row, for printing
+        alternatives = []
+        for row in logits:
+            ids = top_ids(row, n + int(self.disallowed.sum()))
+            alternatives.append(ids[~self.disallowed[ids]][:n])
+        return alternatives
+
+    def select(self, logits):
+        # picks the next token of every row from processed logits
+        if self.temperature == 0:
+            # the first of the pruned candidates is always the most likely allowed token
+            chosen = np.argmax(logits, axis=-1)
+            for row in range(len(logits)):
+                while self.disallowed[chosen[row]]:
+                    logits[row, chosen[row]] = -np.inf
+                    chosen[row] = np.argmax(logits[row])
+            return chosen
+        with profiler.stage('sample.candidates'):
+            ids, values = self.candidates(logits)
+        with profiler.stage('sample.draw'):
+            if self.rng is not None:
+                chosen = draw_rows(values, self.rng)
+            else:
+                import tensorflow as tf
+                chosen = tf.random.categorical(values, num_samples=1).numpy()[:, 0]
+        return ids[np.arange(len(ids)), chosen]
+
+    def probabilities(self, logits):
+        # the distribution select draws from for every row of processed logits, as [batch, vocab] float64:
+        # one-hot at the greedy pick, or the softmax of the pruned candidates
+        probs = np.zeros(logits.shape, dtype=np.float64)
+        if self.temperature == 0:
+            probs[np.arange(len(logits)), self.select(logits.copy())] = 1.
+            return probs
+        if self.nucleus <= 0. and self.topk <= 0:
+            # every allowed token; the distribution doesn't depend on the order, so nothing is sorted
+            probs = logits.astype(np.float64)
+            probs[:, self.disallowed] = -np.inf
+            probs = np.exp(probs - probs.max(axis=-1, keepdims=True))
+            return probs / probs.sum(axis=-1, keepdims=True)
+        ids, values = self.candidates(logits)
+        values = np.exp(values.astype(np.float64) - values.max(axis=-1, keepdims=True))
+        # the padding of short rows has a zero weight, so adding it to id 0 changes nothing
+        np.add.at(probs, (np.arange(len(ids))[:, np.newaxis], ids), values / values.sum(axis=-1, keepdims=True))
+        return probs
+
+    def __call__(self, logits, counts, rows=None):
+        return self.select(self.process(logits, counts, rows))
+
+    def for_batch(self, prompts):
+        # a select function for BatchGenerator that keeps the counts of every row up to date
+        counts = self.new_counts(prompts)
+
+        def select_fn(logits, rows):
+            tokens = self(logits, counts, rows)
+            counts.add(rows, tokens)
+            return tokens
+
+        return select_fn
+
+
+class TokenCounts(object):
+    # how often every token occurred in each row, plus the distinct penalizable tokens of each row
+    # so that the penalty only touches those instead of scanning the vocabulary every step
+
+    def __init__(self, prompts, vocab_size, penalizable):
+        self.penalizable = penalizable
+        self.counts = np.zeros((len(prompts), vocab_size), dtype=np.int32)
+        self.seen = []
+        for row, prompt in enumerate(prompts):
+            self.counts[row] = np.bincount(prompt, minlength=vocab_size)
+            seen = np.unique(np.asarray(prompt, dtype=np.int64))
+            self.seen.append(seen[penalizable[seen]].tolist())
+
+    def add(self, rows, tokens):
+        for row, token in zip(rows, tokens):
+            if self.counts[row, token] == 0 and self.penalizable[token]:
+                self.seen[row].append(token)
+            self.counts[row, token] += 1
+
+    def select(self, rows):
+        # the counts of the given rows, in that order, as a new TokenCounts; a row can be taken more than once
+        selected = TokenCounts([], self.counts.shape[1], self.penalizable)
+        selected.counts = self.counts[rows]
+        selected.seen = [list(self.seen[row]) for row in rows]
+        return selected
+
+    def prefixes(self, row, tokens):
+        # the counts of `row` followed by the first 0, 1, ..., len(tokens) of `tokens`,
+        # as a TokenCounts of len(tokens) + 1 rows; `row` itself is left as it is
+        prefixes = TokenCounts([], self.counts.shape[1], self.penalizable)
+        prefixes.counts = np.repeat(self.counts[row:row + 1], len(tokens) + 1, axis=0)
+        prefixes.seen = [list(self.seen[row]) for _ in range(len(tokens) + 1)]
+        for i, token in enumerate(tokens):
+            prefixes.add(range(i + 1, len(tokens) + 1), [token] * (len(tokens) - i))
+        return prefixes
@@ -0,0 +1,561 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+import argparse
+import asyncio
+import collections
+import http.client
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import CTRL.transformer
+from CTRL.api import CTRLModel
+from CTRL.attribution import DomainScorer, NextTokenLogProbs
+from CTRL.buckets import BucketedModel, make_buckets
+from CTRL.control_codes import CONTROL_CODES
+from CTRL.decoding import BatchGenerator
+from CTRL.sampler import Sampler
+from CTRL.tokenizer import Detokenizer, Tokenizer
+from CTRL.worker_pool import WorkerPool
+
+# a long-running generation and attribution service: the model is loaded once, and requests from
+# any number of clients are queued and run in batches
+#
+# the endpoint is HTTP/1.1 with json bodies, on a local TCP port or a unix socket:
+#   POST /generate   {"tokens": [ids]} or {"text": "..."}, optionally "max_length" (prompt included)
+#                    -> {"tokens": [ids], "text": "...", ...}
+#   POST /attribute  {"tokens": [ids]} or {"text": "..."}
+#                    -> {"ranked": [[domain, perplexity, posterior], ...], ...}
+#   GET  /stats      queue depth, batch sizes and latency percentiles of both endpoints
+# every response also carries the batch it ran in, and its queue and total latency in ms.
+#
+# each endpoint has a queue. a batch starts with the oldest waiting request and takes whatever else
+# arrives within the latency budget (max_delay), up to max_batch_size requests; the generations
+# of a batch decode together in one BatchGenerator. the model runs in a single worker thread,
+# so the event loop keeps accepting requests while a batch runs, and those form the next batch.
+# with --serving_weights the batches run on a WorkerPool instead (see worker_pool.py), one per
+# worker process at a time, and the model is in memory once for all of them.
+
+# asyncio.Task.all_tasks and asyncio.Task.current_task before python 3.7
+all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+asyncio_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+# and asyncio.get_running_loop, inside a coroutine
+get_running_loop = getattr(asyncio, 'get_running_loop', None) or asyncio.get_event_loop
+
+# latencies kept for the percentiles of /stats
+LATENCY_WINDOW = 1000
+
+
+class LatencyStats(object):
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.completed = 0
+        self.failed = 0
+
+    def add_batch(self, size):
+        self.batch_sizes.append(size)
+
+    def add(self, seconds, failed=False):
+        self.latencies.append(seconds)
+        self.completed += 1
+        self.failed += int(failed)
+
+    def summary(self):
+        summary = {'completed': self.completed, 'failed': self.failed,
+                   'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.}
+        if self.latencies:
+            latencies = 1000. * np.array(self.latencies)
+            for percentile in (50, 95, 99):
+                summary['p{}_ms'.format(percentile)] = float(np.percentile(latencies, percentile))
+            summary['max_ms'] = float(latencies.max())
+        return summary
+
+
+class DynamicBatcher(object):
+    # queues the requests of one endpoint and runs them through run_batch(payloads) -> results
+    # in batches, on `executor`, up to `concurrency` batches at a time
+
+    def __init__(self, run_batch, executor, max_batch_size=8, max_delay=0.01, concurrency=1):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue()
+        self.stats = LatencyStats()
+        # requests taken off the queue whose batch hasn't finished
+        self.running = 0
+
+    def depth(self):
+        return self.queue.qsize()
+
+    async def submit(self, payload):
+        # the result of `payload`, once its batch has run, with its batch size and queue time
+        future = get_running_loop().create_future()
+        self.queue.put_nowait((payload, future, time.time()))
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = batch[0][2] + self.max_delay
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        # a batch is only formed once one can start, so requests keep joining it while all slots are busy
+        loop = get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await slots.acquire()
+            batch = await self.next_batch()
+            task = loop.create_task(self.run_one(batch))
+            task.add_done_callback(lambda _: slots.release())
+
+    async def run_one(self, batch):
+        loop = get_running_loop()
+        self.running += len(batch)
+        self.stats.add_batch(len(batch))
+        started = time.time()
+        try:
+            results = await loop.run_in_executor(self.executor, self.run_batch, [item[0] for item in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        self.running -= len(batch)
+        for (_, future, enqueued), result in zip(batch, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result((result, len(batch), started - enqueued))
+
+
+class InferenceService(object):
+    # the model side of the server: batches of requests in, batches of results out, on one thread
+    #
+    # tokenize(text) -> token ids is optional; without it requests have to send token ids.
+    # domains is a list of (domain, prior) pairs with the token ids of their tags in domain_texts,
+    # without them /attribute is not available.
+
+    def __init__(self, encoder, tied_embedding_softmax, sampler, idx2word, seq_length, max_length=None,
+                 decode_step=None, tokenize=None, domains=None, domain_texts=None, attribution_batch_size=8):
+        self.sampler = sampler
+        self.seq_length = seq_length
+        self.max_length = max_length or seq_length
+        self.tokenize = tokenize
+        self.generator = BatchGenerator(encoder, tied_embedding_softmax, decode_step)
+        self.detokenizer = Detokenizer(idx2word)
+        self.vocab_size = len(idx2word)
+
+        self.domain_scorer = None
+        if domains:
+            # the same layers behind an input of any width, scoring in length buckets like source_atttribution.py
+            tokens = tf.keras.layers.Input(shape=(None,), dtype='int32')
+            logits = tied_embedding_softmax(encoder(tied_embedding_softmax(tokens, embed=True), training=False),
+                                            embed=False)
+            score_model = tf.keras.Model(inputs=tokens, outputs=NextTokenLogProbs()([logits, tokens]))
+            self.score_fn = BucketedModel(score_model, seq_length)
+            self.domain_scorer = DomainScorer(domains, domain_texts, seq_length, make_buckets(seq_length))
+            self.attribution_batch_size = attribution_batch_size
+
+    def prompt(self, payload):
+        # the token ids of a request
+        if 'tokens' in payload:
+            tokens = [int(token) for token in payload['tokens']]
+        elif 'text' in payload and self.tokenize is not None:
+            tokens = self.tokenize(payload['text'])
+        else:
+            raise ValueError('a request needs "tokens"' + (' or "text"' if self.tokenize else ''))
+        if len(tokens) == 0 or len(tokens) >= self.seq_length:
+            raise ValueError('a prompt needs 1 to {} tokens, not {}'.format(self.seq_length - 1, len(tokens)))
+        if min(tokens) < 0 or max(tokens) >= self.vocab_size:
+            raise ValueError('token ids must be below {}'.format(self.vocab_size))
+        return tokens
+
+    def max_length_of(self, payload, prompt):
+        max_length = int(payload.get('max_length', self.max_length))
+        return max(len(prompt) + 1, min(max_length, self.seq_length))
+
+    def run_requests(self, run, payloads):
+        # the prompts of a batch are checked one by one, so a bad request only fails itself
+        results = [None] * len(payloads)
+        valid = []
+        for i, payload in enumerate(payloads):
+            try:
+                valid.append((i, self.prompt(payload)))
+            except (ValueError, KeyError, TypeError) as e:
+                results[i] = ValueError(str(e))
+        if valid:
+            for (i, _), result in zip(valid, run([payloads[i] for i, _ in valid], [prompt for _, prompt in valid])):
+                results[i] = result
+        return results
+
+    def generate(self, payloads):
+        return self.run_requests(self.generate_prompts, payloads)
+
+    def generate_prompts(self, payloads, prompts):
+        max_lengths = [self.max_length_of(payload, prompt) for payload, prompt in zip(payloads, prompts)]
+        generated = self.generator.generate(prompts, max_lengths, self.sampler.for_batch(prompts))
+        return [{'tokens': tokens, 'text': self.detokenizer.decode(tokens)} for tokens in generated]
+
+    def attribute(self, payloads):
+        if self.domain_scorer is None:
+            return [ValueError('this server has no domains to attribute to')] * len(payloads)
+        return self.run_requests(self.attribute_prompts, payloads)
+
+    def attribute_prompts(self, payloads, prompts):
+        # every prompt is scored against all domains, batched over the domains
+        return [{'ranked': [[domain, float(ppl), float(posterior)] for domain, ppl, posterior in
+                            self.domain_scorer.rank(self.score_fn, prompt, self.attribution_batch_size)]}
+                for prompt in prompts]
+
+
+class PooledService(InferenceService):
+    # generation on the worker processes of a WorkerPool, a batch per worker at a time; the prompts
+    # are tokenized here and decoded in the workers. there is no /attribute, the workers only generate
+
+    def __init__(self, pool, seq_length, max_length=None, tokenize=None):
+        self.pool = pool
+        self.seq_length = seq_length
+        self.max_length = max_length or seq_length
+        self.tokenize = tokenize
+        self.vocab_size = pool.vocab_size
+        self.domain_scorer = None
+        self.concurrency = pool.workers
+
+    def generate_prompts(self, payloads, prompts):
+        max_lengths = [self.max_length_of(payload, prompt) for payload, prompt in zip(payloads, prompts)]
+        return [{'tokens': tokens, 'text': text} for tokens, text in self.pool.submit(prompts, max_lengths).result()]
+
+
+class InferenceServer(object):
+
+    def __init__(self, service, max_batch_size=8, max_delay=0.01):
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        # the model is only ever used from one thread, unless the service runs batches elsewhere
+        # (PooledService: one batch per worker process at a time)
+        self.concurrency = getattr(service, 'concurrency', 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.batchers = {}
+        self.loop = None
+        self.server = None
+        self.thread = None
+        # writers of the open connections
+        self.connections = set()
+
+    async def start(self, host='127.0.0.1', port=8000, unix_socket=None):
+        self.loop = get_running_loop()
+        self.batchers = {'/generate': DynamicBatcher(self.service.generate, self.executor, self.max_batch_size,
+                                                     self.max_delay, self.concurrency),
+                         '/attribute': DynamicBatcher(self.service.attribute, self.executor, self.max_batch_size,
+                                                      self.max_delay, self.concurrency)}
+        self.tasks = [self.loop.create_task(batcher.run()) for batcher in self.batchers.values()]
+        if unix_socket:
+            self.server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    def stats(self):
+        stats = {}
+        for path, batcher in self.batchers.items():
+            stats[path.strip('/')] = dict(batcher.stats.summary(), queue_depth=batcher.depth(),
+                                          running=batcher.running)
+        return stats
+
+    async def respond(self, method, path, body):
+        # (status, json response) of one request
+        if path == '/stats' and method == 'GET':
+            return 200, self.stats()
+        if path not in self.batchers:
+            return 404, {'error': 'no such endpoint: {}'.format(path)}
+        if method != 'POST':
+            return 405, {'error': '{} takes POST'.format(path)}
+        started = time.time()
+        batcher = self.batchers[path]
+        try:
+            payload = json.loads(body.decode('utf-8'))
+            if not isinstance(payload, dict):
+                raise ValueError('the request body must be a json object')
+            result, batch_size, queued = await batcher.submit(payload)
+        except ValueError as e:
+            batcher.stats.add(time.time() - started, failed=True)
+            return 400, {'error': str(e)}
+        except Exception as e:
+            batcher.stats.add(time.time() - started, failed=True)
+            return 500, {'error': repr(e)}
+        latency = time.time() - started
+        batcher.stats.add(latency)
+        return 200, dict(result, batch_size=batch_size, queue_ms=1000. * queued, latency_ms=1000. * latency)
+
+    async def handle(self, reader, writer):
+        # one connection, any number of requests on it (keep-alive)
+        self.connections.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                close = headers.get('connection', '').lower() == 'close'
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError
+                except ValueError:
+                    # the end of the body is unknown, so is the start of the next request: answer and hang up
+                    status, response = 400, {'error': 'bad Content-Length: {}'.format(headers['content-length'])}
+                    close = True
+                else:
+                    body = await reader.readexactly(length)
+                    status, response = await self.respond(method, path.split('?')[0], body)
+                data = json.dumps(response).encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n'.format(
+                    status, http.client.responses.get(status, ''), len(data),
+                    'Connection: close\r\n' if close else '').encode('latin-1') + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def shutdown(self):
+        # closes the open connections, lets their handlers finish and stops the batchers
+        for writer in list(self.connections):
+            writer.close()
+        handlers = [task for task in all_tasks(self.loop) if task not in self.tasks and
+                    task is not asyncio_current_task(self.loop)]
+        await asyncio.gather(*handlers, return_exceptions=True)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def serve_forever(self, host='127.0.0.1', port=8000, unix_socket=None):
+        # on a loop of its own, closed when the server stops
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(self.start(host, port, unix_socket))
+        print('serving on {}'.format(unix_socket or '{}:{}'.format(*server.sockets[0].getsockname()[:2])))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.close()
+            loop.run_until_complete(self.shutdown())
+            loop.close()
+            self.executor.shutdown()
+
+    def start_in_thread(self, host='127.0.0.1', port=0, unix_socket=None):
+        # serves from a background thread (for tests and benchmarks) and returns the address once it listens:
+        # (host, port) or the unix socket path
+        started = threading.Event()
+        address = []
+
+        def serve():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            server = loop.run_until_complete(self.start(host, port, unix_socket))
+            address.append(unix_socket or server.sockets[0].getsockname()[:2])
+            started.set()
+            loop.run_forever()
+            server.close()
+            loop.run_until_complete(self.shutdown())
+            loop.close()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        return address[0]
+
+    def stop(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+        self.executor.shutdown()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class Client(object):
+    # a blocking client for one connection; address is (host, port) or a unix socket path
+
+    def __init__(self, address, timeout=None):
+        if isinstance(address, str):
+            self.connection = UnixHTTPConnection(address, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(address[0], address[1], timeout=timeout)
+
+    def request(self, path, payload=None):
+        if payload is None:
+            self.connection.request('GET', path)
+        else:
+            self.connection.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        result = json.loads(response.read().decode('utf-8'))
+        if response.status != 200:
+            raise ValueError('{} {}: {}'.format(response.status, path, result.get('error')))
+        return result
+
+    def generate(self, tokens=None, text=None, max_length=None):
+        payload = {'tokens': tokens} if tokens is not None else {'text': text}
+        if max_length is not None:
+            payload['max_length'] = max_length
+        return self.request('/generate', payload)
+
+    def attribute(self, tokens=None, text=None):
+        return self.request('/attribute', {'tokens': tokens} if tokens is not None else {'text': text})
+
+    def stats(self):
+        return self.request('/stats')
+
+    def close(self):
+        self.connection.close()
+
+
+def tiny_service(num_layers=2, d_model_size=64, num_heads=4, dff=256, vocab_size=1000, seq_length=256,
+                 max_length=64, seed=1337, tokenize=None):
+    # a service around a random-weight model, with made-up vocabulary and domain tags;
+    # token ids only, unless some tokenize(text) -> ids is given
+    tf.random.set_random_seed(seed)
+    tied_embedding_softmax = CTRL.transformer.TiedEmbeddingSoftmax(vocab_size, d_model_size)
+    encoder = CTRL.transformer.Encoder(num_layers=num_layers, d_model_size=d_model_size, num_heads=num_heads,
+                                       dff=dff, max_position=max(seq_length, 512))
+    tied_embedding_softmax(encoder(tied_embedding_softmax(tf.zeros((1, 1), dtype=tf.int32), embed=True),
+                                   training=False), embed=False)
+    idx2word = ['tok%d' % i for i in range(vocab_size)]
+    domains = [(domain, float(count)) for domain, count in sorted(CONTROL_CODES.items())[:16]]
+    domain_texts = [[i % vocab_size] for i in range(len(domains))]
+    return InferenceService(encoder, tied_embedding_softmax, Sampler(idx2word), idx2word, seq_length, max_length,
+                            tokenize=tokenize, domains=domains, domain_texts=domain_texts)
+
+
+def ctrl_service(weights, max_length, precision='fp32', temperature=0., nucleus=0., topk=0, penalty=1.2,
+                 codes='codes', vocab='vocab'):
+    # the full model from a weight file (see weight_store.py), with the vocab and BPE codes of the working directory
+    model = CTRLModel(weights=weights, codes=codes, vocab=vocab, precision=precision).load()
+    encoder, tied_embedding_softmax = model.layers
+    tokenizer = model.tokenizer
+    domains = [(domain, float(count)) for domain, count in sorted(CONTROL_CODES.items())]
+    domain_texts = tokenizer.encode_batch([domain for domain, _ in domains])
+    sampler = Sampler(tokenizer.idx2word, temperature=temperature, nucleus=nucleus, topk=topk, penalty=penalty)
+    return InferenceService(encoder, tied_embedding_softmax, sampler, tokenizer.idx2word, 256, max_length,
+                            tokenize=tokenizer.encode, domains=domains, domain_texts=domain_texts)
+
+
+def pooled_service(serving_weights, max_length, workers=None, threads_per_worker=1, temperature=0., nucleus=0.,
+                   topk=0, penalty=1.2, codes='codes', vocab='vocab', num_heads=16, precision='fp32', shortlist=0,
+                   window=0):
+    # the full model from a serving weight file (see numpy_model.py) on worker processes. the workers run the
+    # fp32 weights of the file over the whole vocabulary and the whole context, so the other precisions,
+    # a shortlist or a sliding window are refused rather than ignored
+    if precision != 'fp32':
+        raise ValueError('the serving weights are fp32, {} needs --weights'.format(precision))
+    if shortlist or window:
+        raise ValueError('the worker pool decodes over the whole vocabulary and context, '
+                         'without a shortlist or a sliding window')
+    pool = WorkerPool(serving_weights, workers, threads_per_worker, num_heads, vocab, temperature, nucleus, topk,
+                      penalty).start()
+    tokenizer = Tokenizer(codes, vocab)
+    return PooledService(pool, 256, max_length, tokenize=tokenizer.encode)
+
+
+if __name__ == '__main__':
+    tf.enable_eager_execution()
+    parser = argparse.ArgumentParser(description='serve CTRL generation and source attribution over HTTP')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='weight file of the model (see weight_store.py); run from the directory with vocab and codes')
+    parser.add_argument('--serving_weights', type=str, default=None,
+                        help='or a serving weight file (see numpy_model.py), to generate on worker processes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes with --serving_weights; one per core by default')
+    parser.add_argument('--threads_per_worker', type=int, default=1,
+                        help='BLAS threads of every worker process')
+    parser.add_argument('--codes', type=str, default='codes',
+                        help='BPE codes file of the model')
+    parser.add_argument('--vocab', type=str, default='vocab',
+                        help='vocab file of the model')
+    parser.add_argument('--tiny', action='store_true',
+                        help='serve a tiny random-weight model instead, token ids only')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='listen on this unix socket instead of a port')
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='most requests run in one batch')
+    parser.add_argument('--max_delay_ms', type=float, default=10.,
+                        help='how long the first request of a batch waits for others to join it')
+    parser.add_argument('--generate_num', type=int, default=64,
+                        help='default length of a generation, prompt included')
+    parser.add_argument('--precision', type=str, default='fp32', choices=CTRL.transformer.PRECISIONS,
+                        help='precision of the weight matrices at inference')
+    parser.add_argument('--temperature', type=float, default=0.,
+                        help='temperature for sampling distribution; 0 means greedy')
+    parser.add_argument('--nucleus', type=float, default=0.,
+                        help='cumulative probability cutoff for nucleus sampling; 0 means no nucleus sampling')
+    parser.add_argument('--topk', type=int, default=0,
+                        help='topk value for sampling from the softmax distribution ; 0 means no topk preferred')
+    parser.add_argument('--penalty', type=float, default=1.2,
+                        help='repetition penalty for greedy sampling')
+    args = parser.parse_args()
+    if not args.weights and not args.serving_weights and not args.tiny:
+        parser.error('one of --weights, --serving_weights or --tiny is required')
+
+    if args.serving_weights and args.precision != 'fp32':
+        parser.error('--serving_weights runs at fp32, --precision {} needs --weights'.format(args.precision))
+
+    if args.tiny:
+        service = tiny_service(max_length=args.generate_num)
+    elif args.serving_weights:
+        service = pooled_service(args.serving_weights, args.generate_num, args.workers, args.threads_per_worker,
+                                 args.temperature, args.nucleus, args.topk, args.penalty, args.codes, args.vocab,
+                                 precision=args.precision)
+    else:
+        service = ctrl_service(args.weights, args.generate_num, args.precision, args.temperature, args.nucleus,
+                               args.topk, args.penalty, args.codes, args.vocab)
+    InferenceServer(service, args.max_batch_size, args.max_delay_ms / 1000.).serve_forever(args.host, args.port,
+                                                                                            args.unix_socket)
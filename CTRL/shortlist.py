@@ -0,0 +1,60 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+
+# picking the next token from a fixed part of the vocabulary
+#
+# every decoding step multiplies the last hidden state with all 246534 embeddings, the biggest
+# matmul of the step. tokens the sampler can never pick (the banned ones, see Sampler) don't need
+# a logit, and a candidate index (e.g. the most frequent pieces: the vocab file is sorted by count)
+# can cut the vocabulary much further. the embeddings of the shortlisted tokens are gathered
+# once into their own projection, so a step only computes len(ids) logits; expand() puts them back
+# into vocabulary order with every other token at the logit of a banned one, so the sampler
+# is used unchanged.
+#
+# without a candidate index only banned tokens are left out, which changes nothing.
+# dropping the disallowed tokens too is exact for greedy decoding (it never picks them) but not
+# for top-k or nucleus sampling, which prune before dropping them. with a candidate index, the next
+# token is the same as long as it would have been one of the candidates.
+
+BANNED_LOGIT = -1e8
+
+
+def shortlist_ids(sampler, candidates=None, drop_disallowed=False):
+    # the sorted token ids a shortlist keeps: the candidates (or the whole vocabulary),
+    # minus the tokens the sampler bans, minus the disallowed ones if asked
+    keep = np.ones(sampler.vocab_size, dtype=bool)
+    if candidates is not None:
+        keep[:] = False
+        keep[np.asarray(candidates, dtype=np.int64)] = True
+    keep[sampler.banned] = False
+    if drop_disallowed:
+        keep &= ~sampler.disallowed
+    return np.flatnonzero(keep)
+
+
+def load_candidates(path):
+    # a candidate index file: a .npy array of token ids, or one token id per line
+    if path.endswith('.npy'):
+        return np.load(path)
+    return np.loadtxt(path, dtype=np.int64, ndmin=1)
+
+
+class Shortlist(object):
+
+    def __init__(self, tied_embedding_softmax, ids, vocab_size):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.vocab_size = vocab_size
+        # the embedding rows of the shortlisted tokens, for compile_decode_step and compile_window_step
+        self.projection = tied_embedding_softmax.shortlist(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def expand(self, logits):
+        # [batch, len(ids)] shortlist logits to [batch, vocab_size] logits for the sampler
+        logits = np.asarray(logits)
+        expanded = np.full((len(logits), self.vocab_size), BANNED_LOGIT, dtype=np.float32)
+        expanded[:, self.ids] = logits
+        return expanded
@@ -6,6 +6,9 @@ import numpy as np
 
 tf.enable_eager_execution()
 import transformer
+from attribution import DomainScorer, NextTokenLogProbs
+from buckets import make_buckets
+from tokenizer import Tokenizer
 import argparse
 import pdb
 import sys
@@ -14,7 +17,6 @@ from collections import Counter
 from tensorflow.python import debug as tf_debug
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import embedding_ops
-import fastBPE
 import platform
 
 use_py3 = platform.python_version()[0] == '3'
@@ -24,27 +26,28 @@ parser.add_argument('--model_dir', type=str, required=True,
                     help='location of model checkpoint')
 parser.add_argument('--seed', type=int, default=1337,
                     help='random seed for TensorFlow, numpy and PythonHash')
+parser.add_argument('--batch_size', type=int, default=8,
+                    help='number of domains scored in one forward pass')
+parser.add_argument('--score_domain_tokens', action='store_true',
+                    help='also score the pieces of multi-token domain tags, not just the prompt')
 
 args = parser.parse_args()
 tf.random.set_random_seed(args.seed)
 os.environ['PYTHONHASHSEED'] = str(args.seed)
 np.random.seed(args.seed)
 
-# load the vocabulary from file
-vocab = open('vocab').read().decode(encoding='utf-8').split('\n') if not use_py3 else open('vocab',
-                                                                                           encoding='utf-8').read().split(
-    '\n')
-vocab = list(map(lambda x: x.split(' ')[0], vocab)) + ['<unk>'] + ['\n']
-print('{} unique words'.format(len(vocab)))
+# load the vocabulary and the BPE codes from file
+tokenizer = Tokenizer('codes', 'vocab')
+print('{} unique words'.format(len(tokenizer)))
 
 # length of the vocabulary
-vocab_size = len(vocab)
+vocab_size = len(tokenizer)
 
 # define the numericalization map
 # idx2word maps the numericalized ID to the word
 # word2idx maps the word to the numericalized ID
-word2idx = {u: i for i, u in enumerate(vocab)}
-idx2word = np.array(vocab)
+word2idx = tokenizer.word2idx
+idx2word = tokenizer.idx2word
 
 # sequence length to use for the transformer
 # the model is trained with a seq_length of 512
@@ -56,35 +59,16 @@ embedding_dim = 1280
 
 
 # Now, we begin defining the model
-# we defer the transformer definition to transformer.py
-# here, we only define the tied softmax layer
-# this layer ties the softmax weights to the input embeddings
-class TiedEmbeddingSoftmax(tf.keras.layers.Layer):
-
-    def __init__(self, vocab_size=vocab_size, embedding_size=embedding_dim, **kwargs):
-        super(TiedEmbeddingSoftmax, self).__init__()
-        self.w = self.add_weight(name='w', shape=(vocab_size, embedding_size),
-                                 initializer='random_normal',
-                                 trainable=True)
-        self.b = self.add_weight(name='b', shape=(vocab_size,),
-                                 initializer='zeros',
-                                 trainable=True)
-
-    def call(self, inputs, embed=True):
-        if embed:
-            dtype = tf.keras.backend.dtype(inputs)
-            if dtype != 'int32' and dtype != 'int64':
-                inputs = math_ops.cast(inputs, 'int32')
-            return embedding_ops.embedding_lookup(self.w, inputs)
-        else:
-            return tf.tensordot(inputs, tf.transpose(self.w), 1) + self.b
+# we defer the transformer definition and the tied softmax layer to transformer.py
+# the tied softmax layer ties the softmax weights to the input embeddings
 
 
 # input for the keras model
-tokens = tf.keras.layers.Input(shape=(seq_length,), dtype='int32')
+# the width is left open so that short prompts are not run through the whole seq_length window
+tokens = tf.keras.layers.Input(shape=(None,), dtype='int32')
 
 # instantiates a tied softmax class
-tied_embedding_softmax = TiedEmbeddingSoftmax()
+tied_embedding_softmax = transformer.TiedEmbeddingSoftmax(vocab_size, embedding_dim)
 
 # embedded tokens, before passing it to the transformer
 embedded = tied_embedding_softmax(tokens, embed=True)
@@ -99,8 +83,12 @@ transformed = transformer.Encoder()(embedded, training=False)
 # and not a lookup
 logits = tied_embedding_softmax(transformed, embed=False)
 
-# finally, define the Keras model with inputs as tokens and outputs as the logits we just computed
-model = tf.keras.Model(inputs=tokens, outputs=logits)
+# the log-probability of every next token, computed inside the model
+# so that the logits over the whole vocabulary never leave it
+token_log_probs = NextTokenLogProbs()([logits, tokens])
+
+# finally, define the Keras model with inputs as tokens and outputs as the next-token log-probabilities
+model = tf.keras.Model(inputs=tokens, outputs=token_log_probs)
 
 
 # the loss function is a simple categorical crossentropy between the logits and the labels
@@ -135,56 +123,41 @@ estimator_model = tf.keras.estimator.model_to_estimator(keras_model=model, confi
 # we now create a serving function from this estimator
 # this enables us to load the model once and easily query it multiple times
 def serving_input_fn():
-    inputs = {'input_1': tf.placeholder(tf.int32, [2, seq_length])}
+    inputs = {'input_1': tf.placeholder(tf.int32, [None, None])}
     return tf.estimator.export.ServingInputReceiver(inputs, inputs)
 
 
 predict_fn = tf.contrib.predictor.from_estimator(estimator_model, serving_input_fn)
 
-# almost there, we now take the user prompt and tokenize with BPE
-# load BPE codes
-bpe = fastBPE.fastBPE('codes', 'vocab')
 
 domains = []
 with open('control_codes.txt', 'r') as f:
     domains = [line.split() for line in f.readlines()]
     domains = [(t[1], float(t[0])) for t in domains]
 
+
+# the domain tags are tokenized once, the prompts are scored after each of them,
+# over the smallest length bucket that fits the longest candidate
+domain_scorer = DomainScorer(domains, tokenizer.encode_batch([domain for domain, _ in domains]),
+                             seq_length, make_buckets(seq_length))
+
+
+# the next-token log-probabilities of a batch of padded token rows
+def score_fn(tokens_generated):
+    return predict_fn({'input_1': tokens_generated})['next_token_log_probs']
+
+
 while True:
     _prompt = raw_input('ENTER PROMPT: ') if not use_py3 else input('ENTER PROMPT: ')
 
-    ppls = {}
-    # loop over all domains and compute perplexity
-    for domain, domain_prior in domains:
-        print(u'computing for domain: {}'.format(domain))
-        # tokenize data and add domain tag to it
-        prompt = domain + u' ' + _prompt
-        split_prompt = bpe.apply([prompt])[0].split()
-
-        # numericalize data and pad to the seq_len dimension
-        text = [word2idx[i] for i in split_prompt]
-        padding_text = text + [0] * (seq_length - len(text))
-        tokens_generated = np.tile(padding_text, (2, 1))
-        output_scores = predict_fn({'input_1': tokens_generated})['tied_embedding_softmax'].squeeze()[0]
-        token_scores = output_scores[:-1]
-
-        # compute the perplexity for this sequence
-        xent = 0
-        for sequence_idx, token_idx in enumerate(text[1:]):
-            token = idx2word[token_idx]
-
-            # compute the probability of this token
-            Z = np.exp(token_scores[sequence_idx]).sum()
-            token_prob = np.exp(token_scores[sequence_idx, token_idx]) / Z
-            xent -= np.log(token_prob) / len(text[1:])
-
-        ppls[domain] = round(np.exp(xent), 6)
-        # print(u'{} ppl = {}'.format(domain, ppls[domain]))
-
-    # sort the domains based on perplexities and print
-    ppls = [(k, v) for k, v in ppls.items()]
-    ppls.sort(key=lambda x: x[1])
+    # tokenize and numericalize the prompt once; fastBPE works word by word,
+    # so the tag followed by the prompt tokenizes the same as `domain + ' ' + prompt`
+    text = tokenizer.encode(_prompt)
+
+    # score all domains in batches of args.batch_size and rank them, priors included
+    print(u'computing for {} domains'.format(len(domains)))
+    ranked = domain_scorer.rank(score_fn, text, args.batch_size, args.score_domain_tokens)
+
     print('PROMPT: {}'.format(_prompt))
-    for t in ppls:
-        domain, ppl = t
-        print(u'{} ppl = {}'.format(domain, ppl))
+    for domain, ppl, posterior in ranked:
+        print(u'{} ppl = {} p(domain | prompt) = {:.4f}'.format(domain, ppl, posterior))
@@ -0,0 +1,158 @@
+from __future__ import division
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+from CTRL.decoding import cache_length, compile_decode_step, empty_cache, truncate_cache
+
+
+# speculative decoding: a small draft model proposes the next k tokens one by one, and the main model
+# scores all of them in a single pass over the key/value cache, instead of one pass per token
+#
+# draft token i is kept with probability min(1, p(token) / q(token)), where q is the distribution the draft
+# sampled it from and p the one the main model gives it, both after the Sampler (temperature, penalty,
+# banned tokens, top-k / nucleus). at the first rejection a token is drawn from max(0, p - q) instead and
+# the rest of the draft is dropped; if all k are kept, the pass also gives the distribution of the token
+# after them, and one more is drawn from it. every token is then distributed exactly as if the main model
+# had sampled it on its own, and every main model pass yields between 1 and k + 1 tokens.
+# greedy decoding (temperature 0) keeps the draft tokens the main model would pick itself, so its output
+# is the same token for token.
+#
+# both models need the same vocabulary; the draft is just an Encoder and TiedEmbeddingSoftmax with
+# fewer / narrower layers. the caches of both models are cut back to the kept tokens after every pass.
+# one sequence at a time, the case where the latency of a pass per token hurts most.
+
+
+def draw(probs, rng):
+    # a token id drawn from a (not necessarily normalized) distribution over the vocabulary
+    cumulative = np.cumsum(probs)
+    return int(min(np.searchsorted(cumulative, rng.random_sample() * cumulative[-1], side='right'),
+                   len(probs) - 1))
+
+
+class SpeculativeStats(object):
+    # draft tokens proposed and kept, passes of each model and tokens generated, over every call
+
+    def __init__(self):
+        self.proposed = 0
+        self.accepted = 0
+        self.main_passes = 0
+        self.draft_passes = 0
+        self.tokens = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.proposed if self.proposed else 0.
+
+    @property
+    def tokens_per_pass(self):
+        # tokens generated per pass of the main model; 1 without speculation
+        return self.tokens / self.main_passes if self.main_passes else 0.
+
+    def summary(self):
+        return {'proposed': self.proposed, 'accepted': self.accepted, 'main_passes': self.main_passes,
+                'draft_passes': self.draft_passes, 'tokens': self.tokens,
+                'acceptance_rate': round(self.acceptance_rate, 4), 'tokens_per_pass': round(self.tokens_per_pass, 4)}
+
+
+class SpeculativeDecoder(object):
+
+    def __init__(self, encoder, tied_embedding_softmax, draft_encoder, draft_tied_embedding_softmax, sampler,
+                 k=4, seed=None, verify_step=None, draft_step=None):
+        vocab_size = int(tied_embedding_softmax.b.shape[0])
+        if int(draft_tied_embedding_softmax.b.shape[0]) != vocab_size:
+            raise ValueError('the draft model has {} tokens but the main model {}'.format(
+                int(draft_tied_embedding_softmax.b.shape[0]), vocab_size))
+        if k < 1:
+            raise ValueError('k must be at least 1, got {}'.format(k))
+        self.encoder = encoder
+        self.draft_encoder = draft_encoder
+        self.sampler = sampler
+        self.k = k
+        self.rng = np.random.RandomState(seed)
+        # the main model scores every position it is given, the draft only needs the last one
+        self.verify_step = verify_step or compile_decode_step(encoder, tied_embedding_softmax, all_positions=True)
+        self.draft_step = draft_step or compile_decode_step(draft_encoder, draft_tied_embedding_softmax)
+        self.stats = SpeculativeStats()
+
+    @staticmethod
+    def run(step, past, tokens):
+        # runs `tokens` (a list) after the cached positions of one sequence
+        start = cache_length(past)
+        return step(tf.constant([tokens], dtype=tf.int32), past,
+                    np.zeros((1, start + len(tokens)), dtype=np.float32),
+                    np.arange(start, start + len(tokens), dtype=np.int32)[np.newaxis])
+
+    def propose(self, generated, past, counts, k):
+        # k draft tokens after `generated` and the distribution each was drawn from;
+        # the draft cache then covers everything up to the last draft token, which isn't run
+        tokens, probs = [], []
+        for i in range(k):
+            logits, past = self.run(self.draft_step, past, (generated + tokens)[cache_length(past):])
+            self.stats.draft_passes += 1
+            prefixes = counts.prefixes(0, tokens)
+            q = self.sampler.probabilities(self.sampler.process(logits.numpy(), prefixes, [i]))[0]
+            tokens.append(draw(q, self.rng))
+            probs.append(q)
+        return tokens, probs, past
+
+    def stream(self, prompt, max_length, stop_tokens=()):
+        # yields the tokens that every main model pass adds after `prompt` (a list of token ids),
+        # until the sequence has max_length tokens or ends with one of stop_tokens
+        max_position = min(self.encoder.max_position, self.draft_encoder.max_position)
+        if max_length > max_position:
+            raise ValueError('the models have {} positions, not {}'.format(max_position, max_length))
+        stop_tokens = set(stop_tokens)
+        generated = list(prompt)
+        counts = self.sampler.new_counts([generated])
+        past = empty_cache(self.encoder, 1)
+        draft_past = empty_cache(self.draft_encoder, 1)
+        while len(generated) < max_length:
+            # the last token is always drawn from the main model, so at most max_length - 1 - len from the draft
+            k = min(self.k, max_length - len(generated) - 1)
+            draft, draft_probs, draft_past = self.propose(generated, draft_past, counts, k) if k > 0 else \
+                ([], [], draft_past)
+            self.stats.proposed += k
+
+            # the main model scores the draft in one pass: row i is the distribution after draft[:i]
+            start = cache_length(past)
+            logits, past = self.run(self.verify_step, past, (generated + draft)[start:])
+            self.stats.main_passes += 1
+            logits = logits.numpy()[0, len(generated) - start - 1:]
+            target = self.sampler.probabilities(
+                self.sampler.process(logits, counts.prefixes(0, draft), range(k + 1)))
+
+            new = []
+            for i, token in enumerate(draft):
+                if self.rng.random_sample() * draft_probs[i][token] >= target[i][token]:
+                    break
+                new.append(token)
+            accepted = len(new)
+            self.stats.accepted += accepted
+            if accepted < k:
+                # rejected: the token comes from the part of p that q doesn't cover
+                residual = np.maximum(target[accepted] - draft_probs[accepted], 0.)
+                new.append(draw(residual if residual.sum() > 0 else target[accepted], self.rng))
+            else:
+                new.append(draw(target[k], self.rng))
+
+            for i, token in enumerate(new):
+                if token in stop_tokens:
+                    new = new[:i + 1]
+                    break
+            generated.extend(new)
+            self.sampler.add(counts, new, [0] * len(new))
+            self.stats.tokens += len(new)
+            # only kept tokens stay cached; the newest one isn't run yet, in either model
+            past = truncate_cache(past, min(cache_length(past), len(generated) - 1))
+            draft_past = truncate_cache(draft_past, min(cache_length(draft_past), len(generated) - 1))
+            yield new
+            if new[-1] in stop_tokens:
+                break
+
+    def generate(self, prompt, max_length, stop_tokens=()):
+        # the token ids of the whole sequence, prompt included
+        generated = list(prompt)
+        for new in self.stream(prompt, max_length, stop_tokens):
+            generated.extend(new)
+        return generated
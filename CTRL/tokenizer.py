@@ -0,0 +1,134 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+import collections
+
+try:
+    from CTRL.vocab_index import open_vocab
+except ImportError:
+    # run from inside CTRL/, like source_atttribution.py
+    from vocab_index import open_vocab
+
+
+# turning BPE pieces back into text
+#
+# the text of a list of pieces is the pieces joined with spaces, with every `@@ ` continuation
+# mark removed (and a trailing `@@`). whether a piece is followed by a space only depends on
+# the piece itself, so the text can be produced one piece at a time: every piece adds
+# a delta that never changes afterwards, and nothing before it is ever looked at again.
+
+CONTINUATION = '@@'
+
+
+class Detokenizer(object):
+
+    def __init__(self, idx2word):
+        self.idx2word = idx2word
+        self.reset()
+
+    def reset(self):
+        # for a new text
+        self.started = False
+        # whether the last piece continues into the next one
+        self.continued = False
+
+    def add(self, token):
+        # the text that token id `token` adds to what came before
+        piece = self.idx2word[token]
+        separator = ' ' if self.started and not self.continued else ''
+        self.started = True
+        self.continued = piece.endswith(CONTINUATION)
+        if self.continued:
+            piece = piece[:-len(CONTINUATION)]
+        return separator + piece
+
+    def decode(self, tokens):
+        # the whole text of a token id list, from a fresh state
+        self.reset()
+        return ''.join([self.add(token) for token in tokens])
+
+
+# text to token ids and back, for whole batches
+#
+# fastBPE splits a text into words and splits every word on its own, so the pieces of a word don't
+# depend on what is around it. the pieces of every word are kept in an LRU cache (control codes,
+# domain tags and recurring keywords are split once), and the words of a batch that aren't cached
+# go to fastBPE in one apply call. pieces are mapped to ids through the hash table of the vocabulary
+# index (see vocab_index.py), and pieces that aren't in the vocabulary become <unk> instead of a KeyError.
+# texts are split into words on any whitespace.
+
+UNK = '<unk>'
+
+# words whose pieces are kept
+CACHE_SIZE = 65536
+
+
+class Tokenizer(object):
+
+    def __init__(self, codes_path='codes', vocab_path='vocab', bpe=None, cache_size=CACHE_SIZE):
+        # bpe is anything with fastBPE's apply(list of texts) -> list of texts; fastBPE itself by default
+        if bpe is None:
+            import fastBPE
+            bpe = fastBPE.fastBPE(codes_path, vocab_path)
+        self.bpe = bpe
+        # the memory-mapped index of the vocab file, built in the cache directory on first use (see vocab_index.py);
+        # idx2word[id] is a piece and word2idx[piece] an id, as with the list and dict it replaces
+        self.vocab = open_vocab(vocab_path)
+        self.idx2word = self.vocab
+        self.word2idx = self.vocab.token_ids
+        self.unk = self.vocab.get(UNK)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.detokenizer = Detokenizer(self.idx2word)
+
+    def __len__(self):
+        return len(self.idx2word)
+
+    def lookup(self, pieces):
+        # the ids of a list of pieces, <unk> for the ones that aren't in the vocabulary
+        return self.vocab.ids(pieces, self.unk)
+
+    def split_words(self, words):
+        # the ids of every distinct word, from the cache or from one apply call and one lookup
+        # for all that aren't in it
+        ids = {}
+        missing = []
+        for word in set(words):
+            if word in self.cache:
+                # most recently used last
+                self.cache.move_to_end(word)
+                ids[word] = self.cache[word]
+            else:
+                missing.append(word)
+        if missing:
+            splits = [split.split() for split in self.bpe.apply(missing)]
+            piece_ids = self.lookup([piece for split in splits for piece in split])
+            ends = np.cumsum([len(split) for split in splits])[:-1]
+            for word, word_ids in zip(missing, np.split(piece_ids, ends)):
+                ids[word] = self.cache[word] = word_ids
+            # only trimmed once every word of this call has its ids, which may be more words than the cache holds
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ids
+
+    def encode_batch(self, texts):
+        # a list of token id lists, one per text
+        texts = [text.split() for text in texts]
+        ids = self.split_words([word for words in texts for word in words])
+        return [np.concatenate([ids[word] for word in words]).tolist() if words else [] for words in texts]
+
+    def encode(self, text):
+        return self.encode_batch([text])[0]
+
+    def decode(self, tokens):
+        # the text of a token id list, as Detokenizer.decode
+        text = ' '.join(self.vocab.pieces(tokens)).replace(CONTINUATION + ' ', '')
+        return text[:-len(CONTINUATION)] if text.endswith(CONTINUATION) else text
+
+    def decode_batch(self, tokens, lengths=None):
+        # the texts of the rows of a token id array (or of a list of lists); lengths cuts off padding
+        if lengths is not None:
+            tokens = [row[:length] for row, length in zip(tokens, lengths)]
+        return [self.decode(row) for row in tokens]
+
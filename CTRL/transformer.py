@@ -1,21 +1,37 @@
 import tensorflow as tf
 import numpy as np
+from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import embedding_ops
+
+try:
+  from CTRL.profiling import profiler
+except ImportError:
+  # run from inside CTRL/, like source_atttribution.py
+  from profiling import profiler
 
 def angle_defn(pos, i, d_model_size):
   angle_rates = 1 / np.power(10000, (2 * (i//2)) / np.float32(d_model_size))
   return pos * angle_rates
 
-def positional_encoding(position, d_model_size):
-  # create the sinusoidal pattern for the positional encoding
-  angle_rads = angle_defn(np.arange(position)[:, np.newaxis], np.arange(d_model_size)[np.newaxis, :], d_model_size)
-  
-  sines = np.sin(angle_rads[:, 0::2])
-  cosines = np.cos(angle_rads[:, 1::2])
-  
-  pos_encoding = tf.cast(np.concatenate([sines, cosines], axis=-1)[np.newaxis, ...], dtype=tf.float32)
-  return pos_encoding 
+# positional encoding tables by (positions, d_model_size), shared by every Encoder
+_pos_encodings = {}
 
+def positional_encoding_table(position, d_model_size):
+  # the sinusoidal pattern as a [position, d_model_size] float32 array, built once per size.
+  # the angle rates only depend on the dimension, so they are computed once and
+  # multiplied out with the positions instead of going through np.power for every entry
+  key = (position, d_model_size)
+  if key not in _pos_encodings:
+    angle_rads = np.outer(np.arange(position), angle_defn(1, np.arange(d_model_size), d_model_size))
+    sines = np.sin(angle_rads[:, 0::2])
+    cosines = np.cos(angle_rads[:, 1::2])
+    _pos_encodings[key] = np.concatenate([sines, cosines], axis=-1).astype(np.float32)
+  return _pos_encodings[key]
 
+def positional_encoding(position, d_model_size):
+  # create the sinusoidal pattern for the positional encoding
+  pos_encoding = tf.cast(positional_encoding_table(position, d_model_size)[np.newaxis, ...], dtype=tf.float32)
+  return pos_encoding
 
 def scaled_dot_product_attention(q, k, v, mask):
   # calculate attention
@@ -31,6 +47,56 @@ def scaled_dot_product_attention(q, k, v, mask):
   output = tf.matmul(attention_weights, v) 
   return output
 
+def biased_attention(q, k, v, bias):
+  # the same with q already scaled by 1/sqrt(depth) and the mask already turned into an additive bias
+  attention_weights = tf.nn.softmax(tf.matmul(q, k, transpose_b=True) + bias, axis=-1)
+  return tf.matmul(attention_weights, v)
+
+# inference precisions of the weight matrices (see Encoder.set_precision):
+# fp16/bf16 store the matrices in half precision and multiply in it, int8 stores them as int8
+# with one float32 scale per output channel and multiplies in float32.
+# layernorms, biases, attention softmax and the residual stream stay float32 in every mode
+PRECISIONS = ('fp32', 'fp16', 'bf16', 'int8')
+HALF_DTYPES = {'fp16': tf.float16, 'bf16': tf.bfloat16}
+
+def quantize_int8(matrix, axis):
+  # symmetric per-channel int8: one scale for every slice along `axis` (the reduced axis is the other one)
+  scale = tf.reduce_max(tf.abs(matrix), axis=1 - axis) / 127.
+  scale = tf.where(scale > 0, scale, tf.ones_like(scale))
+  expanded = scale[tf.newaxis, :] if axis == 1 else scale[:, tf.newaxis]
+  return tf.cast(tf.clip_by_value(tf.round(matrix / expanded), -127., 127.), tf.int8), scale
+
+class InferenceDense(tf.keras.layers.Layer):
+  # a Dense layer made from given weights, for inference only, with its kernel at one of PRECISIONS
+  def __init__(self, kernel, bias, activation=None, precision='fp32'):
+    super(InferenceDense, self).__init__()
+    if precision not in PRECISIONS:
+      raise ValueError('precision must be one of {}, not {}'.format(PRECISIONS, precision))
+    self.precision = precision
+    self.activation = tf.keras.activations.get(activation)
+    if precision == 'int8':
+      kernel, scale = quantize_int8(kernel, axis=1)
+      self.scale = tf.Variable(scale, trainable=False, name='scale')
+    elif precision in HALF_DTYPES:
+      kernel = tf.cast(kernel, HALF_DTYPES[precision])
+    self.kernel = tf.Variable(kernel, trainable=False, name='kernel')
+    self.bias = tf.Variable(bias, trainable=False, name='bias')
+
+  @staticmethod
+  def from_dense(dense, precision):
+    if isinstance(dense, InferenceDense) and dense.precision != 'fp32':
+      raise ValueError('the layer is already at {}'.format(dense.precision))
+    return InferenceDense(dense.kernel, dense.bias, dense.activation, precision)
+
+  def call(self, x):
+    if self.precision == 'int8':
+      y = tf.tensordot(x, tf.cast(self.kernel, tf.float32), 1) * self.scale
+    elif self.precision in HALF_DTYPES:
+      y = tf.cast(tf.tensordot(tf.cast(x, self.kernel.dtype), self.kernel, 1), tf.float32)
+    else:
+      y = tf.tensordot(x, self.kernel, 1)
+    return self.activation(y + self.bias)
+
 class MultiHeadAttention(tf.keras.layers.Layer):
   def __init__(self, d_model_size, num_heads):
     super(MultiHeadAttention, self).__init__()
@@ -44,12 +110,57 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     self.Wv = tf.keras.layers.Dense(d_model_size)
     
     self.dense = tf.keras.layers.Dense(d_model_size)
+    # set by fuse_qkv
+    self.fused = False
+
+  def fuse_qkv(self):
+    # for inference: replaces Wq, Wk and Wv by one projection with their weights side by side,
+    # so every layer does a single matmul and one reshape/transpose for all three;
+    # the 1/sqrt(depth) of the attention logits is folded into the query part.
+    # the weights are loaded (checkpoint or weight store) into the separate layers first
+    scale = 1. / np.sqrt(self.depth)
+    self.Wqkv = InferenceDense(tf.concat([self.Wq.kernel * scale, self.Wk.kernel, self.Wv.kernel], axis=-1),
+                               tf.concat([self.Wq.bias * scale, self.Wk.bias, self.Wv.bias], axis=-1))
+    del self.Wq, self.Wk, self.Wv
+    self.fused = True
+
+  def set_precision(self, precision):
+    # the projections are replaced by InferenceDense layers at `precision`
+    for name in ['Wqkv'] if self.fused else ['Wq', 'Wk', 'Wv']:
+      dense = InferenceDense.from_dense(getattr(self, name), precision)
+      delattr(self, name)
+      setattr(self, name, dense)
+    dense = InferenceDense.from_dense(self.dense, precision)
+    del self.dense
+    self.dense = dense
+
+  def fused_call(self, x, bias, layer_past=None, use_cache=False):
+    # self-attention after fuse_qkv; bias is the additive form of the mask (see Encoder.call)
+    batch_size = tf.shape(x)[0]
+    qkv = self.Wqkv(x)
+    # [batch, seq, 3, heads, depth] -> [3, batch, heads, seq, depth]
+    qkv = tf.transpose(tf.reshape(qkv, (batch_size, -1, 3, self.num_heads, self.depth)), perm=[2, 0, 3, 1, 4])
+    q, k, v = qkv[0], qkv[1], qkv[2]
+
+    if layer_past is not None:
+      past_key, past_value = layer_past
+      k = tf.concat([past_key, k], axis=-2)
+      v = tf.concat([past_value, v], axis=-2)
+
+    scaled_attention = tf.transpose(biased_attention(q, k, v, bias), perm=[0, 2, 1, 3])
+    output = self.dense(tf.reshape(scaled_attention, (batch_size, -1, self.d_model_size)))
+
+    if use_cache:
+      return output, (k, v)
+    return output
         
   def split_into_heads(self, x, batch_size):
     x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
     return tf.transpose(x, perm=[0, 2, 1, 3])
     
-  def call(self, v, k, q, mask):
+  def call(self, v, k, q, mask, layer_past=None, use_cache=False):
+    if self.fused:
+      return self.fused_call(q, mask, layer_past=layer_past, use_cache=use_cache)
     batch_size = tf.shape(q)[0]
     
     q = self.Wq(q)
@@ -59,11 +170,20 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     q = self.split_into_heads(q, batch_size)
     k = self.split_into_heads(k, batch_size)
     v = self.split_into_heads(v, batch_size)
+
+    # in decode mode the keys and values of the earlier positions come from the cache
+    # so only the newest positions have to go through the projections
+    if layer_past is not None:
+      past_key, past_value = layer_past
+      k = tf.concat([past_key, k], axis=-2)
+      v = tf.concat([past_value, v], axis=-2)
     
     scaled_attention = tf.transpose(scaled_dot_product_attention(q, k, v, mask), perm=[0, 2, 1, 3])
     original_size_attention = tf.reshape(scaled_attention,  (batch_size, -1, self.d_model_size))
     output = self.dense(original_size_attention) 
-        
+
+    if use_cache:
+      return output, (k, v)
     return output
 
 
@@ -86,9 +206,18 @@ class EncoderLayer(tf.keras.layers.Layer):
     self.dropout1 = tf.keras.layers.Dropout(rate)
     self.dropout2 = tf.keras.layers.Dropout(rate)
     
-  def call(self, x, training, mask):
+  def set_precision(self, precision):
+    self.multi_head_attention.set_precision(precision)
+    layers = [InferenceDense.from_dense(dense, precision) for dense in self.ffn.layers]
+    del self.ffn
+    self.ffn = tf.keras.Sequential(layers)
+
+  def call(self, x, training, mask, layer_past=None, use_cache=False):
     normed = self.layernorm1(x)
-    attn_output  = self.multi_head_attention(normed, normed, normed, mask)
+    attn_output  = self.multi_head_attention(normed, normed, normed, mask,
+                                             layer_past=layer_past, use_cache=use_cache)
+    if use_cache:
+      attn_output, present = attn_output
     attn_output = self.dropout1(attn_output, training=training)
     out1 = x + attn_output
 
@@ -96,7 +225,9 @@ class EncoderLayer(tf.keras.layers.Layer):
     ffn_output = self.ffn(out2)
     ffn_output = self.dropout2(ffn_output, training=training)
     out2 = out1 + ffn_output
-    
+
+    if use_cache:
+      return out2, present
     return out2
 
 
@@ -104,16 +235,26 @@ class EncoderLayer(tf.keras.layers.Layer):
 
 class Encoder(tf.keras.layers.Layer):
   def __init__(self, num_layers=48, d_model_size=1280, num_heads=16, dff=8192, input_vocab_size=50000,
-               rate=0.1, **kwargs):
+               rate=0.1, max_position=512, **kwargs):
+    # max_position is the number of positions the encoder can be run on (the model is trained with 512);
+    # input_vocab_size used to size the positional encoding (50000 positions, 256MB) and is no longer used
     super(Encoder, self).__init__()
 
     self.d_model_size = d_model_size
     self.num_layers = num_layers
-    
-    self.pos_encoding = positional_encoding(input_vocab_size, self.d_model_size)
+    self.max_position = max_position
+    # built on first use, see the pos_encoding property
+    self._pos_encoding = None
+    # causal masks by length, see causal_mask
+    self.masks = {}
+    # set by fuse_qkv and set_precision
+    self.fused = False
+    self.precision = 'fp32'
 
     for i in range(num_layers):
       setattr(self, "layer%i" % i, EncoderLayer(d_model_size, num_heads, dff, rate))
+    # profiler stage of every layer
+    self.stage_names = ["encoder.layer%i" % i for i in range(num_layers)]
     
     self.layernorm = tf.keras.layers.LayerNormalization(epsilon=1e-6)  
     self.dropout = tf.keras.layers.Dropout(rate)
@@ -122,17 +263,162 @@ class Encoder(tf.keras.layers.Layer):
     base_config = super(Encoder, self).get_config()
     return base_config
   
-  def call(self, x, training):
+  @property
+  def pos_encoding(self):
+    if self._pos_encoding is None:
+      # outside of whatever graph is being traced, since it is kept for every later call
+      with tf.init_scope():
+        self._pos_encoding = positional_encoding(self.max_position, self.d_model_size)
+    return self._pos_encoding
+
+  def fuse_qkv(self):
+    # fuses the attention projections of every layer (see MultiHeadAttention.fuse_qkv);
+    # the layers then get the mask as an additive bias, computed once per call instead of once per layer
+    for i in range(self.num_layers):
+      getattr(self, "layer%i" % i).multi_head_attention.fuse_qkv()
+    self.masks = {}
+    self.fused = True
+
+  def set_precision(self, precision):
+    # for inference: converts the weight matrices of every layer to `precision` (one of PRECISIONS),
+    # after the weights are loaded and after fuse_qkv if that is used; it can only be done once
+    if self.precision != 'fp32':
+      raise ValueError('the encoder is already at {}'.format(self.precision))
+    for i in range(self.num_layers):
+      getattr(self, "layer%i" % i).set_precision(precision)
+    self.precision = precision
+
+  def causal_mask(self, seq_len):
+    # the mask of a static length is built once and kept, so every call (and every traced graph)
+    # of that length reuses it; with length buckets there are only a handful of them
+    if seq_len not in self.masks:
+      mask = np.triu(np.ones((seq_len, seq_len), dtype=np.float32), 1)
+      self.masks[seq_len] = mask * -1e9 if self.fused else mask
+    return self.masks[seq_len]
+
+  def call(self, x, training, past=None, use_cache=False, padding_mask=None, position_ids=None):
+    # `past` holds one (key, value) pair per layer from an earlier call with use_cache=True;
+    # `x` then only contains the positions that come after the cached ones
+    # for batches of left-padded rows, `padding_mask` is 1 at the padding of each row
+    # (over the cached and the new positions) and `position_ids` numbers every row from its first real token
 
     seq_len = tf.shape(x)[1]
+    past_len = 0 if past is None else tf.shape(past[0][0])[-2]
     
-    mask = 1 - tf.linalg.band_part(tf.ones((seq_len, seq_len)), -1, 0)
+    # each new position can see every cached position and the new positions up to itself
+    static_len = tf.compat.dimension_value(x.shape[1])
+    if past is None and static_len is not None and padding_mask is None:
+      # already in the form the layers take
+      mask = tf.constant(self.causal_mask(static_len))
+    else:
+      mask = 1 - tf.linalg.band_part(tf.ones((seq_len, past_len + seq_len)), -1, past_len)
+      if padding_mask is not None:
+        mask = tf.maximum(mask, padding_mask[:, tf.newaxis, tf.newaxis, :])
+      if self.fused:
+        mask *= -1e9
     
     x *= tf.math.sqrt(tf.cast(self.d_model_size, tf.float32))
-    x += self.pos_encoding[:, :seq_len, :]
+    if position_ids is None:
+      x += self.pos_encoding[:, past_len:past_len + seq_len, :]
+    else:
+      x += tf.gather(self.pos_encoding[0], position_ids)
 
     x = self.dropout(x, training=training)
     
+    presents = []
     for i in range(self.num_layers):
-      x = getattr(self, "layer%i" % i)(x, training, mask)
+      layer = getattr(self, "layer%i" % i)
+      with profiler.stage(self.stage_names[i]):
+        if use_cache:
+          x, present = layer(x, training, mask, layer_past=None if past is None else past[i], use_cache=True)
+          presents.append(present)
+        else:
+          x = layer(x, training, mask)
+
+    if use_cache:
+      return self.layernorm(x), presents
     return self.layernorm(x)
+
+
+# the softmax weights are tied to the input embeddings,
+# so the same layer does the embedding lookup and the output projection
+def tied_matmul(inputs, w):
+  # inputs [..., d] times the transpose of w [vocab, d], without materializing the transposed copy of w
+  if inputs.shape.ndims == 2:
+    return tf.matmul(inputs, w, transpose_b=True)
+  shape = tf.shape(inputs)
+  logits = tf.matmul(tf.reshape(inputs, [-1, shape[-1]]), w, transpose_b=True)
+  logits = tf.reshape(logits, tf.concat([shape[:-1], tf.shape(w)[:1]], axis=0))
+  logits.set_shape(inputs.shape[:-1].concatenate(w.shape[:1]))
+  return logits
+
+class TiedEmbeddingSoftmax(tf.keras.layers.Layer):
+
+  def __init__(self, vocab_size, embedding_size=1280, **kwargs):
+    super(TiedEmbeddingSoftmax, self).__init__()
+    self.embedding_size = embedding_size
+    self.w = self.add_weight(name='w', shape=(vocab_size, embedding_size), dtype=tf.float32,
+                             initializer='random_normal',
+                             trainable=True)
+    self.b = self.add_weight(name='b', shape=(vocab_size,), dtype=tf.float32,
+                             initializer='zeros',
+                             trainable=True)
+    self.precision = 'fp32'
+
+  # vocabulary rows per matmul of the int8 projection, so the dequantized matrix is never whole
+  INT8_ROWS = 16384
+
+  def set_precision(self, precision):
+    # like Encoder.set_precision; for int8 every vocabulary row gets its own scale
+    if precision not in PRECISIONS:
+      raise ValueError('precision must be one of {}, not {}'.format(PRECISIONS, precision))
+    if self.precision != 'fp32':
+      raise ValueError('the embedding is already at {}'.format(self.precision))
+    if precision == 'fp32':
+      return
+    if precision == 'int8':
+      w, scale = quantize_int8(self.w, axis=0)
+      self.w_scale = tf.Variable(scale, trainable=False, name='w_scale')
+    else:
+      w = tf.cast(self.w, HALF_DTYPES[precision])
+    del self.w
+    self.w_low = tf.Variable(w, trainable=False, name='w_low')
+    self.precision = precision
+
+  def rows(self, ids):
+    # the float32 embeddings of token ids, at any precision
+    if self.precision == 'fp32':
+      return embedding_ops.embedding_lookup(self.w, ids)
+    rows = tf.cast(embedding_ops.embedding_lookup(self.w_low, ids), tf.float32)
+    if self.precision == 'int8':
+      rows *= tf.expand_dims(tf.gather(self.w_scale, ids), -1)
+    return rows
+
+  def shortlist(self, ids):
+    # a projection onto the token ids `ids` only: a TiedEmbeddingSoftmax whose row i is row ids[i] of this one,
+    # at the same precision (the int8 scales are per row, so they come out the same)
+    ids = tf.constant(ids, dtype=tf.int32)
+    shortlist = TiedEmbeddingSoftmax(int(ids.shape[0]), self.embedding_size)
+    shortlist.w.assign(self.rows(ids))
+    shortlist.b.assign(tf.gather(self.b, ids))
+    shortlist.set_precision(self.precision)
+    return shortlist
+
+  def call(self, inputs, embed=True):
+    if embed:
+      dtype = tf.keras.backend.dtype(inputs)
+      if dtype != 'int32' and dtype != 'int64':
+        inputs = math_ops.cast(inputs, 'int32')
+      return self.rows(inputs)
+    elif self.precision == 'fp32':
+      return tied_matmul(inputs, self.w) + self.b
+    elif self.precision == 'int8':
+      vocab_size = int(self.w_low.shape[0])
+      logits = [tied_matmul(inputs, tf.cast(self.w_low[start:start + self.INT8_ROWS], tf.float32))
+                * self.w_scale[start:start + self.INT8_ROWS]
+                for start in range(0, vocab_size, self.INT8_ROWS)]
+      return tf.concat(logits, axis=-1) + self.b
+    else:
+      logits = tied_matmul(tf.cast(inputs, self.w_low.dtype), self.w_low)
+      return tf.cast(logits, tf.float32) + self.b
+
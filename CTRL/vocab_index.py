@@ -0,0 +1,296 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+import argparse
+import hashlib
+import io
+import json
+import mmap
+import os
+import tempfile
+import zlib
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# a flat, memory-mapped vocabulary
+#
+# the scripts used to parse the vocab text file at start-up into a list, a dict of ~250k strings
+# and a unicode array of 246534 x 72 characters (68MB), in every process. here it is converted once
+# into a file that is mapped instead: the pieces as one utf-8 blob with an offsets array
+# (id -> piece is a slice of the blob) and an open-addressing hash table of the ids
+# (piece -> id is a crc32 and usually one probe). nothing is parsed when it is opened,
+# and the pages are read on demand and shared by every process that maps the file.
+#
+# layout: 8 byte magic, 8 byte little-endian header size, the json header, and then the offsets
+# (count + 1 little-endian uint32), the blob and the table (table_size uint32, 0 for an empty slot and
+# id + 1 otherwise), each starting on an ALIGNMENT byte boundary
+#
+# open_vocab keeps the index of a vocab file in a cache directory ($CTRL_CACHE_DIR, or ctrl/ in the user's
+# cache directory), not next to the vocab file, which may be read-only; if it can't be written there
+# either, the index is built in memory.
+
+MAGIC = b'CTRLVOC1'
+ALIGNMENT = 64
+
+
+def aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def load_vocab_text(vocab_path):
+    # the vocabulary of generation.py: the pieces of the vocab file, then <unk> and the newline
+    with io.open(vocab_path, encoding='utf-8') as f:
+        vocab = f.read().split('\n')
+    return [line.split(' ')[0] for line in vocab] + ['<unk>', '\n']
+
+
+def piece_hash(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def vocab_index_bytes(pieces):
+    encoded = [piece.encode('utf-8') for piece in pieces]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+    offsets[1:] = np.cumsum([len(data) for data in encoded])
+    # a power of two with at most half of it in use
+    table_size = 1
+    while table_size < 2 * len(encoded):
+        table_size *= 2
+    table = np.zeros(table_size, dtype='<u4')
+    # a piece that occurs twice maps to its last id, like a dict built over the list
+    last = dict((data, i) for i, data in enumerate(encoded))
+    for data, i in sorted(last.items(), key=lambda item: item[1]):
+        slot = piece_hash(data) & (table_size - 1)
+        while table[slot]:
+            slot = (slot + 1) & (table_size - 1)
+        table[slot] = i + 1
+
+    sections = [('offsets', offsets.tobytes()), ('blob', b''.join(encoded)), ('table', table.tobytes())]
+    section_offsets = {}
+    position = 0
+    for name, data in sections:
+        section_offsets[name] = {'offset': position, 'nbytes': len(data)}
+        position += aligned(len(data))
+    header = json.dumps({'count': len(encoded), 'table_size': table_size, 'alignment': ALIGNMENT,
+                         'sections': section_offsets}).encode('utf-8')
+    data_start = aligned(len(MAGIC) + 8 + len(header))
+    index = bytearray(data_start + position)
+    index[:len(MAGIC) + 8 + len(header)] = MAGIC + np.array(len(header), dtype='<u8').tobytes() + header
+    for name, data in sections:
+        start = data_start + section_offsets[name]['offset']
+        index[start:start + len(data)] = data
+    return bytes(index)
+
+
+def write_vocab_index(path, pieces):
+    data = vocab_index_bytes(pieces)
+    # written next to the final file and moved into place, so a reader never maps half of one
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class VocabIndex(object):
+    # read-only, memory-mapped vocabulary; indexing with an id (or an array of ids) gives the piece(s),
+    # get/ids go the other way. with data (the bytes of an index) instead of a path, it works on those
+
+    def __init__(self, path=None, data=None):
+        self.path = path
+        if data is None:
+            self.file = open(path, 'rb')
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.file = None
+            self.buffer = data
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a CTRL vocabulary index'.format(path or 'data'))
+        header_size = int(np.frombuffer(self.buffer, dtype='<u8', count=1, offset=len(MAGIC))[0])
+        header = json.loads(self.buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_size].decode('utf-8'))
+        data_start = aligned(len(MAGIC) + 8 + header_size)
+        sections = header['sections']
+        self.count = header['count']
+        self.mask = header['table_size'] - 1
+        self.offsets = np.frombuffer(self.buffer, dtype='<u4', count=self.count + 1,
+                                     offset=data_start + sections['offsets']['offset'])
+        self.blob_start = data_start + sections['blob']['offset']
+        self.blob = np.frombuffer(self.buffer, dtype=np.uint8, count=int(self.offsets[-1]), offset=self.blob_start)
+        self.table = np.frombuffer(self.buffer, dtype='<u4', count=header['table_size'],
+                                   offset=data_start + sections['table']['offset'])
+        self.token_ids = TokenIds(self)
+
+    def __len__(self):
+        return self.count
+
+    def piece_bytes(self, i):
+        return self.buffer[self.blob_start + int(self.offsets[i]):self.blob_start + int(self.offsets[i + 1])]
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            if not -self.count <= i < self.count:
+                raise IndexError('id {} is not in a vocabulary of {}'.format(i, self.count))
+            return self.piece_bytes(i % self.count).decode('utf-8')
+        if isinstance(i, slice):
+            return self.pieces(np.arange(self.count)[i])
+        return self.pieces(i)
+
+    def pieces(self, ids):
+        return [self[int(i)] for i in np.asarray(ids).ravel()]
+
+    def get(self, piece, default=None):
+        data = piece.encode('utf-8')
+        slot = piece_hash(data) & self.mask
+        while True:
+            entry = int(self.table[slot])
+            if entry == 0:
+                return default
+            if self.piece_bytes(entry - 1) == data:
+                return entry - 1
+            slot = (slot + 1) & self.mask
+
+    def __contains__(self, piece):
+        return self.get(piece) is not None
+
+    def ids(self, pieces, default):
+        # the ids of a list of pieces, default for the ones that aren't in the vocabulary, as get does for one.
+        # only the encoding and the crc32 are per piece; the probes of all pieces are done together
+        encoded = [piece.encode('utf-8') for piece in pieces]
+        ids = np.full(len(encoded), default, dtype=np.int64)
+        if not encoded:
+            return ids
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        starts = np.cumsum(lengths) - lengths
+        query = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        # piece_hash without its mask, which the table mask makes redundant
+        slots = np.fromiter(map(zlib.crc32, encoded), dtype=np.int64, count=len(encoded)) & self.mask
+        pending = np.arange(len(encoded))
+        while len(pending):
+            entries = self.table[slots[pending]].astype(np.int64)
+            # an empty slot ends the probe: the piece isn't in the vocabulary
+            filled = entries > 0
+            pending, entries = pending[filled], entries[filled] - 1
+            found = self.equal(entries, query, starts[pending], lengths[pending])
+            ids[pending[found]] = entries[found]
+            pending = pending[~found]
+            slots[pending] = (slots[pending] + 1) & self.mask
+        return ids
+
+    def equal(self, entries, query, starts, lengths):
+        # whether the pieces of ids `entries` are the byte strings query[starts:starts + lengths], all compared at once
+        piece_starts = self.offsets[entries].astype(np.int64)
+        same = self.offsets[entries + 1].astype(np.int64) - piece_starts == lengths
+        candidates = np.flatnonzero(same)
+        count = lengths[candidates]
+        if count.sum() == 0:
+            return same
+        # every byte of every candidate with the same length, and which candidate it belongs to
+        owner = np.repeat(np.arange(len(candidates)), count)
+        within = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        differ = self.blob[piece_starts[candidates][owner] + within] != query[starts[candidates][owner] + within]
+        same[candidates[np.bincount(owner[differ], minlength=len(candidates)) > 0]] = False
+        return same
+
+    def find(self, substring):
+        # which pieces contain substring, as a boolean array over the ids
+        data = substring.encode('utf-8')
+        blob = self.buffer[self.blob_start:self.blob_start + int(self.offsets[-1])]
+        found = np.zeros(self.count, dtype=bool)
+        position = blob.find(data)
+        while position >= 0:
+            i = int(np.searchsorted(self.offsets, position, side='right')) - 1
+            # a match across two pieces doesn't count
+            if position + len(data) <= self.offsets[i + 1]:
+                found[i] = True
+            position = blob.find(data, position + 1)
+        return found
+
+    def to_list(self):
+        return self.pieces(np.arange(self.count))
+
+    def close(self):
+        # nothing handed out refers to the mapping, the pieces are copied out
+        self.offsets = self.table = self.blob = None
+        if self.file is not None:
+            self.buffer.close()
+            self.file.close()
+
+
+class TokenIds(Mapping):
+    # piece -> id view of a VocabIndex, for code that expects word2idx
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, piece):
+        i = self.index.get(piece)
+        if i is None:
+            raise KeyError(piece)
+        return i
+
+    def get(self, piece, default=None):
+        return self.index.get(piece, default)
+
+    def __contains__(self, piece):
+        return piece in self.index
+
+    def __iter__(self):
+        return iter(self.index.to_list())
+
+    def __len__(self):
+        return len(self.index)
+
+
+def index_path(vocab_path):
+    return vocab_path + '.idx'
+
+
+def cache_directory():
+    return os.environ.get('CTRL_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'ctrl')
+
+
+def cached_index_path(vocab_path):
+    # one index per vocab file, named after its absolute path
+    name = hashlib.sha1(os.path.abspath(vocab_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_directory(), 'vocab-{}.idx'.format(name))
+
+
+def open_vocab(vocab_path, index=None):
+    # the index of a vocab text file, kept at `index` (the cache directory by default) and built there the first
+    # time, or when the text file is newer; a vocab_path that is an index already is just opened
+    with open(vocab_path, 'rb') as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            return VocabIndex(vocab_path)
+    path = index or cached_index_path(vocab_path)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(vocab_path):
+        pieces = load_vocab_text(vocab_path)
+        try:
+            directory = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            write_vocab_index(path, pieces)
+        except (IOError, OSError):
+            # nowhere to write it: the same index, in this process only
+            return VocabIndex(data=vocab_index_bytes(pieces))
+    return VocabIndex(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert a vocab file into a memory-mapped vocabulary index')
+    parser.add_argument('--vocab', type=str, default='vocab',
+                        help='vocab text file, as for fastBPE')
+    parser.add_argument('--out', type=str, default=None,
+                        help='index to write; the vocab file name + .idx by default')
+    args = parser.parse_args()
+    out = args.out or index_path(args.vocab)
+    write_vocab_index(out, load_vocab_text(args.vocab))
+    print('wrote {}'.format(out))
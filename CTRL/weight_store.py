@@ -0,0 +1,213 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+import argparse
+import json
+import mmap
+
+# a flat, memory-mapped weight file for the CTRL model
+#
+# loading from the TensorFlow checkpoint reads every tensor into memory with reader.get_tensor,
+# casts it into another copy and assigns it, for every one of the ~1.6B parameters.
+# the checkpoint is converted once into this file instead; loading then maps it and assigns every
+# variable straight from a zero-copy view of the mapping, one tensor at a time,
+# so the only private copy of the weights is the model's own variables.
+#
+# layout: 8 byte magic, 8 byte little-endian header size, the json header, and then the tensors,
+# each starting on an ALIGNMENT byte boundary. the header lists name, shape, dtype and offset
+# (from the start of the data) of every tensor, in model order: the tied embedding/softmax
+# weights first, then the encoder weights in the order of encoder.trainable_weights
+#
+# reading a weight file doesn't need TensorFlow (see worker_pool.py), so it is only imported by the functions
+# that load into or build a model
+
+MAGIC = b'CTRLWTS1'
+ALIGNMENT = 64
+
+# tensors bigger than this are written into their variable a block of rows at a time
+# (the 246534 x 1280 embedding is 1.2GB), so converting a view into a tensor
+# never holds more than this much extra memory
+CHUNK_BYTES = 16 * 2 ** 20
+
+
+def aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def write_weight_store(path, entries, get_tensor):
+    # entries is a list of (name, shape, dtype) in model order and get_tensor(name) returns the array;
+    # the tensors are fetched and written one at a time, so only one of them is in memory at once
+    tensors = []
+    size = 0
+    for name, shape, dtype in entries:
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        tensors.append({'name': name, 'shape': [int(dim) for dim in shape], 'dtype': dtype.str,
+                        'offset': size, 'nbytes': nbytes})
+        size += aligned(nbytes)
+    header = json.dumps({'alignment': ALIGNMENT, 'tensors': tensors}).encode('utf-8')
+    data_start = aligned(len(MAGIC) + 8 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array(len(header), dtype='<u8').tobytes())
+        f.write(header)
+        for tensor in tensors:
+            array = np.ascontiguousarray(get_tensor(tensor['name']), dtype=tensor['dtype'])
+            if list(array.shape) != tensor['shape']:
+                raise ValueError('{} has shape {}, expected {}'.format(tensor['name'], array.shape, tensor['shape']))
+            f.seek(data_start + tensor['offset'])
+            f.write(memoryview(array).cast('B'))
+        f.truncate(data_start + size)
+
+
+class WeightStore(object):
+    # read-only, memory-mapped view of a weight file; the arrays it hands out share the mapping,
+    # so the file is paged in on demand and its pages are shared by every process that maps it
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a CTRL weight file'.format(path))
+        header_size = int(np.frombuffer(self.buffer, dtype='<u8', count=1, offset=len(MAGIC))[0])
+        header = json.loads(self.buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_size].decode('utf-8'))
+        self.data_start = aligned(len(MAGIC) + 8 + header_size)
+        self.tensors = header['tensors']
+        self.index = dict((tensor['name'], tensor) for tensor in self.tensors)
+
+    def names(self):
+        return [tensor['name'] for tensor in self.tensors]
+
+    def view(self, tensor):
+        dtype = np.dtype(tensor['dtype'])
+        return np.frombuffer(self.buffer, dtype=dtype, count=tensor['nbytes'] // dtype.itemsize,
+                             offset=self.data_start + tensor['offset']).reshape(tensor['shape'])
+
+    def __getitem__(self, name):
+        return self.view(self.index[name])
+
+    def release(self, tensor, start=0, end=None):
+        # drops bytes [start, end) of a tensor from this process once they have been copied out;
+        # the pages stay in the page cache and a later view just reads them in again
+        if not hasattr(self.buffer, 'madvise'):
+            return
+        end = tensor['nbytes'] if end is None else end
+        first = (self.data_start + tensor['offset'] + start) // mmap.PAGESIZE * mmap.PAGESIZE
+        last = (self.data_start + tensor['offset'] + end) // mmap.PAGESIZE * mmap.PAGESIZE
+        if last > first:
+            self.buffer.madvise(mmap.MADV_DONTNEED, first, last - first)
+
+    def __len__(self):
+        return len(self.tensors)
+
+    def close(self):
+        # the arrays handed out must not be used after this
+        self.buffer.close()
+        self.file.close()
+
+
+def model_weights(tied_embedding_softmax, encoder):
+    # the variables a weight file holds, in the order it holds them
+    return tied_embedding_softmax.trainable_weights + encoder.trainable_weights
+
+
+def save_model_weights(path, tied_embedding_softmax, encoder):
+    variables = model_weights(tied_embedding_softmax, encoder)
+    by_name = dict((variable.name[:-2], variable) for variable in variables)
+    write_weight_store(path, [(variable.name[:-2], variable.shape, variable.dtype.as_numpy_dtype)
+                              for variable in variables],
+                       lambda name: by_name[name].numpy())
+
+
+def load_model_weights(store, tied_embedding_softmax, encoder):
+    # assigns the weights of a (built) model from the store;
+    # the tensors are matched by position, since the variable names depend on how the model was built
+    import tensorflow as tf
+    variables = model_weights(tied_embedding_softmax, encoder)
+    if len(variables) != len(store):
+        raise ValueError('{} holds {} tensors but the model has {} weights'.format(store.path, len(store),
+                                                                                   len(variables)))
+    for variable, tensor in zip(variables, store.tensors):
+        view = store.view(tensor)
+        if tuple(view.shape) != tuple(variable.shape):
+            raise ValueError('{} has shape {} in {} but {} in the model'.format(tensor['name'], view.shape,
+                                                                               store.path, tuple(variable.shape)))
+        dtype = variable.dtype.as_numpy_dtype
+        if tensor['nbytes'] <= CHUNK_BYTES or view.ndim == 0:
+            variable.assign(view.astype(dtype, copy=False))
+            store.release(tensor)
+            continue
+        row_bytes = tensor['nbytes'] // len(view)
+        rows = max(CHUNK_BYTES // row_bytes, 1)
+        for start in range(0, len(view), rows):
+            # the dtype conversion, if any, is only for this block too
+            block = view[start:start + rows].astype(dtype, copy=False)
+            variable.scatter_update(tf.IndexedSlices(block, tf.range(start, start + len(block))))
+            store.release(tensor, start * row_bytes, (start + rows) * row_bytes)
+        store.release(tensor)
+
+
+def checkpoint_variable_names(num_layers, num_heads=16):
+    # the checkpoint names of the model weights, in model order. keras names the encoder variables
+    # by the order in which layers are built, so a model with the same number of layers,
+    # built the same way as in generation.py but tiny, has exactly the names of the full one
+    import tensorflow as tf
+    import CTRL.transformer
+    tf.keras.backend.clear_session()
+    tokens = tf.keras.layers.Input(shape=(1,), dtype='int32')
+    tied_embedding_softmax = CTRL.transformer.TiedEmbeddingSoftmax(1, num_heads)
+    encoder = CTRL.transformer.Encoder(num_layers=num_layers, d_model_size=num_heads, num_heads=num_heads, dff=1,
+                                       max_position=1)
+    tied_embedding_softmax(encoder(tied_embedding_softmax(tokens, embed=True), training=False), embed=False)
+    # the tied weights are stored under their plain names in the checkpoint
+    return ['w', 'b'] + [variable.name[:-2] for variable in encoder.trainable_weights]
+
+
+def checkpoint_dtype(name):
+    # the precision generation.py always loaded a checkpoint tensor at: the embedding / softmax and the layernorms
+    # at fp32, every other encoder weight rounded through fp16
+    return np.float32 if name in ('w', 'b') or 'normalization' in name else np.float16
+
+
+def load_checkpoint_weights(model_path, tied_embedding_softmax, encoder, names):
+    # assigns the weights of a (built) model straight from the checkpoint *data* file, matched by position
+    # with names (checkpoint_variable_names, taken before the model is built: it clears the keras session).
+    # every tensor is read and cast in memory, which is what converting to a weight file saves
+    import tensorflow as tf
+    from tensorflow.python import pywrap_tensorflow
+    reader = pywrap_tensorflow.NewCheckpointReader('.'.join(model_path.split('.')[:-1]))
+    variables = model_weights(tied_embedding_softmax, encoder)
+    if len(variables) != len(names):
+        raise ValueError('{} names for the {} weights of the model'.format(len(names), len(variables)))
+    for variable, name in zip(variables, names):
+        tensor = reader.get_tensor(name).astype(checkpoint_dtype(name), copy=False)
+        variable.assign(tf.cast(tensor, variable.dtype))
+
+
+def convert_checkpoint(model_path, out_path, num_layers=48):
+    # model_path is the checkpoint *data* file, as for generation.py --model_path
+    from tensorflow.python import pywrap_tensorflow
+    reader = pywrap_tensorflow.NewCheckpointReader('.'.join(model_path.split('.')[:-1]))
+    shapes = reader.get_variable_to_shape_map()
+    names = checkpoint_variable_names(num_layers)
+    # at the precision the checkpoint is loaded at, so that both loading paths give the same weights
+    write_weight_store(out_path, [(name, shapes[name], checkpoint_dtype(name)) for name in names],
+                       reader.get_tensor)
+
+
+if __name__ == '__main__':
+    import tensorflow as tf
+    tf.enable_eager_execution()
+    parser = argparse.ArgumentParser(description='convert a CTRL checkpoint into a memory-mapped weight file')
+    parser.add_argument('--model_path', type=str, required=True,
+                        help='location of model *data* checkpoint; this is NOT the directory but rather the model checkpoint')
+    parser.add_argument('--out', type=str, required=True,
+                        help='weight file to write')
+    parser.add_argument('--num_layers', type=int, default=48,
+                        help='number of encoder layers of the checkpoint')
+    args = parser.parse_args()
+    convert_checkpoint(args.model_path, args.out, args.num_layers)
+    print('wrote {}'.format(args.out))
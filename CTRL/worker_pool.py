@@ -0,0 +1,279 @@
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+import argparse
+import binascii
+import multiprocessing
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+from CTRL.numpy_model import NumpyModel
+from CTRL.sampler import Sampler
+from CTRL.tokenizer import Detokenizer
+from CTRL.vocab_index import open_vocab
+
+# generation on every core of a CPU box, with one copy of the weights
+#
+# N worker processes run NumpyModel (see numpy_model.py) on the same serving weight file. each maps it
+# read-only, so the weights are in memory once, in the page cache, however many workers there are;
+# what a worker has of its own is its interpreter, its activations and the key/value cache of its batch.
+# the vocabulary index is mapped the same way. the workers are fresh interpreters
+# (python -m CTRL.worker_pool --worker), not forks, and never import TensorFlow, so nothing of the parent is
+# carried over. each one gets threads_per_worker BLAS threads through the environment it starts with,
+# so that the workers don't oversubscribe the cores.
+#
+# batches of prompts (token ids) go into one queue. every worker has a thread here that hands it the next
+# batch as soon as it is done with the last one, so no batch waits behind a busy worker while another one
+# is idle. results come back as futures; the parent tokenizes, the workers detokenize.
+#
+#   pool = WorkerPool('ctrl.serving', workers=8, vocab='vocab').start()
+#   pool.generate([tokenizer.encode('Links my wallet')], 64)
+#
+# server.py --serving_weights serves the pool over HTTP (see PooledService).
+
+# the thread counts of the BLAS libraries numpy may be built with
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS']
+
+# the worker's connection secret, hex, in its environment
+AUTHKEY_VARIABLE = 'CTRL_WORKER_AUTHKEY'
+
+# seconds a worker has to connect and map the weights
+START_TIMEOUT = 600
+
+
+def memory_usage(pid):
+    # resident, proportional and private MB of a process; the proportional size splits every shared page between
+    # the processes that map it, so it adds up to the memory of a group of processes. {} without /proc
+    usage = {}
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    usage[name] = int(value.split()[0]) / 1024.
+    except (IOError, OSError):
+        return {}
+    return {'rss_mb': usage.get('Rss', 0.), 'pss_mb': usage.get('Pss', 0.),
+            'private_mb': usage.get('Private_Clean', 0.) + usage.get('Private_Dirty', 0.)}
+
+
+def wait_for(ready, process, timeout, what):
+    # polls ready() until it is true, failing if the worker process exits or time runs out
+    deadline = time.time() + timeout
+    while not ready():
+        if process.poll() is not None:
+            raise RuntimeError('the worker exited with status {} before {}'.format(process.returncode, what))
+        if time.time() > deadline:
+            raise RuntimeError('the worker was still {} after {}s'.format(what, timeout))
+
+
+class WorkerPool(object):
+
+    def __init__(self, weights, workers=None, threads_per_worker=1, num_heads=16, vocab=None, temperature=0.,
+                 nucleus=0., topk=0, penalty=1.2, seed=1337, max_batch_size=8):
+        # weights is a serving weight file (see numpy_model.py); vocab the vocab file or its index,
+        # without it the pieces are made up and only the token ids mean anything
+        self.weights = weights
+        self.workers = workers or multiprocessing.cpu_count()
+        self.threads_per_worker = threads_per_worker
+        self.num_heads = num_heads
+        self.vocab = vocab
+        self.sampling = {'temperature': temperature, 'nucleus': nucleus, 'topk': topk, 'penalty': penalty}
+        self.seed = seed
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.processes = []
+        self.threads = []
+        self.lock = threading.Lock()
+        self.worker_stats = []
+        self.vocab_size = None
+        self.listener = None
+
+    def worker_config(self, index):
+        return {'weights': self.weights, 'num_heads': self.num_heads, 'vocab': self.vocab,
+                'sampling': self.sampling, 'seed': self.seed + index}
+
+    def start(self, timeout=START_TIMEOUT):
+        # starts the workers one after the other and returns once all of them have mapped the weights
+        if self.vocab:
+            # builds the vocabulary index here, so that the workers only open it
+            open_vocab(self.vocab).close()
+        authkey = os.urandom(32)
+        self.listener = Listener(authkey=authkey)
+        # accept() gives up every 0.1s, so that a worker that never connects is noticed
+        self.listener._listener._socket.settimeout(0.1)
+        env = dict(os.environ)
+        env[AUTHKEY_VARIABLE] = binascii.hexlify(authkey).decode('ascii')
+        # the workers import CTRL from wherever this module was imported
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        for name in THREAD_VARIABLES:
+            env[name] = str(self.threads_per_worker)
+        try:
+            for index in range(self.workers):
+                process = subprocess.Popen([sys.executable, '-m', 'CTRL.worker_pool', '--worker',
+                                            str(self.listener.address)], env=env)
+                self.processes.append(process)
+                connections = []
+
+                def accept():
+                    try:
+                        connections.append(self.listener.accept())
+                    except socket.timeout:
+                        pass
+                    return connections
+
+                wait_for(accept, process, timeout, 'connecting')
+                connection = connections[0]
+                connection.send(self.worker_config(index))
+                wait_for(lambda: connection.poll(0.1), process, timeout, 'loading the model')
+                status, result = connection.recv()
+                if status != 'ready':
+                    raise RuntimeError('worker {} failed to start: {}'.format(index, result))
+                pid, vocab_size = result
+                if self.vocab_size is not None and vocab_size != self.vocab_size:
+                    raise RuntimeError('worker {} has {} tokens, not {}'.format(index, vocab_size, self.vocab_size))
+                self.vocab_size = vocab_size
+                self.worker_stats.append({'pid': pid, 'batches': 0, 'requests': 0, 'tokens': 0, 'busy_s': 0.})
+                thread = threading.Thread(target=self.dispatch, args=(index, connection))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def dispatch(self, index, connection):
+        # feeds one worker: the next batch of the queue as soon as it is done with the last one
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            prompts, max_lengths, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                connection.send((prompts, max_lengths))
+                status, result, seconds = connection.recv()
+            except (EOFError, IOError, OSError) as e:
+                # the worker is gone; the others keep taking batches
+                future.set_exception(RuntimeError('worker {} failed: {!r}'.format(index, e)))
+                break
+            with self.lock:
+                stats = self.worker_stats[index]
+                stats['batches'] += 1
+                stats['requests'] += len(prompts)
+                stats['busy_s'] += seconds
+                if status == 'done':
+                    stats['tokens'] += sum(len(tokens) - len(prompt) for (tokens, _), prompt in zip(result, prompts))
+            if status == 'done':
+                future.set_result(result)
+            elif status == 'invalid':
+                future.set_exception(ValueError(result))
+            else:
+                future.set_exception(RuntimeError(result))
+        connection.close()
+
+    def submit(self, prompts, max_lengths):
+        # a future of the (tokens, text) of every prompt of one batch, decoded together on the next free worker;
+        # prompts are token id lists and max_lengths their lengths with the prompt, or one length for all
+        if not self.threads:
+            raise RuntimeError('the pool is not running')
+        if isinstance(max_lengths, int):
+            max_lengths = [max_lengths] * len(prompts)
+        future = Future()
+        self.queue.put(([list(map(int, prompt)) for prompt in prompts], [int(length) for length in max_lengths],
+                        future))
+        return future
+
+    def generate(self, prompts, max_lengths):
+        # the (tokens, text) of every prompt, in batches of at most max_batch_size spread over the workers
+        if isinstance(max_lengths, int):
+            max_lengths = [max_lengths] * len(prompts)
+        size = max(1, min(self.max_batch_size, -(-len(prompts) // self.workers)))
+        futures = [self.submit(prompts[start:start + size], max_lengths[start:start + size])
+                   for start in range(0, len(prompts), size)]
+        return [result for future in futures for result in future.result()]
+
+    def summary(self):
+        # what every worker did and how much memory it holds, and the totals; the weights are shared,
+        # so the workers' proportional sizes add up to about one model plus their private memory
+        with self.lock:
+            workers = [dict(stats) for stats in self.worker_stats]
+        for stats in workers:
+            stats.update(memory_usage(stats['pid']))
+        total = {'workers': len(workers), 'queue_depth': self.queue.qsize(),
+                 'tokens': sum(stats['tokens'] for stats in workers)}
+        for key in ('pss_mb', 'private_mb'):
+            total[key] = sum(stats.get(key, 0.) for stats in workers)
+        return {'workers': workers, 'total': total}
+
+    def close(self, timeout=10.):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        # first, so that a worker that connected but was never accepted gets a closed connection and exits
+        if self.listener is not None:
+            self.listener.close()
+        for process in self.processes:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.threads, self.processes, self.listener = [], [], None
+
+
+def serve_worker(address, authkey):
+    # the loop of a worker process: batches of (prompts, max lengths) in, (status, result, seconds) out
+    connection = Client(address, authkey=authkey)
+    config = connection.recv()
+    try:
+        model = NumpyModel(config['weights'], config['num_heads'])
+        idx2word = open_vocab(config['vocab']) if config['vocab'] else ['tok%d' % i for i in range(model.vocab_size)]
+        if len(idx2word) != model.vocab_size:
+            raise ValueError('the vocabulary has {} tokens but the model {}'.format(len(idx2word), model.vocab_size))
+    except Exception as e:
+        connection.send(('failed', repr(e)))
+        return
+    # samples are drawn with numpy, without TensorFlow
+    sampler = Sampler(idx2word, rng=np.random.RandomState(config['seed']), **config['sampling'])
+    detokenizer = Detokenizer(idx2word)
+    connection.send(('ready', (os.getpid(), model.vocab_size)))
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        prompts, max_lengths = message
+        started = time.time()
+        try:
+            generated = model.generate(prompts, max_lengths, sampler.for_batch(prompts))
+            connection.send(('done', [(tokens, detokenizer.decode(tokens)) for tokens in generated],
+                             time.time() - started))
+        except ValueError as e:
+            connection.send(('invalid', str(e), time.time() - started))
+        except Exception as e:
+            connection.send(('failed', repr(e), time.time() - started))
+    connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='a worker process of WorkerPool, which starts it')
+    parser.add_argument('--worker', type=str, required=True,
+                        help='address of the pool to connect to')
+    args = parser.parse_args()
+    serve_worker(args.worker, binascii.unhexlify(os.environ[AUTHKEY_VARIABLE]))
@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os import listdir
+from os.path import join
+
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+
+from depeng.extract_keywords_from_email import (KeywordExtractor, extra_n_top_keywords, extract_keywords_from_files,
+                                                get_extractor, get_stop_words, pre_process, sort_coo)
+from depeng.pipeline import (Pipeline, choose_control_code, email_files, hashed_tokenizer, load_control_codes,
+                             service_generate_batch)
+from depeng.read_email import extract, extract_file, get_email_body_from_directory
+
+# benchmarks for the e-mail side of the pipeline, on copies of the spam/ corpus
+# run from the repository root as `python -m depeng.benchmark <name>`;
+# it exits with 1 if a benchmark doesn't give the same result as the code it replaces
+
+parser = argparse.ArgumentParser(description='benchmarks for depeng')
+parser.add_argument('benchmark', type=str, choices=['ingest', 'keywords', 'pipeline'],
+                    help='which benchmark to run')
+parser.add_argument('--corpus', type=str, default='spam',
+                    help='directory of e-mails the synthetic corpus is copied from')
+parser.add_argument('--emails', type=int, default=10000,
+                    help='number of e-mails in the synthetic corpus')
+parser.add_argument('--processes', type=int, default=0,
+                    help='worker processes for parsing; 0 means one per cpu')
+parser.add_argument('--stop_file', type=str, default='depeng/resources/stopwords.txt',
+                    help='stop words for keyword extraction')
+parser.add_argument('--targets', type=int, default=10,
+                    help='number of target e-mails the per-target refit is timed on')
+parser.add_argument('--pipeline_emails', type=int, default=200,
+                    help='number of e-mails the pipeline benchmark generates for')
+parser.add_argument('--generate_num', type=int, default=32,
+                    help='length of every generation of the pipeline benchmark, prompt included')
+parser.add_argument('--changed', type=float, default=0.01,
+                    help='fraction of the e-mails that is modified before the incremental run')
+
+
+def make_corpus(source, emails):
+    """Copies the e-mails of source into a temporary directory until there are `emails` of them."""
+    templates = [join(source, f) for f in sorted(listdir(source)) if f.endswith('.eml')]
+    directory = tempfile.mkdtemp()
+    for i in range(emails):
+        shutil.copyfile(templates[i % len(templates)], join(directory, "b'%d'.eml" % i))
+    return directory
+
+
+# names of the parity checks that failed in this run
+failed_checks = []
+
+
+def check(name, ok):
+    """Records a parity check and returns whether it passed, for printing."""
+    ok = bool(ok)
+    if not ok:
+        failed_checks.append(name)
+    return ok
+
+
+def timed(fn, *fn_args, **fn_kwargs):
+    start = time.time()
+    result = fn(*fn_args, **fn_kwargs)
+    return result, time.time() - start
+
+
+def bench_ingest(args):
+    directory = make_corpus(args.corpus, args.emails)
+    processes = args.processes or None
+    try:
+        reference, serial_time = timed(get_email_body_from_directory, directory, cache=False, processes=1)
+        cold, cold_time = timed(get_email_body_from_directory, directory, processes=processes)
+        warm, warm_time = timed(get_email_body_from_directory, directory, processes=processes)
+
+        # touch some of the files, and add new ones
+        changed = max(1, int(args.emails * args.changed))
+        for i in range(0, args.emails, args.emails // changed)[:changed]:
+            with open(join(directory, "b'%d'.eml" % i), 'ab') as f:
+                f.write(b'\n')
+        for i in range(args.emails, args.emails + changed):
+            shutil.copyfile(join(directory, "b'0'.eml"), join(directory, "b'%d'.eml" % i))
+        incremental, incremental_time = timed(get_email_body_from_directory, directory, processes=processes)
+        expected = get_email_body_from_directory(directory, cache=False, processes=1)
+    finally:
+        shutil.rmtree(directory)
+
+    print('%d e-mails, %d cpus' % (args.emails, os.cpu_count() or 1))
+    print('run                              | seconds | same bodies')
+    print('%-32s | %7.2f | -' % ('serial, no cache (before)', serial_time))
+    print('%-32s | %7.2f | %s' % ('pool, cold cache', cold_time, check('ingest: cold cache', cold == reference)))
+    print('%-32s | %7.2f | %s' % ('pool, warm cache', warm_time, check('ingest: warm cache', warm == reference)))
+    print('%-32s | %7.2f | %s' % ('%d changed + %d new files' % (changed, changed), incremental_time,
+                                  check('ingest: changed and new files', incremental == expected)))
+
+
+def reference_keywords(target_file, docs_path, topn, stop_file):
+    """What extract_keywords did for every target: refit on the whole corpus, then score the target."""
+    data = get_email_body_from_directory(path=docs_path)
+    for key, value in data.items():
+        data[key] = pre_process(value)
+    docs = [data[x] for x in data]
+    with open(target_file, 'rb') as tf:
+        target_doc = str(extract(tf, tf.name))
+    cv = CountVectorizer(max_df=0.90, stop_words=sorted(get_stop_words(stop_file)), max_features=1000)
+    word_count = cv.fit_transform(docs)
+    tfidf_transformer = TfidfTransformer(smooth_idf=True, use_idf=True)
+    tfidf_transformer.fit(word_count)
+    feature_names = sorted(cv.vocabulary_, key=cv.vocabulary_.get)
+    tf_idf_vector = tfidf_transformer.transform(cv.transform([target_doc]))
+    return extra_n_top_keywords(feature_names, sort_coo(tf_idf_vector.tocoo()), topn)
+
+
+def bench_keywords(args):
+    directory = make_corpus(args.corpus, args.emails)
+    # outside the corpus, where it would be read as an e-mail
+    model_path = directory + '.keywords.pickle'
+    try:
+        targets = [join(directory, "b'%d'.eml" % i) for i in range(args.emails)]
+        # parse the corpus once, both sides read it from the body cache
+        get_email_body_from_directory(directory, processes=args.processes or None)
+
+        reference, reference_time = timed(lambda: [reference_keywords(target, directory, 10, args.stop_file)
+                                                   for target in targets[:args.targets]])
+        keywords, batched_time = timed(extract_keywords_from_files, targets, directory, 10, args.stop_file,
+                                       model_path)
+        same = check('keywords: one fit, one batched transform', keywords[:args.targets] == reference)
+        _, load_time = timed(KeywordExtractor.load, model_path, get_stop_words(args.stop_file))
+    finally:
+        shutil.rmtree(directory)
+        if os.path.exists(model_path):
+            os.remove(model_path)
+
+    per_target = reference_time / args.targets
+    print('%d e-mails in the corpus, keywords of all of them' % args.emails)
+    print('run                                   | seconds | same keywords')
+    print('%-37s | %7.1f | -' % ('refit per target (estimated)', per_target * args.emails))
+    print('%-37s | %7.1f | %s' % ('one fit, one batched transform', batched_time, same))
+    print('%-37s | %7.3f | -' % ('loading the saved extractor', load_time))
+
+
+def serial_contents(generate_batch, extractor, control_codes, files):
+    """What generation.py does for one e-mail, for every file in turn."""
+    contents = []
+    for abs_file in files:
+        keywords = list(extractor.keywords([str(extract_file(abs_file))], 10)[0])
+        code = choose_control_code(keywords, control_codes, 'Links')
+        contents.append(generate_batch([' '.join([code] + keywords)])[0])
+    return contents
+
+
+def bench_pipeline(args):
+    directory = make_corpus(args.corpus, args.pipeline_emails)
+    try:
+        files = email_files(directory)
+        extractor = get_extractor(directory, args.stop_file)
+        control_codes = load_control_codes('depeng/control_codes.json')
+        pipeline = Pipeline(extractor, control_codes, 'Links', processes=args.processes or None)
+
+        # the model is built after the workers are forked
+        import tensorflow as tf
+        tf.enable_eager_execution()
+        from CTRL.server import tiny_service
+        service = tiny_service(max_length=args.generate_num, tokenize=hashed_tokenizer(1000))
+        generate_batch = service_generate_batch(service, args.generate_num)
+        generate_batch(['Links warm up'])
+
+        serial, serial_time = timed(serial_contents, generate_batch, extractor, set(control_codes), files)
+        out_path = directory + '.jsonl'
+        try:
+            with open(out_path, 'w', encoding='utf-8') as out:
+                stats, pipeline_time = timed(pipeline.run, generate_batch, files, out)
+            with open(out_path, 'r', encoding='utf-8') as f:
+                contents = dict((item['file'], item.get('content')) for item in map(json.loads, f))
+        finally:
+            pipeline.close()
+            if os.path.exists(out_path):
+                os.remove(out_path)
+    finally:
+        shutil.rmtree(directory)
+
+    same = check('pipeline: same contents', [contents[f] for f in files] == serial)
+    print('%d e-mails, tiny random-weight model, %d tokens each, %d cpus' % (len(files), args.generate_num,
+                                                                              os.cpu_count() or 1))
+    print('run                   | seconds | e-mails/s | mean batch | model idle s | same contents')
+    print('%-21s | %7.2f | %9.1f | %10d | %12s | -' % ('serial (before)', serial_time, len(files) / serial_time, 1,
+                                                        '-'))
+    print('%-21s | %7.2f | %9.1f | %10.2f | %12.2f | %s' % ('pipeline', pipeline_time, len(files) / pipeline_time,
+                                                            stats['mean_batch'], stats['model_idle_s'], same))
+    print('parse stage:    %s' % json.dumps(stats['parse']))
+    print('generate stage: %s' % json.dumps(stats['generate']))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.benchmark == 'ingest':
+        bench_ingest(args)
+    elif args.benchmark == 'keywords':
+        bench_keywords(args)
+    elif args.benchmark == 'pipeline':
+        bench_pipeline(args)
+    if failed_checks:
+        print('failed parity checks: %s' % '; '.join(failed_checks))
+        sys.exit(1)
@@ -6,4 +6,12 @@ key_words = None
 def get_keywords():
     return key_words
     
-# TBD
\ No newline at end of file
+# TBD
+
+
+def generate_content(generator, control_code, keywords):
+    """Generates content for the keywords of an e-mail behind a control code, as pipeline.py prompts.
+
+    generator is a CTRL.api.CTRLGenerator; its model is loaded by the first call and shared by the next ones.
+    """
+    return generator.generate(' '.join([control_code] + list(keywords)))
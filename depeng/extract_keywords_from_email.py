@@ -4,11 +4,21 @@ from sklearn.feature_extraction.text import CountVectorizer
 
 from sklearn.feature_extraction.text import TfidfTransformer
 
+import hashlib
+import os
+import pickle
 import re
 import string
+from collections import Counter
+from os.path import join
+
+import numpy as np
+from sklearn.preprocessing import normalize
 
 from depeng.read_email import extract
 from depeng.read_email import get_email_body_from_directory
+# CTRL's profiler, or a no-op one without CTRL
+from depeng.read_email import profiler
 
 # preprocess our data
 def pre_process(txt):
@@ -56,42 +66,219 @@ def extra_n_top_keywords(feature_names, sorted_tfidf_vector, n_top=10):
 
     return results
 
-def extract_keywords(target_file, docs_path, topn,stop_file):
+def subtract_counts(counter, counts):
+    """Takes counts out of counter, dropping the terms that reach zero."""
+    for term, n in counts.items():
+        left = counter[term] - n
+        if left > 0:
+            counter[term] = left
+        else:
+            del counter[term]
+
+
+def text_stamp(text):
+    """What a counted document is compared by to tell whether its text changed."""
+    return hashlib.sha1(str(text).encode('utf-8', 'surrogatepass')).digest()
+
+
+class KeywordExtractor(object):
+    """TF-IDF keywords of e-mails against a corpus, fitted once and kept up to date.
+    Gives the keywords of the CountVectorizer(max_df, stop_words, max_features) + TfidfTransformer fit
+    that extract_keywords used to redo for every target, but only keeps the document and term
+    frequencies of the corpus: new documents just add to them, changed or deleted ones take their
+    old counts out again, the vocabulary and idf are derived from them when needed, and many
+    targets are scored in one sparse transform.
+    """
+
+    def __init__(self, stop_words, max_df=0.90, max_features=1000):
+        self.stop_words = sorted(stop_words)
+        self.max_df = max_df
+        self.max_features = max_features
+        # number of corpus documents containing every term, and its count over the corpus
+        self.df = Counter()
+        self.tf = Counter()
+        self.n_docs = 0
+        # key -> (text stamp, term counts) of every document counted so far
+        self.documents = {}
+        self._analyzer = None
+        self._model = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_analyzer'] = None
+        state['_model'] = None
+        return state
+
+    def analyzer(self):
+        if self._analyzer is None:
+            self._analyzer = CountVectorizer(stop_words=self.stop_words).build_analyzer()
+        return self._analyzer
+
+    @profiler.profiled('tfidf.fit')
+    def add_documents(self, data):
+        """Counts the documents of data (dict key -> text) that are not counted yet, or whose text
+        changed since they were (their old counts are taken out first).
+        Returns the number of documents counted.
+        """
+        analyzer = self.analyzer()
+        added = 0
+        for key, value in data.items():
+            stamp = text_stamp(value)
+            if key in self.documents:
+                if self.documents[key][0] == stamp:
+                    continue
+                self.remove_documents([key])
+            counts = Counter(analyzer(pre_process(value)))
+            self.tf.update(counts)
+            self.df.update(counts.keys())
+            self.n_docs += 1
+            self.documents[key] = (stamp, counts)
+            added += 1
+        if added:
+            self._model = None
+        return added
+
+    def remove_documents(self, keys):
+        """Takes the counts of the documents with these keys out again.
+        Returns the number of documents removed.
+        """
+        removed = 0
+        for key in keys:
+            if key not in self.documents:
+                continue
+            _, counts = self.documents.pop(key)
+            subtract_counts(self.tf, counts)
+            subtract_counts(self.df, dict.fromkeys(counts, 1))
+            self.n_docs -= 1
+            removed += 1
+        if removed:
+            self._model = None
+        return removed
+
+    def update(self, data):
+        """Makes the counts those of the corpus data (dict key -> text): documents that are no longer in it
+        are removed, new and changed ones counted.
+        Returns the number of documents removed or counted.
+        """
+        return self.remove_documents([key for key in self.documents if key not in data]) + self.add_documents(data)
+
+    def settings(self):
+        return {'stop_words': self.stop_words, 'max_df': self.max_df, 'max_features': self.max_features}
+
+    def model(self):
+        """The vectorizer with the pruned vocabulary, its feature names and their idf."""
+        if self._model is None:
+            terms = sorted(self.df)
+            dfs = np.array([self.df[term] for term in terms], dtype=np.int64)
+            tfs = np.array([self.tf[term] for term in terms], dtype=np.int64)
+            # the same pruning as CountVectorizer._limit_features, on the same (sorted) arrays
+            high = self.max_df if isinstance(self.max_df, int) else self.max_df * self.n_docs
+            mask = dfs <= high
+            if self.max_features is not None and mask.sum() > self.max_features:
+                mask_inds = (-tfs[mask]).argsort()[:self.max_features]
+                new_mask = np.zeros(len(dfs), dtype=bool)
+                new_mask[np.where(mask)[0][mask_inds]] = True
+                mask = new_mask
+            kept = np.where(mask)[0]
+            if len(kept) == 0:
+                raise ValueError("After pruning, no terms remain. Try a higher max_df.")
+            vectorizer = CountVectorizer(stop_words=self.stop_words,
+                                         vocabulary=dict((terms[i], n) for n, i in enumerate(kept)))
+            # smooth idf, as TfidfTransformer(smooth_idf=True)
+            idf = np.log((self.n_docs + 1.) / (dfs[kept] + 1.)) + 1
+            self._model = (vectorizer, [terms[i] for i in kept], idf)
+        return self._model
+
+    def transform(self, docs):
+        """The l2-normalized tf-idf rows of docs, in one sparse matrix."""
+        vectorizer, _, idf = self.model()
+        X = vectorizer.transform(docs).astype(np.float64).tocsr()
+        X.data *= idf[X.indices]
+        return normalize(X, norm='l2', copy=False)
+
+    @profiler.profiled('tfidf.keywords')
+    def keywords(self, docs, topn=10):
+        """The topn keywords of every doc, as {keyword: score} like extra_n_top_keywords."""
+        _, feature_names, _ = self.model()
+        X = self.transform(docs)
+        results = []
+        for row in range(X.shape[0]):
+            start, end = X.indptr[row], X.indptr[row + 1]
+            sorted_tfidf_vector = sorted(zip(X.indices[start:end], X.data[start:end]),
+                                         key=lambda x: (x[1], x[0]), reverse=True)
+            results.append(extra_n_top_keywords(feature_names, sorted_tfidf_vector, topn))
+        return results
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path, stop_words, max_df=0.90, max_features=1000):
+        """The extractor saved at path, which has to have been made with these settings.
+        Raises ValueError if it was made with others, or by a version that didn't keep the counts of
+        every document.
+        """
+        with open(path, 'rb') as f:
+            extractor = pickle.load(f)
+        if not isinstance(extractor, KeywordExtractor) or 'documents' not in extractor.__dict__:
+            raise ValueError('{} is not a keyword extractor of this version'.format(path))
+        expected = KeywordExtractor(stop_words, max_df, max_features).settings()
+        if extractor.settings() != expected:
+            changed = sorted(name for name in expected if extractor.settings()[name] != expected[name])
+            raise ValueError('{} was made with other {}'.format(path, ', '.join(changed)))
+        return extractor
+
+
+# extractors by (corpus, stop words), so that a process fits every corpus once
+extractors = {}
+
+
+def get_extractor(docs_path, stop_file, model_path=None, data=None):
+    """The keyword extractor of a corpus, with exactly the e-mails now in docs_path counted.
+    model_path -- where the extractor is kept between runs; after loading it only new and changed e-mails
+                  are counted, and deleted ones taken out. a file made with other settings is refitted
+    data       -- get_email_body_from_directory(docs_path), if the caller has it already
+    """
+    key = (docs_path, stop_file)
+    if key not in extractors:
+        stop_words = get_stop_words(stop_file)
+        extractors[key] = None
+        if model_path and os.path.exists(model_path):
+            try:
+                extractors[key] = KeywordExtractor.load(model_path, stop_words)
+            except ValueError:
+                pass
+        if extractors[key] is None:
+            extractors[key] = KeywordExtractor(stop_words)
+    extractor = extractors[key]
+    if data is None:
+        data = get_email_body_from_directory(path=docs_path)
+    if extractor.update(data) and model_path:
+        extractor.save(model_path)
+    return extractor
+
+
+def extract_keywords_from_files(target_files, docs_path, topn, stop_file, model_path=None):
+    """The topn keywords of every target file against the corpus in docs_path, scored in one batch."""
     data = get_email_body_from_directory(path=docs_path)
-    # preprocess ducuments data
-    for key, value in data.items():
-        data[key] = pre_process(value)
-    # get all files content in a list
-    docs = [data[x] for x in data]
-    # read bytes
-    with open(target_file, 'rb') as tf:
-        target_doc = str(extract(tf, tf.name))
-    tf.close()
-    stopwords = get_stop_words(stop_file)
-    # create voucabulary words
-    # ignore words that appear in 90% of documents
-    # our vocabulary size set to 1000
-    # remove stop wprds
-    cv = CountVectorizer(max_df=0.90, stop_words=stopwords, max_features=1000)
-    word_count = cv.fit_transform(docs)
-
-    # list words in our vocabulary
-    # print(list(cv.vocabulary_.keys())[:1000])
-
-    # tfidf
-    tfidf_transformer = TfidfTransformer(smooth_idf=True, use_idf=True)
-    tfidf_transformer.fit(word_count)
-
-    # get feature names
-    feature_names = cv.get_feature_names()
-    # generate tf-idf value for the given file
-    tf_idf_vector = tfidf_transformer.transform(cv.transform([target_doc]))
-
-    # sort the tf-idf vectors by descending order of scores
-    sorted_tfidf_vector = sort_coo(tf_idf_vector.tocoo())
-
-    keywords = extra_n_top_keywords(feature_names, sorted_tfidf_vector, topn)
-    return keywords
+    extractor = get_extractor(docs_path, stop_file, model_path, data)
+    target_docs = []
+    for target_file in target_files:
+        # targets from the corpus itself were just extracted (or checked against the cache)
+        key = join(docs_path, os.path.basename(target_file)).replace(docs_path, "")
+        if os.path.dirname(os.path.abspath(target_file)) == os.path.abspath(docs_path) and key in data:
+            target_docs.append(str(data[key]))
+            continue
+        with open(target_file, 'rb') as tf:
+            target_docs.append(str(extract(tf, tf.name)))
+    return extractor.keywords(target_docs, topn)
+
+
+def extract_keywords(target_file, docs_path, topn,stop_file, model_path=None):
+    return extract_keywords_from_files([target_file], docs_path, topn, stop_file, model_path)[0]
 
 
 if __name__ == "__main__":
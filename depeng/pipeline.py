@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from multiprocessing import Pool
+from os import listdir
+from os.path import join
+
+from depeng.extract_keywords_from_email import get_extractor
+from depeng.read_email import extract_file
+# CTRL's profiler, or a no-op one without CTRL
+from depeng.read_email import profiler
+
+# spam e-mails to generated content: parse the e-mail, pick its tf-idf keywords,
+# put them behind a control code and generate, for a whole directory of e-mails
+#
+# the stages run at the same time: a process pool parses e-mails and scores their keywords
+# while the model generates for the e-mails that are ready, in batches. at most `queue_size`
+# e-mails are between the two (being parsed, waiting or being generated), so parsing can't run
+# away from the model, and the model only waits when the pool has nothing ready for it.
+# the results are written as one json line per e-mail, in the order they finish.
+#
+# run from the repository root, e.g.
+#   python -m depeng.pipeline spam --tiny --out contents.jsonl
+# or with the real model, from the directory with vocab and codes:
+#   python -m depeng.pipeline spam --weights ctrl.wts --out contents.jsonl
+
+parser = argparse.ArgumentParser(description='generate content for every e-mail of a directory')
+parser.add_argument('emails', type=str,
+                    help='directory of .eml files')
+parser.add_argument('--out', type=str, default='contents.jsonl',
+                    help='json lines file the results are written to')
+parser.add_argument('--control_codes', type=str, default='depeng/control_codes.json',
+                    help='control codes an e-mail can get, by keyword')
+parser.add_argument('--default_code', type=str, default='Links',
+                    help='control code of e-mails without a control code among their keywords')
+parser.add_argument('--docs_path', type=str, default=None,
+                    help='corpus the keywords are scored against; the e-mail directory by default')
+parser.add_argument('--stop_file', type=str, default='depeng/resources/stopwords.txt',
+                    help='stop words for keyword extraction')
+parser.add_argument('--model_path', type=str, default=None,
+                    help='where the keyword extractor of the corpus is kept between runs')
+parser.add_argument('--topn', type=int, default=10,
+                    help='keywords per e-mail')
+parser.add_argument('--processes', type=int, default=0,
+                    help='worker processes for parsing and keywords; 0 means one per cpu')
+parser.add_argument('--queue_size', type=int, default=64,
+                    help='most e-mails between parsing and generation')
+parser.add_argument('--batch_size', type=int, default=8,
+                    help='most e-mails generated in one batch')
+parser.add_argument('--max_delay_ms', type=float, default=50.,
+                    help='how long a batch waits to fill up once it has an e-mail')
+parser.add_argument('--generate_num', type=int, default=64,
+                    help='length of every generation, prompt included')
+parser.add_argument('--weights', type=str, default=None,
+                    help='weight file of the CTRL model (see CTRL/weight_store.py)')
+# CTRL.transformer.PRECISIONS, which isn't imported here so that TensorFlow is only loaded after the fork
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16', 'int8'],
+                    help='precision of the weight matrices at inference')
+parser.add_argument('--tiny', action='store_true',
+                    help='generate with a tiny random-weight model instead')
+parser.add_argument('--profile', action='store_true',
+                    help='time the stages of this process (corpus fit, sampling, ...) and print them at the end; '
+                         'the worker processes are not profiled')
+
+# set in every worker process by init_worker
+worker_extractor = None
+worker_topn = 10
+
+
+def init_worker(extractor, topn):
+    global worker_extractor, worker_topn
+    worker_extractor = extractor
+    worker_topn = topn
+
+
+def prepare(abs_file):
+    """The first stage, in a worker process: parses one e-mail and scores its keywords.
+    Returns the item for the generation stage and the seconds it took.
+    """
+    started = time.time()
+    try:
+        body = str(extract_file(abs_file))
+        keywords = list(worker_extractor.keywords([body], worker_topn)[0])
+        return {'file': abs_file, 'keywords': keywords}, time.time() - started
+    except Exception as e:
+        return {'file': abs_file, 'error': repr(e)}, time.time() - started
+
+
+def load_control_codes(path):
+    """The control codes of a mapping file, lowercase: a list of records with a "control code"
+    like control_codes.json, or a json object with the codes as keys.
+    Entries that are not a single word (e.g. "bitcoin(prompt)") are not control codes.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        mapping = json.load(f)
+    codes = [record['control code'] for record in mapping] if isinstance(mapping, list) else list(mapping)
+    return [code.lower() for code in codes if code.isalpha()]
+
+
+def choose_control_code(keywords, control_codes, default):
+    """The control code of an e-mail: its best keyword that is a control code, or default."""
+    for keyword in keywords:
+        if keyword in control_codes:
+            return keyword.capitalize()
+    return default
+
+
+def email_files(path):
+    return [join(path, f) for f in sorted(listdir(path)) if f.endswith('.eml')]
+
+
+class StageCounter(object):
+    """Items through one stage and the seconds it was busy with them."""
+
+    def __init__(self):
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.
+
+    def add(self, items, seconds, failed=0):
+        self.items += items
+        self.failed += failed
+        self.busy += seconds
+
+    def summary(self, elapsed):
+        return {'items': self.items, 'failed': self.failed, 'busy_s': round(self.busy, 3),
+                'items_per_busy_s': round(self.items / self.busy, 2) if self.busy else 0.,
+                'items_per_s': round(self.items / elapsed, 2) if elapsed else 0.}
+
+
+class Pipeline(object):
+    """Parsing and keywords in a process pool, generation in batches in this process, bounded in between.
+    The pool is started here, so create the pipeline before the model: the workers are forked
+    without it.
+    """
+
+    def __init__(self, extractor, control_codes, default_code, topn=10, processes=None, queue_size=64,
+                 batch_size=8, max_delay=0.05):
+        self.control_codes = set(control_codes)
+        self.default_code = default_code
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pool = Pool(processes or os.cpu_count() or 1, initializer=init_worker, initargs=(extractor, topn))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def prompt(self, item):
+        item['control_code'] = choose_control_code(item['keywords'], self.control_codes, self.default_code)
+        item['prompt'] = ' '.join([item['control_code']] + item['keywords'])
+        return item['prompt']
+
+    def run(self, generate_batch, files, out):
+        """Generates for every file, writing a json line per file to out as its batch finishes.
+        generate_batch(prompts) returns the generated text, or an exception, of every prompt.
+        Returns the counters of the stages.
+        """
+        ready = queue.Queue()
+        # a slot per e-mail between the stages; taken before it is parsed, given back once it is written
+        slots = threading.BoundedSemaphore(self.queue_size)
+        parse, generate = StageCounter(), StageCounter()
+        stats = {'batches': 0, 'max_queue': 0, 'model_idle_s': 0.}
+
+        def feed():
+            for abs_file in files:
+                slots.acquire()
+                self.pool.apply_async(prepare, (abs_file,), callback=ready.put,
+                                      error_callback=lambda e, abs_file=abs_file: ready.put(
+                                          ({'file': abs_file, 'error': repr(e)}, 0.)))
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        started = time.time()
+        feeder.start()
+        done = 0
+        while done < len(files):
+            waiting = time.time()
+            batch = [ready.get()]
+            stats['model_idle_s'] += time.time() - waiting
+            stats['max_queue'] = max(stats['max_queue'], ready.qsize() + 1)
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.batch_size and done + len(batch) < len(files):
+                try:
+                    batch.append(ready.get(timeout=max(deadline - time.time(), 0.)))
+                except queue.Empty:
+                    break
+            for item, seconds in batch:
+                parse.add(1, seconds, int('error' in item))
+
+            items = [item for item, _ in batch if 'error' not in item]
+            generating = time.time()
+            try:
+                results = generate_batch([self.prompt(item) for item in items]) if items else []
+            except Exception as e:
+                results = [e] * len(items)
+            generate.add(len(items), time.time() - generating,
+                         sum(isinstance(result, Exception) for result in results))
+            stats['batches'] += int(len(items) > 0)
+            for item, result in zip(items, results):
+                if isinstance(result, Exception):
+                    item['error'] = repr(result)
+                else:
+                    item['content'] = result
+
+            for item, _ in batch:
+                out.write(json.dumps(item) + '\n')
+                slots.release()
+            out.flush()
+            done += len(batch)
+
+        elapsed = time.time() - started
+        return dict(stats, elapsed_s=round(elapsed, 3), parse=parse.summary(elapsed),
+                    generate=generate.summary(elapsed),
+                    mean_batch=round(generate.items / stats['batches'], 2) if stats['batches'] else 0.)
+
+
+def hashed_tokenizer(vocab_size):
+    """Words to made-up token ids, for the tiny random-weight model."""
+    def tokenize(text):
+        return [zlib.crc32(word.encode('utf-8')) % vocab_size for word in text.split()]
+    return tokenize
+
+
+def service_generate_batch(service, max_length):
+    """A generate_batch over a CTRL.server.InferenceService."""
+    def generate_batch(prompts):
+        results = service.generate([{'text': prompt, 'max_length': max_length} for prompt in prompts])
+        return [result if isinstance(result, Exception) else result['text'] for result in results]
+    return generate_batch
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if not args.weights and not args.tiny:
+        parser.error('one of --weights or --tiny is required')
+    if args.profile:
+        profiler.enable()
+    files = email_files(args.emails)
+    docs_path = args.docs_path or args.emails
+    extractor = get_extractor(docs_path, args.stop_file, args.model_path)
+    pipeline = Pipeline(extractor, load_control_codes(args.control_codes), args.default_code, args.topn,
+                        args.processes or None, args.queue_size, args.batch_size, args.max_delay_ms / 1000.)
+
+    # the model is only built once the workers are forked
+    import tensorflow as tf
+    tf.enable_eager_execution()
+    from CTRL.server import ctrl_service, tiny_service
+    if args.tiny:
+        service = tiny_service(max_length=args.generate_num, tokenize=hashed_tokenizer(1000))
+    else:
+        service = ctrl_service(args.weights, args.generate_num, args.precision)
+
+    try:
+        with open(args.out, 'w', encoding='utf-8') as out:
+            stats = pipeline.run(service_generate_batch(service, args.generate_num), files, out)
+    finally:
+        pipeline.close()
+    print(json.dumps(stats, indent=2))
+    if args.profile:
+        print(profiler.report())
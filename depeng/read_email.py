@@ -1,17 +1,43 @@
 import os
+import pickle
 import re
 
 from email import policy
 from email.parser import BytesParser
+from multiprocessing import Pool
 from os import listdir
 from os.path import isfile, join
 #extract text from html
 from bs4 import BeautifulSoup
+
+try:
+    from CTRL.profiling import profiler
+except ImportError:
+    # depeng without CTRL next to it: nothing is timed
+
+    class NoProfiler(object):
+        """Stands in for CTRL.profiling.profiler, doing nothing."""
+
+        def enable(self):
+            pass
+
+        def profiled(self, name):
+            return lambda fn: fn
+
+        def report(self):
+            return 'no profile: CTRL.profiling is not importable'
+
+    profiler = NoProfiler()
 #
 
 
 path = '../../spam'
 
+# name of the parsed-body cache that get_email_body_from_directory keeps in every corpus directory
+CACHE_FILE = '.email_bodies.pickle'
+# below this many files to parse, starting worker processes costs more than it saves
+MIN_FILES_FOR_POOL = 32
+
 
 def caption(origin):
     """Extracts: To, From, Subject and Date from email.Message() or mailbox.Message()
@@ -152,6 +178,7 @@ def extract_body(msgfile):
     return body
 
 
+@profiler.profiled('email.parse')
 def extract(msgfile, key):
     """Extracts all data from e-mail, including From, To, etc., and returns it as a dictionary.
     msgfile -- A file-like readable object
@@ -191,21 +218,83 @@ def extract(msgfile, key):
     return msg
 
 
-def get_email_body_from_directory(path):
-    data = {}
-    file_list = listdir(path)
-    # script_dir = os.path.dirname(__file__) #<-- absolute dir the script is in
-    # rel_path = "email/b'2'.eml"
-    for f in file_list:
+def extract_file(abs_file):
+    """Extracts one e-mail file (what get_email_body_from_directory stores for it)."""
+    with open(abs_file, 'rb') as fp:
+        return extract(fp, fp.name)
+
+
+def file_stamp(abs_file):
+    """What a cached body is keyed by besides the path: (mtime in ns, size)."""
+    st = os.stat(abs_file)
+    return st.st_mtime_ns, st.st_size
+
+
+def load_cache(cache_path):
+    """Reads the body cache, {path: (stamp, body)}; a missing or unreadable cache is just empty."""
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return {}
+
+
+def save_cache(cache_path, cache):
+    """Writes the body cache through a temporary file, so an interrupted run never leaves half a cache."""
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def parse_files(files, processes=None):
+    """Extracts every file in files, in a process pool when there are enough of them."""
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(files) < MIN_FILES_FOR_POOL:
+        return [extract_file(f) for f in files]
+    pool = Pool(processes)
+    try:
+        return pool.map(extract_file, files, chunksize=max(1, len(files) // (4 * processes)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_email_body_from_directory(path, cache=True, processes=None):
+    """Extracts every e-mail in a directory.
+    path      -- directory of the corpus
+    cache     -- keep the extracted bodies in CACHE_FILE inside the directory, keyed by path, mtime and size,
+                 so that only new or changed files are parsed again
+    processes -- worker processes for parsing (default: one per cpu); 1 parses in this process
+    Returns dict() mapping the file name (with a leading separator) to what extract() returned for it.
+    """
+    cache_path = join(path, CACHE_FILE)
+    files = []
+    for f in sorted(listdir(path)):
         if(f.find(".eml")==False):
             continue
-        abs_file = join(path, f)
-        with open(abs_file, 'rb') as fp:
-            # print(f,"**********",self.extract(fp,fp.name))
-            # print(fp.name)
-            data.update({fp.name.replace(path, ""): (extract(fp, fp.name))})
-            fp.close()
+        if f == CACHE_FILE or f == CACHE_FILE + '.tmp':
+            continue
+        files.append(join(path, f))
+
+    stamps = dict((f, file_stamp(f)) for f in files)
+    cached = load_cache(cache_path) if cache else {}
+    stale = [f for f in files if f not in cached or cached[f][0] != stamps[f]]
+    bodies = dict((f, cached[f][1]) for f in files if f not in stale)
+    bodies.update(zip(stale, parse_files(stale, processes)))
 
+    # files that are gone are dropped from the cache too
+    if cache and (stale or len(cached) != len(files)):
+        try:
+            save_cache(cache_path, dict((f, (stamps[f], bodies[f])) for f in files))
+        except (IOError, OSError):
+            # a read-only corpus just isn't cached
+            pass
+
+    data = {}
+    for f in files:
+        data.update({f.replace(path, ""): bodies[f]})
     return data
 
 # abs_file_path = os.path.join(script_dir, rel_path)